@@ -0,0 +1,106 @@
+"""
+Build a replay corpus from the test fixtures, one JSON request per line:
+
+    {"path": "/github_payload", "headers": {...}, "body": {...},
+     "seed_eval": {...}}
+
+seed_eval, if present, is written to the liaison db before the request is
+sent, i.e. the eval a /confirm or /results request refers to. The string
+LEAGUE_HEAD_SHA is replaced with the synthetic league repo's commit on
+replay.
+
+Usage:
+    python -m benchmarks.corpus --num-evals 100 > corpus.jsonl
+"""
+import argparse
+import json
+import sys
+from copy import deepcopy
+from os.path import join
+from typing import List
+
+from constants import HOST, ROOT_DIR
+from utils import generate_rand_alphanumeric, read_json
+
+LEAGUE_HEAD_SHA = 'LEAGUE_HEAD_SHA'
+FIXTURES_DIR = join(ROOT_DIR, 'tests', 'data')
+
+
+def get_pr_event(number: int, action='opened') -> dict:
+    ret = read_json(join(FIXTURES_DIR, 'bot_eval', 'pr_event.json'))
+    ret['action'] = action
+    ret['number'] = number
+    ret['pull_request']['number'] = number
+    ret['pull_request']['base']['sha'] = LEAGUE_HEAD_SHA
+    # Unique head so pushes aren't collapsed by the work queue
+    ret['pull_request']['head']['sha'] = \
+        generate_rand_alphanumeric(40).lower()
+    return ret
+
+
+def get_eval_requests() -> List[dict]:
+    """A /confirm and /results pair for a new eval"""
+    eval_data = read_json(join(FIXTURES_DIR, 'results_handler',
+                               'eval_data.json'))
+    results = read_json(join(FIXTURES_DIR, 'results_handler',
+                             'results_success.json'))
+    eval_key = generate_rand_alphanumeric(25)
+    eval_data.update(eval_key=eval_key,
+                     eval_id=generate_rand_alphanumeric(25),
+                     botleague_liaison_host=HOST,
+                     status='started')
+    results['eval_key'] = eval_key
+    return [dict(path='/confirm', body=dict(eval_key=eval_key),
+                 seed_eval=eval_data),
+            dict(path='/results', body=results)]
+
+
+def make_corpus(num_prs=20, num_ignored=60, num_evals=50) -> List[dict]:
+    """
+    Interleaves actionable pull requests, ignored webhooks (i.e. labeled,
+    closed and ping) and eval confirm/results pairs, roughly in the ratio we
+    see in production.
+    """
+    webhooks = []
+    for i in range(num_prs):
+        webhooks.append(dict(
+            path='/github_payload',
+            headers={'X-Github-Event': 'pull_request'},
+            body=get_pr_event(number=1000 + i)))
+    ignored_actions = ['labeled', 'closed', 'edited']
+    for i in range(num_ignored):
+        if i % 4 == 3:
+            webhooks.append(dict(path='/github_payload',
+                                 headers={'X-Github-Event': 'ping'},
+                                 body=dict(zen='Keep it logically awesome.')))
+        else:
+            webhooks.append(dict(
+                path='/github_payload',
+                headers={'X-Github-Event': 'pull_request'},
+                body=get_pr_event(number=2000 + i,
+                                  action=ignored_actions[i % 3])))
+    evals = [get_eval_requests() for _ in range(num_evals)]
+
+    # Round robin so load is mixed rather than phased
+    ret = []
+    while webhooks or evals:
+        if webhooks:
+            ret.append(webhooks.pop(0))
+        if evals:
+            ret.extend(evals.pop(0))
+    return deepcopy(ret)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--num-prs', type=int, default=20)
+    parser.add_argument('--num-ignored', type=int, default=60)
+    parser.add_argument('--num-evals', type=int, default=50)
+    args = parser.parse_args()
+    for request in make_corpus(args.num_prs, args.num_ignored,
+                               args.num_evals):
+        sys.stdout.write(json.dumps(request) + '\n')
+
+
+if __name__ == '__main__':
+    main()
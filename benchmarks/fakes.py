@@ -0,0 +1,216 @@
+"""
+In-memory stand-ins for GitHub, Firestore and problem endpoints with
+configurable latency, so benchmarks measure the liaison rather than the
+network.
+"""
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from box import Box
+from github import UnknownObjectException
+
+
+def delay(seconds: float):
+    if seconds:
+        time.sleep(seconds)
+
+
+class FakeGithub:
+    """
+    Just the parts of github.Github the liaison uses.
+
+    :param files: Path -> contents served by every repo's get_contents
+    :param changed_files: Raw changed file dicts returned for every pull
+    """
+    def __init__(self, files: Dict[str, str] = None,
+                 changed_files: List[dict] = None, latency: float = 0):
+        self.files = files or {}
+        self.changed_files = changed_files or []
+        self.latency = latency
+        self.calls = 0
+        self.rate_limit_remaining = 5000
+        self._lock = threading.Lock()
+
+    def call(self):
+        with self._lock:
+            self.calls += 1
+        delay(self.latency)
+
+    @property
+    def rate_limiting(self):
+        return self.rate_limit_remaining, 5000
+
+    @property
+    def rate_limiting_resettime(self):
+        return time.time() + 3600
+
+    def get_repo(self, name):
+        self.call()
+        return FakeRepo(self, name)
+
+    def get_organization(self, org):
+        self.call()
+        return Box(get_public_members=lambda: [])
+
+    def get_user(self):
+        return FakeUser(self)
+
+
+class FakeRepo:
+    def __init__(self, github: FakeGithub, name: str):
+        self.github = github
+        self.full_name = name
+
+    def get_contents(self, path, ref=None):
+        self.github.call()
+        if path not in self.github.files:
+            raise UnknownObjectException(404, {'message': 'Not Found'}, {})
+        return Box(decoded_content=self.github.files[path].encode())
+
+    def get_commit(self, sha):
+        self.github.call()
+        return FakeCommit(self.github, sha)
+
+    def get_issue(self, number):
+        self.github.call()
+        return FakeIssue(self.github, number)
+
+    def get_pull(self, number):
+        self.github.call()
+        return FakePull(self.github, number)
+
+
+class FakeCommit:
+    def __init__(self, github: FakeGithub, sha: str):
+        self.github = github
+        self.sha = sha
+
+    def create_status(self, state, description=None, target_url=None,
+                      context=None):
+        self.github.call()
+        return Box(raw_data=dict(state=state, description=description,
+                                 context=context, sha=self.sha))
+
+
+class FakeIssue:
+    def __init__(self, github: FakeGithub, number: int):
+        self.github = github
+        self.number = number
+
+    def create_comment(self, body):
+        self.github.call()
+        return Box(body=body)
+
+
+class FakePull:
+    def __init__(self, github: FakeGithub, number: int):
+        self.github = github
+        self.number = number
+        self.raw_data = dict(number=number, mergeable_state='clean')
+
+    def get_files(self):
+        self.github.call()
+        return [Box(raw_data=f) for f in self.github.changed_files]
+
+    def merge(self, commit_message=None):
+        self.github.call()
+        return Box(merged=True, message='')
+
+
+class FakeUser:
+    def __init__(self, github: FakeGithub):
+        self.github = github
+
+    def create_gist(self, public, files, description=None):
+        self.github.call()
+        return Box(html_url='https://gist.github.com/benchmark')
+
+
+def inject_db_latency(seconds: float):
+    """Add latency to every read and write on the local key value store"""
+    from botleague_helpers.db import DBLocal
+    if getattr(DBLocal, '_benchmark_latency_injected', False):
+        return
+
+    def with_latency(fn):
+        def wrapper(*args, **kwargs):
+            delay(seconds)
+            return fn(*args, **kwargs)
+        return wrapper
+
+    for name in ['_get', '_set', '_compare_and_swap']:
+        setattr(DBLocal, name, with_latency(getattr(DBLocal, name)))
+    DBLocal._benchmark_latency_injected = True
+
+
+class FakeProblemEndpoint:
+    """
+    Local HTTP server accepting eval requests, point REPLACE_PROBLEM_HOST at
+    its url
+    """
+    def __init__(self, latency: float = 0):
+        endpoint = self
+        self.requests = 0
+        self._lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with endpoint._lock:
+                    endpoint.requests += 1
+                delay(latency)
+                body = json.dumps({'success': True}).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.server.server_port}'
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+def build_league_repo(path: str, files: Dict[str, Optional[str]]) -> str:
+    """
+    Commit files to a git repo at path, for the botleague mirror to clone
+    instead of GitHub. The repo is created if need be, so calling again
+    commits a new revision on top.
+    :param files: Relative path -> contents, or None to delete the file
+    :return: The commit sha
+    """
+    from dulwich import porcelain
+    if os.path.exists(os.path.join(path, '.git')):
+        repo = porcelain.open_repo(path)
+    else:
+        repo = porcelain.init(path)
+    deleted = [os.path.join(path, p) for p, c in files.items() if c is None]
+    for rel_path, contents in files.items():
+        if contents is None:
+            continue
+        full_path = os.path.join(path, rel_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as f:
+            f.write(contents)
+    if deleted:
+        porcelain.remove(repo, paths=deleted)
+    porcelain.add(repo, paths=[os.path.join(path, p)
+                               for p, c in files.items() if c is not None])
+    sha = porcelain.commit(repo, message=b'Synthetic league',
+                           author=b'Botleague <bench@botleague.io>',
+                           committer=b'Botleague <bench@botleague.io>')
+    return sha.decode()
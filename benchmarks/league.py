@@ -0,0 +1,202 @@
+"""
+Generate synthetic leagues far larger than the test fixtures: a botleague
+repo tree with thousands of bots and hundreds of problems, the matching
+aggregated_results.json leaderboard snapshots and bot score histories of
+configurable length.
+
+Usage:
+    python -m benchmarks.league --bots 5000 --problems 300 --out /tmp/league
+
+writes out/botleague (a git repo), out/data/problems/<problem_id>/
+aggregated_results.json laid out like LEADERBOARD_DATA_URL, and
+out/bot_scores.jsonl.
+"""
+import argparse
+import json
+import math
+import os
+import random
+from os.path import join
+from typing import Dict, List
+
+from botleague_helpers.utils import get_bot_scores_id_from_parts
+from box import Box
+
+import constants
+from models.bot_scores import EvalKeyFilter, QuantileSketch
+
+
+class SyntheticLeague:
+    """
+    Plain dicts rather than Boxes throughout, as converting millions of
+    scores to Boxes takes longer than generating them
+    """
+    problem_ids: List[str]
+
+    # Repo path -> file contents
+    files: Dict[str, str]
+
+    # problem_id -> aggregated_results.json contents
+    aggregated_results: Dict[str, dict]
+
+    # Bot scores id -> document as save_to_bot_scores writes it
+    bot_scores: Dict[str, dict]
+
+    def __init__(self, problem_ids, files, aggregated_results, bot_scores):
+        self.problem_ids = problem_ids
+        self.files = files
+        self.aggregated_results = aggregated_results
+        self.bot_scores = bot_scores
+
+    def get_stats(self) -> Dict[str, int]:
+        bot_paths = [p for p in self.files
+                     if p.startswith(constants.BOTS_DIR + '/')]
+        return dict(bots=len(bot_paths), problems=len(self.problem_ids),
+                    bot_scores=len(self.bot_scores))
+
+
+def make_league(num_bots=1000, num_problems=100, problems_per_bot=3,
+                history_length=10, bots_per_user=5,
+                seed=0) -> SyntheticLeague:
+    """
+    Each bot has a hidden skill, so its scores agree across problems and
+    leaderboards are stable, and each problem has its own score scale and
+    acceptable_score_deviation.
+    """
+    rng = random.Random(seed)
+    problem_ids = [f'org{i % 10}/problem_{i}' for i in range(num_problems)]
+    problems = {}
+    files = {}
+    for problem_id in problem_ids:
+        # (score scale, acceptable_score_deviation)
+        problems[problem_id] = scale, deviation = \
+            rng.uniform(10, 1000), rng.uniform(1, 50)
+        files[f'{constants.PROBLEMS_DIR}/{problem_id}/'
+              f'{constants.PROBLEM_DEFINITION_FILENAME}'] = json.dumps(dict(
+                endpoint=f'https://example.com/eval/{problem_id}',
+                author='Synthetic League',
+                display_name=problem_id,
+                acceptable_score_deviation=deviation), indent=2)
+
+    leaders = {problem_id: [] for problem_id in problem_ids}
+    bot_scores = {}
+    for i in range(num_bots):
+        username = f'user{i // bots_per_user}'
+        botname = f'bot{i}'
+        bot_problems = rng.sample(problem_ids,
+                                  min(problems_per_bot, num_problems))
+        files[f'{constants.BOTS_DIR}/{username}/{botname}/'
+              f'{constants.BOT_DEFINITION_FILENAME}'] = json.dumps(dict(
+                source_commit=f'https://github.com/{username}/{botname}/'
+                              f'commit/{rng.getrandbits(160):040x}',
+                problems=bot_problems,
+                docker_tag=f'{username}/{botname}',
+                seed='random'), indent=2)
+        skill = rng.random()
+        for problem_id in bot_problems:
+            scale, deviation = problems[problem_id]
+            values = [skill * scale + rng.gauss(0, deviation / 4)
+                      for _ in range(history_length)]
+            scores = make_bot_scores(
+                values, [f'{botname}-{problem_id}-{j}'
+                         for j in range(history_length)])
+            score_id = get_bot_scores_id_from_parts(problem_id, username,
+                                                    botname)
+            bot_scores[score_id] = dict(scores, id=score_id,
+                                        botname=botname, username=username,
+                                        problem_id=problem_id)
+            leaders[problem_id].append(dict(
+                problem=problem_id, username=username, botname=botname,
+                score=scores['mean'] if history_length else None))
+
+    aggregated_results = {}
+    for problem_id, bots in leaders.items():
+        bots.sort(key=lambda b: b['score'] if b['score'] is not None else
+                  -float('inf'), reverse=True)
+        aggregated_results[problem_id] = dict(problem=problem_id, bots=bots)
+
+    ret = SyntheticLeague(problem_ids, files, aggregated_results, bot_scores)
+    return ret
+
+
+def make_bot_scores(values: List[float], eval_keys: List[str]) -> dict:
+    """What add_score leaves after adding each value in turn"""
+    count, mean, m2 = 0, 0.0, 0.0
+    sketch = QuantileSketch()
+    key_filter = EvalKeyFilter()
+    for eval_key in eval_keys:
+        key_filter.add(eval_key)
+    for value in values:
+        count += 1
+        delta = value - mean
+        mean += delta / count
+        m2 += delta * (value - mean)
+        sketch.add(value)
+    recent = constants.BOT_SCORES_NUM_RECENT
+    ret = dict(count=count, mean=mean, m2=m2,
+              stdev=math.sqrt(m2 / (count - 1)) if count > 1 else None,
+              min=min(values) if values else None,
+              max=max(values) if values else None,
+              median=sketch.quantile(0.5),
+              quantile_sketch=sketch.to_list(),
+              eval_key_filter=key_filter.to_str(),
+              scores=[dict(score=v, eval_key=k) for v, k in
+                      zip(values[-recent:], eval_keys[-recent:])])
+    return ret
+
+
+def use_league(league: SyntheticLeague, tmp_dir: str) -> str:
+    """
+    Commit the league to a repo in tmp_dir and point the bot index and
+    leaderboard cache at it, as problem CI would see it in production.
+    :return: The league commit sha
+    """
+    from benchmarks.fakes import build_league_repo
+    from bot_index import BotIndex, set_bot_index
+    from leaderboard import LeaderboardCache, set_leaderboard_cache
+    from repo_mirror import RepoMirror
+
+    src = join(tmp_dir, 'botleague')
+    sha = build_league_repo(src, league.files)
+    mirror = RepoMirror(src, join(tmp_dir, 'botleague_mirror'))
+    set_bot_index(BotIndex(mirror, join(tmp_dir, 'bot_index.json')))
+    cache = LeaderboardCache()
+    for problem_id, snapshot in league.aggregated_results.items():
+        cache.set(problem_id, Box(snapshot))
+    set_leaderboard_cache(cache)
+    return sha
+
+
+def write_league(league: SyntheticLeague, out: str) -> str:
+    """:return: The league commit sha"""
+    from benchmarks.fakes import build_league_repo
+    sha = build_league_repo(join(out, 'botleague'), league.files)
+    for problem_id, snapshot in league.aggregated_results.items():
+        problem_dir = join(out, 'data', 'problems', problem_id)
+        os.makedirs(problem_dir, exist_ok=True)
+        with open(join(problem_dir, 'aggregated_results.json'), 'w') as f:
+            json.dump(snapshot, f)
+    with open(join(out, 'bot_scores.jsonl'), 'w') as f:
+        for bot_scores in league.bot_scores.values():
+            f.write(json.dumps(bot_scores) + '\n')
+    return sha
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--bots', type=int, default=1000)
+    parser.add_argument('--problems', type=int, default=100)
+    parser.add_argument('--problems-per-bot', type=int, default=3)
+    parser.add_argument('--history', type=int, default=10,
+                        help='Scores per bot per problem')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', required=True)
+    args = parser.parse_args()
+    league = make_league(args.bots, args.problems, args.problems_per_bot,
+                         args.history, seed=args.seed)
+    sha = write_league(league, args.out)
+    print(f'Wrote {league.get_stats()} at commit {sha} to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
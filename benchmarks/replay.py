@@ -0,0 +1,271 @@
+"""
+Replay webhook, confirm and results traffic against the WSGI app with fake
+GitHub, Firestore and problem endpoints, and report throughput and latency
+percentiles per route and per stage.
+
+Usage:
+    python -m benchmarks.replay
+    python -m benchmarks.replay --corpus corpus.jsonl --concurrency 8 \\
+        --db-latency 0.02 --github-latency 0.1 --endpoint-latency 0.2
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join
+from typing import Dict, List
+
+WEBHOOK_SECRET = 'benchmark-webhook-secret'
+LEAGUE_GITHUB_TOKEN = 'benchmark-league-token'
+RESULTS_GITHUB_TOKEN = 'benchmark-results-token'
+
+
+def percentile(values: List[float], q: float) -> float:
+    """Nearest rank"""
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize(durations: Dict[str, List[float]]) -> Dict[str, dict]:
+    return {name: dict(count=len(values),
+                       p50=percentile(values, 0.50),
+                       p95=percentile(values, 0.95),
+                       p99=percentile(values, 0.99))
+            for name, values in sorted(durations.items())}
+
+
+def print_table(title: str, summary: Dict[str, dict], out=sys.stdout):
+    out.write(f'\n{title}\n')
+    out.write(f'{"name":<40}{"count":>8}{"p50 ms":>10}{"p95 ms":>10}'
+              f'{"p99 ms":>10}\n')
+    for name, s in summary.items():
+        out.write(f'{name:<40}{s["count"]:>8}{s["p50"] * 1000:>10.1f}'
+                  f'{s["p95"] * 1000:>10.1f}{s["p99"] * 1000:>10.1f}\n')
+
+
+def setup_environment(tmp_dir: str, endpoint_url: str):
+    """Must run before the app and constants are imported"""
+    os.environ['SHOULD_USE_FIRESTORE'] = 'false'
+    os.environ['LEADERBOARD_GITHUB_TOKEN'] = LEAGUE_GITHUB_TOKEN
+    os.environ['PR_QUEUE_PATH'] = join(tmp_dir, 'pr_queue.sqlite')
+    os.environ['BOTLEAGUE_REPO_ROOT'] = join(tmp_dir, 'botleague_mirror')
+    os.environ['REPLACE_PROBLEM_HOST'] = endpoint_url
+    from botleague_helpers.config import disable_firestore_access
+    disable_firestore_access()
+
+
+def build_fake_league(tmp_dir: str) -> str:
+    """:return: Commit sha of a league repo with the fixture bot and problem"""
+    from benchmarks.corpus import FIXTURES_DIR
+    from benchmarks.fakes import build_league_repo
+    from utils import read_file
+    bot_path = 'bots/crizcraig/forward-agent/bot.json'
+    problem_path = 'problems/deepdrive/domain_randomization/problem.json'
+    problem_def = json.loads(read_file(join(FIXTURES_DIR, 'bot_eval',
+                                            problem_path)))
+    # REPLACE_PROBLEM_HOST keeps the path from /eval on
+    problem_def['endpoint'] = 'https://example.com/eval/domain_randomization'
+    src = join(tmp_dir, 'botleague')
+    sha = build_league_repo(src, {
+        bot_path: read_file(join(FIXTURES_DIR, 'bot_eval', bot_path)),
+        problem_path: json.dumps(problem_def, indent=2)})
+    os.environ['BOTLEAGUE_REPO_URL'] = src
+    return sha
+
+
+def install_fakes(github_latency: float, db_latency: float):
+    import constants
+    from benchmarks.corpus import FIXTURES_DIR
+    from benchmarks.fakes import FakeGithub, inject_db_latency
+    from config_cache import get_config_cache
+    from github_gateway import GithubGateway, set_github_gateway
+    from utils import read_file, read_json
+
+    bot_path = 'bots/crizcraig/forward-agent/bot.json'
+    fake_github = FakeGithub(
+        files={bot_path: read_file(join(FIXTURES_DIR, 'bot_eval', bot_path))},
+        changed_files=read_json(join(FIXTURES_DIR, 'bot_eval',
+                                     'changed_files.json')),
+        latency=github_latency)
+    for token in [LEAGUE_GITHUB_TOKEN, RESULTS_GITHUB_TOKEN]:
+        set_github_gateway(GithubGateway(token, client=fake_github), token)
+    cache = get_config_cache()
+    cache.set(constants.GITHUB_WEBHOOK_SECRET_NAME, WEBHOOK_SECRET)
+    cache.set(constants.BOTLEAGUE_RESULTS_GITHUB_TOKEN_NAME,
+              RESULTS_GITHUB_TOKEN)
+    inject_db_latency(db_latency)
+    return fake_github
+
+
+def load_corpus(path: str, league_sha: str) -> List[dict]:
+    if path:
+        with open(path) as f:
+            lines = [l for l in f if l.strip()]
+    else:
+        from benchmarks.corpus import make_corpus
+        lines = [json.dumps(r) for r in make_corpus()]
+    from benchmarks.corpus import LEAGUE_HEAD_SHA
+    return [json.loads(l.replace(LEAGUE_HEAD_SHA, league_sha)) for l in lines]
+
+
+def send(app, request: dict):
+    from botleague_helpers.utils import get_eval_db_key
+    from box import Box
+    from webob import Request
+
+    from utils import get_liaison_db_store
+    if 'seed_eval' in request:
+        seed = Box(request['seed_eval'])
+        get_liaison_db_store().set(get_eval_db_key(seed['eval_key']), seed)
+    body = json.dumps(request['body']).encode()
+    headers = dict(request.get('headers') or {})
+    headers['Content-Type'] = 'application/json'
+    if request['path'] == '/github_payload':
+        sig = hmac.new(WEBHOOK_SECRET.encode(), body,
+                       hashlib.sha256).hexdigest()
+        headers['X-Hub-Signature-256'] = f'sha256={sig}'
+    req = Request.blank(request['path'], method='POST', body=body,
+                        headers=headers)
+    start = time.time()
+    try:
+        status = req.get_response(app).status_code
+    except Exception:
+        # Unhandled errors are logged by the app, count them like a server
+        status = 500
+    return time.time() - start, status
+
+
+def wait_for_queue(timeout: float) -> float:
+    from work_queue import JOB_STATUS_PENDING, JOB_STATUS_RUNNING, \
+        get_pr_queue
+    start = time.time()
+    queue = get_pr_queue()
+    while time.time() - start < timeout:
+        if not queue.count(JOB_STATUS_PENDING) and \
+                not queue.count(JOB_STATUS_RUNNING):
+            break
+        time.sleep(0.05)
+    return time.time() - start
+
+
+def run(args) -> dict:
+    """
+    Replay in a temp dir holding the PR queue, league repo and mirror,
+    removed afterwards unless args.keep_tmp
+    """
+    from benchmarks.fakes import FakeProblemEndpoint
+    tmp_dir = tempfile.mkdtemp(prefix='liaison_bench_')
+    endpoint = FakeProblemEndpoint(latency=args.endpoint_latency)
+    try:
+        return replay_corpus(args, tmp_dir, endpoint)
+    finally:
+        endpoint.stop()
+        # Queue workers hold the SQLite queue in tmp_dir open
+        from work_queue import stop_pr_workers
+        stop_pr_workers(timeout=args.queue_timeout)
+        if args.keep_tmp:
+            print(f'Kept {tmp_dir}')
+        else:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def replay_corpus(args, tmp_dir: str, endpoint) -> dict:
+    setup_environment(tmp_dir, endpoint.url)
+    league_sha = build_fake_league(tmp_dir)
+
+    from main import app
+    from tracing import add_trace_listener
+    fake_github = install_fakes(args.github_latency, args.db_latency)
+
+    stage_durations = defaultdict(list)
+    stage_lock = threading.Lock()
+
+    def on_trace(spans):
+        with stage_lock:
+            for s in spans:
+                stage_durations[s.name].append(s.duration)
+
+    add_trace_listener(on_trace)
+    corpus = load_corpus(args.corpus, league_sha)
+
+    route_durations = defaultdict(list)
+    statuses = defaultdict(int)
+
+    def replay(request):
+        duration, status = send(app, request)
+        with stage_lock:
+            route_durations[request['path']].append(duration)
+            statuses[f'{request["path"]} {status}'] += 1
+
+    start = time.time()
+    if args.concurrency <= 1:
+        for request in corpus:
+            replay(request)
+    else:
+        # Keep each eval's /confirm before its /results
+        with ThreadPoolExecutor(args.concurrency) as executor:
+            pending = {}
+            for request in corpus:
+                if request['path'] == '/results':
+                    key = request['body']['eval_key']
+                    if key in pending:
+                        pending.pop(key).result()
+                future = executor.submit(replay, request)
+                if request['path'] == '/confirm':
+                    pending[request['body']['eval_key']] = future
+    elapsed = time.time() - start
+    drain_time = wait_for_queue(args.queue_timeout)
+
+    return dict(requests=len(corpus),
+                elapsed=elapsed,
+                requests_per_second=len(corpus) / elapsed,
+                queue_drain_seconds=drain_time,
+                github_calls=fake_github.calls,
+                eval_requests=endpoint.requests,
+                statuses=dict(statuses),
+                routes=summarize(route_durations),
+                stages=summarize(stage_durations))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--corpus', help='JSONL corpus, see '
+                                         'benchmarks/corpus.py. Generated '
+                                         'from test fixtures by default.')
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--db-latency', type=float, default=0.01)
+    parser.add_argument('--github-latency', type=float, default=0.05)
+    parser.add_argument('--endpoint-latency', type=float, default=0.1)
+    parser.add_argument('--queue-timeout', type=float, default=300)
+    parser.add_argument('--json', help='Also write the report here')
+    parser.add_argument('--keep-tmp', action='store_true',
+                        help="Keep the temp dir with the replay's PR queue, "
+                             "league repo and mirror for debugging")
+    args = parser.parse_args()
+
+    report = run(args)
+    print(f'\n{report["requests"]} requests in {report["elapsed"]:.2f}s, '
+          f'{report["requests_per_second"]:.1f} req/s. PR queue drained '
+          f'{report["queue_drain_seconds"]:.2f}s later. '
+          f'{report["github_calls"]} GitHub calls, '
+          f'{report["eval_requests"]} eval requests.')
+    print(f'Statuses: {report["statuses"]}')
+    print_table('Routes', report['routes'])
+    print_table('Stages', report['stages'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+"""
+Benchmark how problem CI bot selection and bot score updates scale with
+league size and score history length, on synthetic leagues.
+
+Usage:
+    python -m benchmarks.scale
+    python -m benchmarks.scale --bots 1000 5000 --problems 300 \\
+        --history 10 1000
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from benchmarks.replay import print_table, summarize
+
+
+def timed(durations: List[float], fn, *args, **kwargs):
+    start = time.time()
+    ret = fn(*args, **kwargs)
+    durations.append(time.time() - start)
+    return ret
+
+
+def bench_problem_ci_selection(league, tmp_dir: str,
+                               num_problems: int) -> Dict[str, List[float]]:
+    """
+    Time building the bot index over the league repo, loading it back from
+    disk and selecting the bots to rerun when a problem changes
+    """
+    from bot_index import BotIndex, get_bot_index
+    from problem_ci import get_problem_ci_bots
+    from benchmarks.league import use_league
+
+    durations = defaultdict(list)
+    sha = use_league(league, tmp_dir)
+    index = get_bot_index()
+    timed(durations['bot_index.build'], index.update, sha)
+    timed(durations['bot_index.load'], BotIndex, index.mirror, index.path)
+    for problem_id in league.problem_ids[:num_problems]:
+        timed(durations['problem_ci.select_bots'], get_problem_ci_bots,
+              problem_id, sha)
+    return durations
+
+
+def bench_score_updates(league, num_updates: int) -> Dict[str, List[float]]:
+    """
+    Time adding a score to existing histories, checking a new score against
+    the confidence interval and reading the snapshot a problem CI reduce
+    works from
+    """
+    from botleague_helpers.utils import get_bot_scores_db, get_eval_db_key
+    from box import Box
+
+    import constants
+    from handlers.results_handler import get_problem_ci_snapshot, \
+        save_to_bot_scores, score_within_confidence_interval
+    from utils import generate_rand_alphanumeric, get_liaison_db_store, \
+        set_many
+
+    durations = defaultdict(list)
+    rng = random.Random(0)
+    score_ids = rng.sample(sorted(league.bot_scores),
+                           min(num_updates, len(league.bot_scores)))
+    bot_scores_db = get_bot_scores_db()
+    liaison_db = get_liaison_db_store()
+    bot_evals = {}
+    for i in range(0, len(score_ids), constants.FIRESTORE_MAX_BATCH_SIZE):
+        batch_ids = score_ids[i:i + constants.FIRESTORE_MAX_BATCH_SIZE]
+        set_many(bot_scores_db, {score_id: Box(league.bot_scores[score_id])
+                                 for score_id in batch_ids})
+        evals = {}
+        for score_id in batch_ids:
+            bot_scores = league.bot_scores[score_id]
+            eval_key = generate_rand_alphanumeric(25)
+            evals[get_eval_db_key(eval_key)] = bot_evals[score_id] = Box(
+                eval_key=eval_key,
+                username=bot_scores['username'],
+                botname=bot_scores['botname'],
+                problem_id=bot_scores['problem_id'],
+                status=constants.EVAL_STATUS_COMPLETE,
+                problem_def=Box(acceptable_score_deviation=10),
+                results=Box(score=bot_scores['mean'] or 0, errors=None))
+        set_many(liaison_db, evals)
+
+    for score_id in score_ids:
+        bot_eval = bot_evals[score_id]
+        past_bot_scores = bot_scores_db.get(score_id)
+        timed(durations['bot_scores.confidence_interval'],
+              score_within_confidence_interval, bot_eval, past_bot_scores)
+        timed(durations['bot_scores.save'], save_to_bot_scores, bot_eval,
+              bot_eval.eval_key, Box(score=bot_eval.results.score,
+                                     eval_key=bot_eval.eval_key))
+
+    # Problem CI reruns the top bots, so read them a problem CI at a time
+    num_top = constants.PROBLEM_CI_NUM_TOP_BOTS
+    for i in range(0, len(score_ids), num_top):
+        problem_ci = Box(bot_eval_keys=[bot_evals[s].eval_key
+                                        for s in score_ids[i:i + num_top]])
+        timed(durations['problem_ci.snapshot'], get_problem_ci_snapshot,
+              liaison_db, problem_ci)
+    return durations
+
+
+def run(args) -> dict:
+    os.environ['SHOULD_USE_FIRESTORE'] = 'false'
+    from botleague_helpers.config import disable_firestore_access
+    disable_firestore_access()
+    from benchmarks.league import make_league
+
+    report = {}
+    for num_bots in args.bots:
+        for history_length in args.history:
+            name = f'bots={num_bots} history={history_length}'
+            start = time.time()
+            league = make_league(num_bots, args.problems,
+                                 args.problems_per_bot, history_length)
+            durations = {'league.generate': [time.time() - start]}
+            if history_length == args.history[0]:
+                # Selection doesn't depend on score history
+                with tempfile.TemporaryDirectory() as tmp_dir:
+                    durations.update(bench_problem_ci_selection(
+                        league, tmp_dir, args.selections))
+            durations.update(bench_score_updates(league, args.updates))
+            report[name] = dict(league=league.get_stats(),
+                                stages=summarize(durations))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--bots', type=int, nargs='+',
+                        default=[100, 1000, 5000])
+    parser.add_argument('--problems', type=int, default=300)
+    parser.add_argument('--problems-per-bot', type=int, default=3)
+    parser.add_argument('--history', type=int, nargs='+', default=[10, 100],
+                        help='Scores per bot per problem')
+    parser.add_argument('--selections', type=int, default=50,
+                        help='Problems to select problem CI bots for')
+    parser.add_argument('--updates', type=int, default=300,
+                        help='Bot scores to add a score to')
+    parser.add_argument('--json', help='Also write the report here')
+    args = parser.parse_args()
+
+    report = run(args)
+    for name, result in report.items():
+        print_table(f'{name} {result["league"]}', result['stages'])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
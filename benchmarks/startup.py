@@ -0,0 +1,166 @@
+"""
+Profile what importing the app costs with -X importtime, attribute heavy
+dependencies to whoever imports them, and time cold starts to the first
+response.
+
+Usage:
+    python -m benchmarks.startup
+    python -m benchmarks.startup --top 40 --budget 2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+from constants import ROOT_DIR
+
+# Must only be imported by the handlers that use them
+LAZY_MODULES = ['dulwich', 'botleague_helpers.crypto',
+                'botleague_helpers.logs', 'googleclouddebugger']
+
+# Reported with who imported them. github and firestore come in with
+# botleague_helpers.config and db, which every request needs.
+HEAVY_MODULES = ['github', 'google.cloud.firestore', 'requests',
+                 'cryptography', 'pkg_resources', 'pyramid.config',
+                 'loguru'] + LAZY_MODULES
+
+# Seconds to import main, generous so slow CI machines don't flake
+IMPORT_BUDGET_SECONDS = float(os.environ.get('IMPORT_BUDGET_SECONDS', 3))
+
+
+class ImportRecord:
+    name: str
+    self_seconds: float
+    cumulative_seconds: float
+    depth: int
+    parent: Optional['ImportRecord']
+
+    def __init__(self, name, self_seconds, cumulative_seconds, depth):
+        self.name = name
+        self.self_seconds = self_seconds
+        self.cumulative_seconds = cumulative_seconds
+        self.depth = depth
+        self.parent = None
+
+    @property
+    def chain(self) -> List[str]:
+        """e.g. ['main', 'handlers.results_handler', 'github']"""
+        ret = []
+        record = self
+        while record is not None:
+            ret.insert(0, record.name)
+            record = record.parent
+        return ret
+
+
+def parse_importtime(output: str) -> List[ImportRecord]:
+    """
+    Parse -X importtime output, i.e. lines like
+        import time:       788 |       7880 |   handlers.github_handler
+    Children are printed before their parent and indented one level more.
+    """
+    ret = []
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name[1:]
+        depth = (len(name) - len(name.lstrip(' '))) // 2
+        ret.append(ImportRecord(name.strip(), int(self_us) / 1e6,
+                                int(cumulative_us) / 1e6, depth))
+    # The parent is the next record one level up
+    pending = {}
+    for record in ret:
+        for child in pending.pop(record.depth + 1, []):
+            child.parent = record
+        pending.setdefault(record.depth, []).append(record)
+    return ret
+
+
+def profile_imports(module='main') -> List[ImportRecord]:
+    """Import module in a fresh interpreter, as on a cold start"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True)
+    return parse_importtime(result.stderr)
+
+
+def get_record(records: List[ImportRecord],
+               name: str) -> Optional[ImportRecord]:
+    return next((r for r in records if r.name == name), None)
+
+
+def measure_first_response(path='/', method='GET', body=None) -> float:
+    """:return: Seconds from starting a process to it serving a request"""
+    code = (f'import main\n'
+            f'from webob import Request\n'
+            f'req = Request.blank({path!r}, method={method!r}, '
+            f'body={body!r}, content_type="application/json")\n'
+            f'req.get_response(main.app)\n')
+    start = time.time()
+    subprocess.run([sys.executable, '-c', code], cwd=ROOT_DIR,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   check=True)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--runs', type=int, default=3,
+                        help='Cold starts to time per route')
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET_SECONDS,
+                        help='Exit non-zero if importing main takes longer')
+    parser.add_argument('--json', help='Also write the report here')
+    args = parser.parse_args()
+
+    records = profile_imports('main')
+    main_record = get_record(records, 'main')
+    print(f'\nImporting main took {main_record.cumulative_seconds:.3f}s '
+          f'(budget {args.budget}s)')
+
+    print(f'\n{"module":<50}{"self ms":>10}{"cumul ms":>10}')
+    for record in sorted(records, key=lambda r: r.self_seconds,
+                         reverse=True)[:args.top]:
+        print(f'{record.name:<50}{record.self_seconds * 1000:>10.1f}'
+              f'{record.cumulative_seconds * 1000:>10.1f}')
+
+    print('\nHeavy dependencies')
+    heavy = {}
+    for name in HEAVY_MODULES:
+        record = get_record(records, name)
+        if record is None:
+            print(f'{name:<30}not imported')
+            continue
+        heavy[name] = dict(cumulative=record.cumulative_seconds,
+                           chain=record.chain)
+        print(f'{name:<30}{record.cumulative_seconds * 1000:>8.1f}ms via '
+              f'{" > ".join(record.chain[:-1])}')
+
+    first_response = {}
+    for path, method, body in [('/', 'GET', None),
+                               ('/confirm', 'POST', b'{}')]:
+        durations = [measure_first_response(path, method, body)
+                     for _ in range(args.runs)]
+        first_response[path] = min(durations)
+        print(f'\nCold start to first {path} response: '
+              f'{min(durations):.3f}s (best of {args.runs})')
+
+    eager = [name for name in LAZY_MODULES if get_record(records, name)]
+    if eager:
+        print(f'\nImported eagerly, should be lazy: {eager}')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(dict(import_seconds=main_record.cumulative_seconds,
+                           heavy=heavy, first_response=first_response,
+                           eager=eager), f, indent=2)
+    if eager or main_record.cumulative_seconds > args.budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
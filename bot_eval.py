@@ -1,28 +1,61 @@
-import json
 import os
 import random
+import threading
 import time
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
-from typing import List, Union, Tuple
+from typing import Callable, Dict, List, Union, Tuple
+from urllib.parse import urlparse
 from logs import log
+from metrics import counter
+from models.eval_data import EvalData, PullRequestRef
 from box import Box, BoxList
 
 import constants
 import github
 import requests
+from requests.adapters import HTTPAdapter
 from botleague_helpers.config import blconfig, get_test_name_from_callstack
+from botleague_helpers.db import DB
 from botleague_helpers.utils import get_eval_db_key
 from github import Repository
+from repo_mirror import get_botleague_mirror
 from responses.pr_responses import ErrorPrResponse, RegenPrResponse, \
     IgnorePrResponse, PrResponse, EvalErrorPrResponse, EvalStartedPrResponse
 from tests.mockable import Mockable
-from utils import read_file, get_str_or_box, get_liaison_db_store
+from tracing import span
+from utils import read_file, get_str_or_box, get_liaison_db_store, fan_out, \
+    set_many, cas_update
 
 from utils import generate_rand_alphanumeric
 
 BOT_CHANGED = 'bot_changed'
 PROBLEM_CHANGED = 'problem_changed'
 
+EVALS_TRIGGERED = counter('liaison_evals_triggered_total',
+                          'Eval requests to problem endpoints by outcome',
+                          ['endpoint', 'outcome'])
+
+_problem_sessions: Dict[str, requests.Session] = {}
+_problem_sessions_lock = threading.Lock()
+
+
+def get_problem_session(endpoint: str) -> requests.Session:
+    """
+    Session per problem endpoint host, so a problem CI fan out reuses
+    keep-alive connections instead of a TLS handshake per eval
+    """
+    url = urlparse(endpoint)
+    host = f'{url.scheme}://{url.netloc}'
+    with _problem_sessions_lock:
+        if host not in _problem_sessions:
+            session = requests.Session()
+            session.mount(host, HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=constants.EVAL_FAN_OUT_MAX_WORKERS))
+            _problem_sessions[host] = session
+        return _problem_sessions[host]
+
+
 class BotEvalBase:
     botname: str
     changed_filenames: List[str]
@@ -115,33 +148,39 @@ class BotEvalBase:
 
     def eval_bots_problems(self, problem_ids, bot_def) -> List[PrResponse]:
         """Triggered when someone submits a new bot """
-        responses: List[PrResponse] = []
+        responses = {}
+        evals = []
         for problem_id in problem_ids:
             problem_def_url = '%s/%s/%s' % (
                 constants.PROBLEMS_DIR, problem_id,
                 constants.PROBLEM_DEFINITION_FILENAME)
 
             # Ensure the problem exists
-            # TODO: Use local repo clone for this instead
-            problem_def = self.github_get(self.base_repo, problem_def_url)
+            problem_def = self.league_get(problem_def_url)
 
             if not problem_def:
                 # Problem does not exist
-                responses.append(
-                    EvalErrorPrResponse('Problem does not exist %s' %
-                                        problem_id))
+                responses[problem_id] = EvalErrorPrResponse(
+                    'Problem does not exist %s' % problem_id)
             else:
-                # Trigger the eval at the problem endpoint
-                resp = self.trigger_single_eval(bot_def, problem_def,
-                                                problem_id)
-                responses.append(resp)
-        return responses
+                evals.append((self, self.prepare_single_eval(
+                    bot_def, problem_def, problem_id)))
 
-    def trigger_single_eval(self, bot_def, problem_def,
-                            problem_id,
+        def on_timeout(eval_item) -> PrResponse:
+            _evaluator, eval_data = eval_item
+            return EvalErrorPrResponse('Timed out triggering eval for %s' %
+                                       eval_data.problem_id)
+
+        # Trigger the evals at the problem endpoints
+        trigger_responses = trigger_evals(evals, on_timeout=on_timeout)
+        for (_evaluator, eval_data), resp in zip(evals, trigger_responses):
+            responses[eval_data.problem_id] = resp
+        return [responses[problem_id] for problem_id in problem_ids]
+
+    def prepare_single_eval(self, bot_def, problem_def, problem_id,
                             problem_ci_replace_sim_url=None,
-                            container_postfix=None) -> PrResponse:
-        endpoint = problem_def.endpoint
+                            container_postfix=None) -> EvalData:
+        """:return: eval_data to store and then send to the problem endpoint"""
         if problem_ci_replace_sim_url:
             problem_def.problem_ci_replace_sim_url = problem_ci_replace_sim_url
         if container_postfix:
@@ -150,11 +189,18 @@ class BotEvalBase:
         eval_id = generate_rand_alphanumeric(25)
         eval_data = self.get_eval_data(eval_id, eval_key, problem_id, bot_def,
                                        problem_def)
-        db = get_liaison_db_store()
-        db_key = get_eval_db_key(eval_data.eval_key)
-        db.set(db_key, eval_data)
-        eval_data = db.get(db_key)  # Resolve timestamp
-        resp = self.request_eval(endpoint, eval_data)
+        return eval_data
+
+    def trigger_single_eval(self, bot_def, problem_def,
+                            problem_id,
+                            problem_ci_replace_sim_url=None,
+                            container_postfix=None,
+                            db: DB = None) -> PrResponse:
+        eval_data = self.prepare_single_eval(
+            bot_def, problem_def, problem_id,
+            problem_ci_replace_sim_url=problem_ci_replace_sim_url,
+            container_postfix=container_postfix)
+        resp = trigger_evals([(self, eval_data)], db=db)[0]
         return resp
 
     @staticmethod
@@ -162,51 +208,26 @@ class BotEvalBase:
         raise NotImplementedError()
 
     def get_eval_data(self, eval_id, eval_key, problem_id, bot_def,
-                      problem_def) -> Box:
-        # TODO: Move this to models/eval_data and use an object instead of a box
-        pull_number = self.pr_event.number
-        pull_url = self.pr_event.url
-        pull_request_updated_at = self.pr_event.updated_at
-        merge_commit_sha = self.pr_event.merge_commit_sha
-        head_commit = self.pr_event.head.sha
-        base_commit = self.pr_event.base.sha
-        draft = self.pr_event.draft
-        is_release = not draft
-        head_full_name = self.pr_event.head.repo.full_name
-        base_full_name = self.pr_event.base.repo.full_name
-        now = time.time()
-        eval_data = Box(docker_tag=bot_def.docker_tag,
-                        eval_key=eval_key,
-                        eval_id=eval_id,
-                        seed=self.seed,
-                        problem_id=problem_id,
-                        problem_def=problem_def,
-                        botname=self.botname,
-                        username=self.user_or_org_dir,
-                        status=constants.EVAL_STATUS_STARTED,
-                        started=now,
-                        started_at=SERVER_TIMESTAMP,
-                        league_commit_sha=head_commit,
-                        botleague_liaison_host=self.botleague_liaison_host,
-                        reason=self.reason,
-                        is_release=is_release,
-                        pull_request=dict(
-                            url=pull_url,
-                            number=pull_number,
-                            updated_at=pull_request_updated_at,
-                            merge_commit_sha=merge_commit_sha,
-                            head_commit=head_commit,
-                            head_full_name=head_full_name,
-                            base_commit=base_commit,
-                            base_full_name=base_full_name,
-                            draft=draft,
-                            pr_event=self.pr_event,
-                        ), )
-        if 'source_commit' in bot_def:
-            eval_data.source_commit = bot_def.source_commit
-        else:
-            eval_data.source_commit = ''
-
+                      problem_def) -> EvalData:
+        pull_request = PullRequestRef.from_github(self.pr_event)
+        eval_data = EvalData(
+            docker_tag=bot_def.docker_tag,
+            eval_key=eval_key,
+            eval_id=eval_id,
+            seed=self.seed,
+            problem_id=problem_id,
+            problem_def=problem_def,
+            botname=self.botname,
+            username=self.user_or_org_dir,
+            status=constants.EVAL_STATUS_STARTED,
+            started=time.time(),
+            started_at=SERVER_TIMESTAMP,
+            league_commit_sha=pull_request.head_commit,
+            botleague_liaison_host=self.botleague_liaison_host,
+            reason=self.reason,
+            is_release=not pull_request.draft,
+            pull_request=pull_request,
+            source_commit=bot_def.get('source_commit', ''))
         return eval_data
 
     @staticmethod
@@ -217,6 +238,10 @@ class BotEvalBase:
     def github_get(self, repo, filename, ref=None):
         raise NotImplementedError()
 
+    def league_get(self, filename):
+        """Get a file from the league repo as of the pull request's base"""
+        raise NotImplementedError()
+
     def user_in_org(self, user, org):
         raise NotImplementedError()
 
@@ -229,21 +254,28 @@ class BotEval(BotEvalBase):
         from utils import get_file_from_github
         return get_file_from_github(repo, filename, ref)
 
+    def league_get(self, filename):
+        return get_botleague_mirror().read_box(filename,
+                                               ref=self.pr_event.base.sha)
+
     @staticmethod
-    def request_eval(endpoint: str, eval_data: Box) -> PrResponse:
+    def request_eval(endpoint: str, eval_data: EvalData) -> PrResponse:
         try:
             if 'REPLACE_PROBLEM_HOST' in os.environ:
                 endpoint = os.environ['REPLACE_PROBLEM_HOST'] + \
                            endpoint[endpoint.find('/eval'):]
-            # TODO: Don't pass everything through to endpoint - i.e. cleanse
-            serializable_data = json.loads(eval_data.to_json(default=str,
-                                                             sort_keys=True))
-            endpoint_resp = requests.post(endpoint,
-                                          json=serializable_data,
-                                          timeout=10)
+            body = eval_data.to_request_body()
+            with span('request_eval', endpoint=endpoint, size=len(body)):
+                endpoint_resp = get_problem_session(endpoint).post(
+                    endpoint, data=body,
+                    headers={'Content-Type': 'application/json'},
+                    timeout=constants.PROBLEM_ENDPOINT_TIMEOUT)
         except requests.exceptions.Timeout:
             ret = EvalErrorPrResponse(
                 'Endpoint %s took too long to respond' % endpoint)
+        except requests.exceptions.RequestException as e:
+            ret = EvalErrorPrResponse(
+                'Could not reach endpoint %s: %s' % (endpoint, e))
         else:
             # Yay, we did not timeout!
             if endpoint_resp.status_code != 200:
@@ -285,8 +317,11 @@ class BotEvalMock(BotEvalBase, Mockable):
         ret = get_str_or_box(content_str, filepath)
         return ret
 
+    def league_get(self, filename):
+        return self.github_get(None, filename)
+
     @staticmethod
-    def request_eval(endpoint: str, eval_data: Box) -> PrResponse:
+    def request_eval(endpoint: str, eval_data: EvalData) -> PrResponse:
         if eval_data.eval_key == eval_data.eval_id:
             raise RuntimeWarning('eval_key and eval_id should be different! '
                                  'The key is private, but the id can be '
@@ -300,6 +335,93 @@ class BotEvalMock(BotEvalBase, Mockable):
         return ret
 
 
+def trigger_evals(evals: List[Tuple[BotEvalBase, EvalData]], db: DB = None,
+                  on_timeout: Callable = None) -> List[PrResponse]:
+    """
+    Store the prepared evals in one batched write, then request them from
+    their problem endpoints concurrently.
+
+    Evals that fail to start, time out or raise are canceled, so that the
+    endpoint can't confirm and run them later on. Those that were confirmed
+    in the meantime are running after all, and are returned as started.
+
+    :param evals: (evaluator, eval_data) pairs from prepare_single_eval
+    :param on_timeout: Called with the (evaluator, eval_data) pair for evals
+        whose endpoint doesn't respond in time
+    :return: Responses in the same order as evals
+    """
+    db = db or get_liaison_db_store()
+    stored = set_many(db, {get_eval_db_key(eval_data.eval_key):
+                           eval_data.to_dict()
+                           for _evaluator, eval_data in evals})
+
+    def get_stored(eval_item) -> EvalData:
+        # Stored version has the timestamps resolved
+        return EvalData.from_dict(
+            stored[get_eval_db_key(eval_item[1].eval_key)])
+
+    def not_started(eval_item, resp: PrResponse, outcome: str) -> PrResponse:
+        eval_data = get_stored(eval_item)
+        if not cancel_eval(db, eval_data.eval_key):
+            resp = EvalStartedPrResponse(
+                f'Evaluation confirmed despite: {resp.msg}', eval_data)
+            outcome = 'started'
+        EVALS_TRIGGERED.inc(endpoint=eval_data.problem_def.endpoint,
+                            outcome=outcome)
+        return resp
+
+    def request(eval_item) -> PrResponse:
+        evaluator, _eval_data = eval_item
+        eval_data = get_stored(eval_item)
+        endpoint = eval_data.problem_def.endpoint
+        resp = evaluator.request_eval(endpoint, eval_data)
+        if not isinstance(resp, EvalStartedPrResponse):
+            return not_started(eval_item, resp, 'error')
+        EVALS_TRIGGERED.inc(endpoint=endpoint, outcome='started')
+        return resp
+
+    def timed_out(eval_item) -> PrResponse:
+        if on_timeout is None:
+            resp = EvalErrorPrResponse('Timed out triggering eval')
+        else:
+            resp = on_timeout(eval_item)
+        return not_started(eval_item, resp, 'timeout')
+
+    def failed(eval_item, e: Exception) -> PrResponse:
+        log.opt(exception=e).error(
+            f'Could not trigger eval for {eval_item[1].problem_id}')
+        return not_started(eval_item, EvalErrorPrResponse(
+            f'Could not trigger eval: {e}'), 'error')
+
+    ret = fan_out(request, evals,
+                  max_workers=constants.EVAL_FAN_OUT_MAX_WORKERS,
+                  timeout=constants.EVAL_FAN_OUT_DEADLINE,
+                  on_timeout=timed_out, on_error=failed)
+    return ret
+
+
+def cancel_eval(db: DB, eval_key: str) -> bool:
+    """
+    Keep an eval that failed to trigger from starting later, as problem
+    endpoints confirm evals before running them
+    :return: False if it was already confirmed, i.e. it's running
+    """
+    status = None
+
+    def cancel(current_eval_data):
+        nonlocal status
+        status = current_eval_data.status
+        if status != constants.EVAL_STATUS_STARTED:
+            return None
+        current_eval_data.status = constants.EVAL_STATUS_CANCELED
+        return current_eval_data
+
+    if cas_update(db, get_eval_db_key(eval_key), cancel,
+                  name='eval_data') is not None:
+        return True
+    return status == constants.EVAL_STATUS_CANCELED
+
+
 def get_bot_eval(use_mock):
     if use_mock or blconfig.is_test or get_test_name_from_callstack():
         # Redundant guard rails
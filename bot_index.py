@@ -0,0 +1,154 @@
+import json
+import os
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from box import Box
+
+import constants
+from logs import log
+from repo_mirror import RepoMirror, get_botleague_mirror
+
+
+class BotIndex:
+    """
+    Inverted index of problem_id -> bots listing that problem, built from the
+    league repo and persisted to disk.
+
+    Moving the index to a new commit only re-reads the bot.json files that
+    changed between the indexed commit and the new one.
+    """
+    mirror: RepoMirror
+    path: str
+    commit: Optional[str] = None
+
+    # 'user_or_org/botname' -> bot_def
+    bots: Dict[str, dict]
+
+    # problem_id -> ['user_or_org/botname', ...]
+    problems: Dict[str, List[str]]
+
+    def __init__(self, mirror: RepoMirror, path: str):
+        self.mirror = mirror
+        self.path = path
+        self.bots = {}
+        self.problems = {}
+        self._lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.commit = data['commit']
+            self.bots = data['bots']
+        except Exception:
+            log.exception(f'Could not load bot index {self.path}, rebuilding')
+            self.commit = None
+            self.bots = {}
+        self._invert()
+
+    def save(self):
+        # Unique temp file as every server worker saves its own index here
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(self.path) or '.',
+            prefix=os.path.basename(self.path) + '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(dict(commit=self.commit, bots=self.bots), f)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def update(self, ref: str):
+        with self._lock:
+            commit = self.mirror.resolve(ref).decode()
+            if commit == self.commit:
+                return
+            if self.commit is None or not self.mirror.has_commit(self.commit):
+                log.info(f'Building bot index at {commit}')
+                self.bots = {f'{user}/{botname}': bot_def.to_dict()
+                             for user, botname, bot_def in
+                             self.mirror.get_bot_defs(commit)}
+            else:
+                changed = [path for path in
+                           self.mirror.get_changed_paths(self.commit, commit)
+                           if is_bot_def_path(path)]
+                log.info(f'Updating bot index from {self.commit} to {commit}, '
+                         f'{len(changed)} bots changed')
+                for path in changed:
+                    _bots_dir, user, botname, _filename = path.split('/')
+                    bot_def = parse_bot_def(
+                        path, self.mirror.read_file(path, commit,
+                                                    missing_ok=True))
+                    if bot_def:
+                        self.bots[f'{user}/{botname}'] = bot_def
+                    else:
+                        self.bots.pop(f'{user}/{botname}', None)
+            self.commit = commit
+            self._invert()
+            self.save()
+
+    def get_bots_for_problem(self, problem_id: str,
+                             ref: str) -> List[Tuple[str, str, Box]]:
+        """:return: (user_or_org, botname, bot_def) of bots listing problem"""
+        ret = []
+        with self._lock:
+            self.update(ref)
+            for bot_id in self.problems.get(problem_id, []):
+                user, botname = bot_id.split('/')
+                ret.append((user, botname, Box(self.bots[bot_id])))
+        return ret
+
+    def _invert(self):
+        problems = {}
+        for bot_id, bot_def in sorted(self.bots.items()):
+            for problem_id in set(bot_def.get('problems') or []):
+                problems.setdefault(problem_id, []).append(bot_id)
+        self.problems = problems
+
+
+def parse_bot_def(path: str, text: str) -> Optional[dict]:
+    """:return: The bot_def, or None if deleted or malformed"""
+    if not text:
+        return None
+    try:
+        ret = json.loads(text)
+    except ValueError:
+        log.exception(f'Dropping malformed {path} from bot index')
+        return None
+    if not isinstance(ret, dict):
+        log.error(f'Dropping {path} from bot index, not a JSON object')
+        return None
+    return ret
+
+
+def is_bot_def_path(path: str) -> bool:
+    # e.g. ['bots', user_or_org, botname, 'bot.json']
+    parts = path.split('/')
+    return len(parts) == 4 and parts[0] == constants.BOTS_DIR and \
+        parts[-1] == constants.BOT_DEFINITION_FILENAME
+
+
+_bot_index: Optional[BotIndex] = None
+_bot_index_lock = threading.Lock()
+
+
+def get_bot_index() -> BotIndex:
+    global _bot_index
+    with _bot_index_lock:
+        if _bot_index is None:
+            _bot_index = BotIndex(get_botleague_mirror(),
+                                  constants.BOT_INDEX_PATH)
+        return _bot_index
+
+
+def set_bot_index(bot_index: BotIndex):
+    """Use bot_index instead, e.g. one over a synthetic league in benchmarks"""
+    global _bot_index
+    with _bot_index_lock:
+        _bot_index = bot_index
@@ -0,0 +1,115 @@
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from box import Box
+
+import constants
+from logs import log
+from utils import get_liaison_db_store
+
+
+class ConfigCache:
+    """
+    In-process cache of config values and decrypted secrets, so hot paths like
+    webhooks don't hit Firestore and KMS on every request.
+
+    Entries older than refresh_after are served while being reloaded in the
+    background, so in steady state reads never block on a remote call. Entries
+    older than ttl are reloaded inline.
+    """
+    entries: Dict[str, Box]
+
+    def __init__(self, ttl=constants.CONFIG_CACHE_TTL,
+                 refresh_after=constants.CONFIG_CACHE_REFRESH_AFTER):
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+
+    def get(self, name: str, load: Callable[[], Any], ttl: float = None,
+            refresh_after: float = None) -> Any:
+        """
+        :param load: Fetches the value. Called from a background thread on
+            refresh, so resolve the db before passing it in.
+        :param ttl: Overrides the cache's ttl for name, e.g. for switches
+            that need to take effect quickly. Same for refresh_after.
+        """
+        ttl = self.ttl if ttl is None else ttl
+        if refresh_after is None:
+            refresh_after = min(self.refresh_after, ttl)
+        entry = self.entries.get(name)
+        if entry is not None:
+            age = time.time() - entry.loaded_at
+            if age < refresh_after:
+                return entry.value
+            elif age < ttl:
+                self._refresh_async(name, load)
+                return entry.value
+        return self._load(name, load)
+
+    def set(self, name: str, value: Any):
+        """Seed a value, e.g. one from the environment"""
+        with self._lock:
+            self.entries[name] = Box(value=value, loaded_at=time.time())
+
+    def invalidate(self, name: str = None):
+        """Drop name, or everything if name is None, so it's reloaded"""
+        with self._lock:
+            if name is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(name, None)
+
+    def _load(self, name: str, load: Callable[[], Any]) -> Any:
+        value = load()
+        self.set(name, value)
+        return value
+
+    def _refresh_async(self, name: str, load: Callable[[], Any]):
+        with self._lock:
+            if name in self._refreshing:
+                return
+            self._refreshing.add(name)
+
+        def refresh():
+            try:
+                self._load(name, load)
+            except Exception:
+                log.warning(f'Background refresh of {name} failed, serving '
+                            f'cached value until it expires')
+            finally:
+                with self._lock:
+                    self._refreshing.discard(name)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+
+_config_cache: Optional[ConfigCache] = None
+
+
+def get_config_cache() -> ConfigCache:
+    global _config_cache
+    if _config_cache is None:
+        _config_cache = ConfigCache()
+    return _config_cache
+
+
+def get_config(key: str, ttl: float = None) -> Any:
+    """
+    Cached read of key from the liaison db
+    :param ttl: Seconds a change can take to be seen, per worker. Defaults to
+        CONFIG_CACHE_TTL.
+    """
+    db = get_liaison_db_store()
+    return get_config_cache().get(key, lambda: db.get(key), ttl=ttl)
+
+
+def get_secret(encrypted_key: str) -> str:
+    """Cached, decrypted value of encrypted_key in the liaison db"""
+    # KMS client is slow to import, so wait for the first secret
+    from botleague_helpers.crypto import decrypt_symmetric
+    db = get_liaison_db_store()
+    return get_config_cache().get(
+        encrypted_key, lambda: decrypt_symmetric(db.get(encrypted_key)))
@@ -2,7 +2,8 @@ import os
 from os.path import dirname, join, realpath
 
 ROOT_DIR = dirname(realpath(__file__))
-BOTLEAGUE_REPO_ROOT = join('/tmp', 'botleague')
+BOTLEAGUE_REPO_ROOT = os.environ.get('BOTLEAGUE_REPO_ROOT',
+                                     join('/tmp', 'botleague'))
 
 BOTS_DIR = 'bots'
 PROBLEMS_DIR = 'problems'
@@ -18,6 +19,8 @@ PR_STATUS_SUCCESS = 'success'
 EVAL_STATUS_STARTED = 'started'
 EVAL_STATUS_CONFIRMED = 'confirmed'
 EVAL_STATUS_COMPLETE = 'complete'
+# Failed to trigger, so its endpoint can't confirm it
+EVAL_STATUS_CANCELED = 'canceled'
 
 # TODO: Rename to remove ONGOING
 ONGOING_PROBLEM_CI_KEY_PREFIX = 'botleague_problem_ci'
@@ -31,7 +34,109 @@ SHOULD_RECORD = 'SHOULD_RECORD' in os.environ
 RENAME_PROBLEM_ERROR_MSG = 'Renaming problems currently not supported'
 
 BOTLEAGUE_RESULTS_GITHUB_TOKEN_NAME = 'BOTLEAGUE_RESULTS_GITHUB_TOKEN_encrypted'
+GITHUB_WEBHOOK_SECRET_NAME = 'BL_GITHUB_WEBOOK_SECRET_encrypted'
 
 ON_GAE = 'GAE_APPLICATION' in os.environ
+# Cloud Debugger's agent adds to every cold start, so it's opt in. The App
+# Engine service opts in, see botleague-liaison-app.yaml.
+ENABLE_CLOUD_DEBUGGER = os.environ.get('ENABLE_CLOUD_DEBUGGER') == 'true'
 
 HOST = 'https://liaison.botleague.io'
+
+# Off App Engine we serve with gunicorn, see serve.py
+SERVER_PORT = int(os.environ.get('PORT', 8888))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', 2))
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))
+SERVER_KEEPALIVE = 75  # Longer than load balancers' idle timeouts
+# Results requests upload a gist, comment and merge, so allow for slow GitHub
+SERVER_TIMEOUT = 120
+# Workers are killed this long after shutdown starts, covering in-flight
+# requests and then PR_QUEUE_DRAIN_TIMEOUT for queued pull requests. Jobs
+# cut short are retried on restart.
+SERVER_GRACEFUL_TIMEOUT = 90
+
+# Webhook work queue
+PR_QUEUE_PATH = os.environ.get('PR_QUEUE_PATH',
+                               join('/tmp', 'botleague_liaison_queue.sqlite'))
+PR_QUEUE_WORKERS = int(os.environ.get('PR_QUEUE_WORKERS', 2))
+PR_QUEUE_MAX_ATTEMPTS = 3
+# How long shutdown waits for pull requests being processed
+PR_QUEUE_DRAIN_TIMEOUT = 30
+# Jobs running this long without finishing are assumed to belong to a worker
+# that died, e.g. was killed for timing out, and are retried. Well beyond how
+# long processing a pull request takes.
+PR_QUEUE_STALE_AFTER = 10 * 60
+
+# Eval fan-out
+PROBLEM_ENDPOINT_TIMEOUT = 10
+EVAL_FAN_OUT_MAX_WORKERS = int(os.environ.get('EVAL_FAN_OUT_MAX_WORKERS', 8))
+# Upper bound on requesting any one eval from its problem endpoint, from when
+# its request starts
+EVAL_FAN_OUT_DEADLINE = PROBLEM_ENDPOINT_TIMEOUT + 5
+# Seconds between checks on fan out items waiting for a worker
+FAN_OUT_POLL_INTERVAL = 0.05
+
+BOT_INDEX_PATH = join('/tmp', 'botleague_bot_index.json')
+
+# Leaderboard snapshots used to pick bots for problem CI
+LEADERBOARD_DATA_URL = 'https://botleague.io/data'
+LEADERBOARD_REQUEST_TIMEOUT = 5
+LEADERBOARD_CACHE_TTL = 60
+LEADERBOARD_CACHE_MAX_STALE = 60 * 60
+# 'aggregated_results' or 'bot_scores'
+LEADERBOARD_SOURCE = os.environ.get('LEADERBOARD_SOURCE', 'aggregated_results')
+PROBLEM_CI_NUM_TOP_BOTS = 3
+
+# GitHub client
+GITHUB_POOL_SIZE = 10
+GITHUB_OBJECT_CACHE_SIZE = 256
+# Below this many remaining requests, defer non-critical calls like comments
+GITHUB_RATE_LIMIT_RESERVE = 500
+
+# Bot score aggregates
+BOT_SCORES_NUM_RECENT = 100
+BOT_SCORES_SKETCH_SIZE = 100
+# 16KB of Bloom filter per bot for the eval_keys counted, see EvalKeyFilter
+BOT_SCORES_KEY_FILTER_BITS = 2 ** 17
+BOT_SCORES_KEY_FILTER_HASHES = 7
+
+# Optimistic concurrency retries, see utils.cas_update
+CAS_MAX_ATTEMPTS = 8
+CAS_BASE_DELAY = 0.05
+
+# Config and secrets cache, see config_cache.py
+CONFIG_CACHE_TTL = 600
+# Entries older than this are refreshed in the background
+CONFIG_CACHE_REFRESH_AFTER = 300
+# Kill switches like DISABLE_GIT_HOOK_CONSUMPTION take this long to apply
+CONFIG_SWITCH_TTL = 10
+
+# GitHub webhooks, see webhook_verify.py
+GITHUB_WEBHOOK_PATH = '/github_payload'
+# GitHub caps webhook payloads at 25MB
+GITHUB_WEBHOOK_MAX_PAYLOAD_SIZE = 25 * 1024 * 1024
+GITHUB_WEBHOOK_READ_CHUNK_SIZE = 64 * 1024
+# Webhooks from other repos are acknowledged and ignored, see event_routes.py
+LEAGUE_REPOS = os.environ.get('LEAGUE_REPOS', 'botleague/botleague').split(',')
+
+# Seconds to cache the pending problem CI count served on /metrics
+METRICS_PENDING_PROBLEM_CI_TTL = 60
+
+# Append finished traces as OTLP JSON lines here, see tracing.py
+TRACE_DUMP_PATH = os.environ.get('TRACE_DUMP_PATH')
+
+# Firestore limit on writes in one batch, see utils.set_many
+FIRESTORE_MAX_BATCH_SIZE = 500
+
+# Error alerts to Slack, see logs.SlackAlertShipper
+SLACK_ALERT_QUEUE_SIZE = 1000
+SLACK_ALERT_FLUSH_INTERVAL = 2
+# Errors from the same call site within this many seconds are sent once
+SLACK_ALERT_COALESCE_WINDOW = 60
+SLACK_ALERTS_PER_MINUTE = 20
+
+# Structured log fields are capped at these sizes, see logs.as_json
+LOG_MAX_STRING_CHARS = 2000
+LOG_MAX_LIST_ITEMS = 20
+# Episode logs in results, often pasted inline rather than linked
+LOG_MAX_RESULTS_LOG_CHARS = 200
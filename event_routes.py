@@ -0,0 +1,120 @@
+from typing import Any, Callable, List, Optional, Tuple
+
+import constants
+from logs import log
+from metrics import counter
+from work_queue import PR_ACTIONS, enqueue_pr_event
+
+WEBHOOK_EVENTS = counter('liaison_webhook_events_total',
+                         'GitHub webhook events by action and matched route',
+                         ['event', 'action', 'route'])
+
+ROUTE_IGNORED = 'ignored'
+
+
+class EventRoute:
+    """
+    Selects GitHub webhook events to handle. Criteria left as None match
+    anything.
+    """
+    name: str
+    event: str
+    actions: Optional[List[str]]
+    base_repos: Optional[List[str]]
+    path_prefixes: Optional[List[str]]
+    handler: Callable[[dict], Any]
+    status: int
+
+    def __init__(self, name, event, handler, actions=None, base_repos=None,
+                 path_prefixes=None, status=200):
+        self.name = name
+        self.event = event
+        self.handler = handler
+        self.actions = actions
+        self.base_repos = base_repos
+        self.path_prefixes = path_prefixes
+        self.status = status
+
+    def matches(self, event: str, payload: dict) -> bool:
+        # Cheapest checks first
+        if event != self.event:
+            return False
+        if self.actions is not None and \
+                payload.get('action') not in self.actions:
+            return False
+        if self.base_repos is not None and \
+                get_base_repo(payload) not in self.base_repos:
+            return False
+        if self.path_prefixes is not None and not any(
+                path.startswith(prefix)
+                for path in get_changed_paths(payload)
+                for prefix in self.path_prefixes):
+            return False
+        return True
+
+
+def get_base_repo(payload: dict) -> Optional[str]:
+    if 'pull_request' in payload:
+        repo = payload['pull_request']['base']['repo']
+    else:
+        repo = payload.get('repository') or {}
+    return repo.get('full_name')
+
+
+def get_changed_paths(payload: dict) -> List[str]:
+    """
+    Paths changed by a push. Pull request payloads don't list files, so
+    routes on those can't filter by path.
+    """
+    ret = []
+    for commit in payload.get('commits') or []:
+        for key in ['added', 'modified', 'removed']:
+            ret.extend(commit.get(key) or [])
+    return ret
+
+
+def handle_ping(_payload):
+    return {'ping': True}
+
+
+def handle_pull_request(payload):
+    # Processing happens on the work queue so that we respond well within
+    # GitHub's webhook timeout regardless of how many problems a bot lists
+    queued = enqueue_pr_event(payload)
+    # Responses are sent via creating statuses on the pull request:
+    #   c.f. create_status
+    return {'queued': queued}
+
+
+def handle_push(_payload):
+    # TODO: Set should gen when a problem readme changes
+    return 'nothing to push payload'
+
+
+EVENT_ROUTES = [
+    EventRoute('ping', event='ping', handler=handle_ping),
+    EventRoute('pull_request', event='pull_request',
+               handler=handle_pull_request, actions=PR_ACTIONS,
+               base_repos=constants.LEAGUE_REPOS, status=202),
+    EventRoute('push', event='push', handler=handle_push,
+               base_repos=constants.LEAGUE_REPOS,
+               path_prefixes=[constants.PROBLEMS_DIR + '/']),
+]
+
+
+def route_event(event: str, payload: dict,
+                routes: List[EventRoute] = None) -> Tuple[Any, int]:
+    """
+    Hand the event to the first matching route. Everything else is
+    acknowledged without doing any work.
+    :return: (response body, HTTP status)
+    """
+    routes = EVENT_ROUTES if routes is None else routes
+    action = payload.get('action') or ''
+    for route in routes:
+        if route.matches(event, payload):
+            WEBHOOK_EVENTS.inc(event=event, action=action, route=route.name)
+            return route.handler(payload), route.status
+    WEBHOOK_EVENTS.inc(event=event, action=action, route=ROUTE_IGNORED)
+    log.debug(f'Ignoring {event} event with action {action}')
+    return {'ignored': True}, 200
@@ -0,0 +1,89 @@
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Dict, List, Optional
+
+from logs import log
+
+
+class GithubEffect:
+    name: str
+    fn: Callable
+    depends_on: List[str]
+
+    def __init__(self, name, fn, depends_on=None):
+        self.name = name
+        self.fn = fn
+        self.depends_on = depends_on or []
+
+
+class SkippedEffect(Exception):
+    pass
+
+
+class GithubEffectPlan:
+    """
+    The GitHub side effects of an eval, i.e. comment, status and merge, planned
+    up front and executed concurrently wherever they don't depend on each
+    other.
+
+    Usage:
+        plan.add('status', create_status)
+        plan.add('merge', merge, depends_on=['status'])
+        plan.start()
+        # ... other work
+        results = plan.wait()
+    """
+    effects: List[GithubEffect]
+
+    def __init__(self):
+        self.effects = []
+        self._futures: Dict[str, Future] = {}
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def add(self, name: str, fn: Callable, depends_on: List[str] = None):
+        names = [e.name for e in self.effects]
+        for dependency in depends_on or []:
+            if dependency not in names:
+                # Also guarantees we can't deadlock waiting on dependencies
+                raise ValueError(f'{name} depends on {dependency} which must '
+                                 f'be added first')
+        self.effects.append(GithubEffect(name, fn, depends_on))
+
+    def start(self):
+        if not self.effects:
+            return
+        # One thread per effect so dependents can block on their dependencies
+        self._executor = ThreadPoolExecutor(max_workers=len(self.effects))
+        for effect in self.effects:
+            dependencies = [self._futures[d] for d in effect.depends_on]
+            # Copy the context per effect so spans nest under the caller's
+            self._futures[effect.name] = self._executor.submit(
+                contextvars.copy_context().run, self._run, effect,
+                dependencies)
+
+    def wait(self) -> Dict[str, Any]:
+        """
+        :return: Results by effect name. Effects that raised, or whose
+            dependencies raised, are absent.
+        """
+        if self._executor is None:
+            self.start()
+        # Not a Box, as that would convert results like responses.error.Error
+        ret = {}
+        for name, future in self._futures.items():
+            try:
+                ret[name] = future.result()
+            except SkippedEffect as e:
+                log.error(f'Skipped GitHub effect {name}: {e}')
+            except Exception:
+                log.exception(f'GitHub effect {name} failed')
+        if self._executor is not None:
+            self._executor.shutdown()
+        return ret
+
+    @staticmethod
+    def _run(effect: GithubEffect, dependencies: List[Future]):
+        for name, dependency in zip(effect.depends_on, dependencies):
+            if dependency.exception() is not None:
+                raise SkippedEffect(f'{name} failed')
+        return effect.fn()
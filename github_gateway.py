@@ -0,0 +1,133 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+import github
+from botleague_helpers.config import blconfig
+
+import constants
+from logs import log
+
+
+class GithubGateway:
+    """
+    Process-wide GitHub client for one token.
+
+    Keeps a pooled keep-alive connection, caches repo, commit and issue
+    objects so we don't refetch the same repo for every status or comment, and
+    defers non-critical calls like PR comments when we get close to the rate
+    limit.
+    """
+    client: github.Github
+
+    def __init__(self, token: str, client: github.Github = None):
+        self.client = client or github.Github(
+            token, pool_size=constants.GITHUB_POOL_SIZE)
+        self._lock = threading.RLock()
+        self._cache = OrderedDict()
+        self._deferred = []
+        self._flush_timer: Optional[threading.Timer] = None
+
+    def get_repo(self, repo_name: str):
+        return self._cached(('repo', repo_name),
+                            lambda: self.client.get_repo(repo_name))
+
+    def get_commit(self, repo_name: str, sha: str):
+        return self._cached(
+            ('commit', repo_name, sha),
+            lambda: self.get_repo(repo_name).get_commit(sha=sha))
+
+    def get_issue(self, repo_name: str, number: int):
+        return self._cached(
+            ('issue', repo_name, number),
+            lambda: self.get_repo(repo_name).get_issue(number))
+
+    def get_pull(self, repo_name: str, number: int):
+        # Not cached as we need the current mergeable state
+        return self.get_repo(repo_name).get_pull(number)
+
+    @property
+    def rate_limit_remaining(self) -> int:
+        remaining, _limit = self.client.rate_limiting
+        return remaining
+
+    def is_rate_limit_low(self) -> bool:
+        return self.rate_limit_remaining < constants.GITHUB_RATE_LIMIT_RESERVE
+
+    def call_non_critical(self, fn: Callable, *args, **kwargs):
+        """
+        Call fn now, unless we're close to the rate limit, in which case
+        it's called once the limit resets.
+        """
+        if not self.is_rate_limit_low():
+            return fn(*args, **kwargs)
+        with self._lock:
+            self._deferred.append((fn, args, kwargs))
+            log.warning(f'GitHub rate limit remaining is '
+                        f'{self.rate_limit_remaining}, deferring '
+                        f'{len(self._deferred)} non-critical calls until '
+                        f'reset')
+            if self._flush_timer is None:
+                delay = max(0, self.client.rate_limiting_resettime -
+                            time.time()) + 1
+                self._flush_timer = threading.Timer(delay,
+                                                    self._flush_deferred)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+        return None
+
+    def _flush_deferred(self):
+        with self._lock:
+            deferred, self._deferred = self._deferred, []
+            self._flush_timer = None
+        for fn, args, kwargs in deferred:
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                log.exception(f'Deferred GitHub call {fn} failed')
+
+    def _cached(self, key, fetch: Callable):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        value = fetch()
+        with self._lock:
+            self._cache[key] = value
+            if len(self._cache) > constants.GITHUB_OBJECT_CACHE_SIZE:
+                self._cache.popitem(last=False)
+        return value
+
+
+_gateways: Dict[str, GithubGateway] = {}
+_gateways_lock = threading.Lock()
+
+
+def get_github_gateway(token: str = None) -> GithubGateway:
+    """:param token: Defaults to the league's github token"""
+    if token is None:
+        token = blconfig.github_token
+    with _gateways_lock:
+        if token not in _gateways:
+            _gateways[token] = GithubGateway(token)
+        return _gateways[token]
+
+
+def set_github_gateway(gateway: GithubGateway, token: str = None):
+    """Use gateway for token, e.g. one wrapping a fake client in benchmarks"""
+    if token is None:
+        token = blconfig.github_token
+    with _gateways_lock:
+        _gateways[token] = gateway
+
+
+def get_rate_limit_remaining() -> Optional[int]:
+    """
+    Rate limit left on the league token's gateway, without creating one if
+    nothing has used GitHub yet
+    """
+    gateway = _gateways.get(blconfig.github_token)
+    if gateway is None:
+        return None
+    return gateway.rate_limit_remaining
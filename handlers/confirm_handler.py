@@ -1,11 +1,16 @@
 from botleague_helpers.db import DB
+from botleague_helpers.utils import get_eval_db_key
 from box import Box
 from logs import log
 
 import constants
-from models.eval_data import get_eval_data, save_eval_data
+from models.eval_data import get_eval_data
 from responses.error import Error
-from utils import get_liaison_db_store
+from utils import get_liaison_db_store, cas_update
+
+EVAL_CANCELED_MESSAGE = 'This evaluation was canceled as it could not be ' \
+                        'triggered in time'
+
 
 @log.catch(reraise=True)
 def handle_confirm_request(request):
@@ -38,6 +43,9 @@ def process_confirm(result_payload: Box, db: DB):
         elif eval_data.status == constants.EVAL_STATUS_COMPLETE:
             error.http_status_code = 400
             error.message = 'This evaluation has already been processed'
+        elif eval_data.status == constants.EVAL_STATUS_CANCELED:
+            error.http_status_code = 400
+            error.message = EVAL_CANCELED_MESSAGE
         elif eval_data.status in [constants.EVAL_STATUS_STARTED,
                                   constants.EVAL_STATUS_CONFIRMED]:
             if 'error' in result_payload:
@@ -45,9 +53,25 @@ def process_confirm(result_payload: Box, db: DB):
                 error.message = result_payload.error
             else:
                 # confirmed!
-                resp.confirmed = True
-                eval_data.status = constants.EVAL_STATUS_CONFIRMED
-                save_eval_data(eval_data, db)
+                def confirm(current_eval_data):
+                    if current_eval_data.status == \
+                            constants.EVAL_STATUS_COMPLETE:
+                        error.message = 'This evaluation has already been ' \
+                                        'processed'
+                        return None
+                    elif current_eval_data.status == \
+                            constants.EVAL_STATUS_CANCELED:
+                        # Lost the race with a timed out trigger
+                        error.message = EVAL_CANCELED_MESSAGE
+                        return None
+                    current_eval_data.status = constants.EVAL_STATUS_CONFIRMED
+                    return current_eval_data
+
+                if cas_update(db, get_eval_db_key(eval_key), confirm,
+                              name='eval_data') is None:
+                    error.http_status_code = 400
+                else:
+                    resp.confirmed = True
         else:
             error.http_status_code = 400
             error.message = 'Eval data status unknown %s' % eval_data.status
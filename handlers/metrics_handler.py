@@ -0,0 +1,51 @@
+from typing import Optional
+
+from config_cache import ConfigCache
+from github_gateway import get_rate_limit_remaining
+from logs import log
+from metrics import gauge, render_prometheus
+from problem_ci import PROBLEM_CI_STATUS_PENDING
+from utils import get_liaison_db_store
+
+import constants
+
+GITHUB_RATE_LIMIT_REMAINING = gauge(
+    'liaison_github_rate_limit_remaining',
+    'GitHub API requests left for the league token')
+PENDING_PROBLEM_CI = gauge(
+    'liaison_pending_problem_ci',
+    'Problem CI runs waiting on bot evals to reduce')
+
+# Scrapes shouldn't query Firestore every time
+_pending_problem_ci_cache = ConfigCache(
+    ttl=constants.METRICS_PENDING_PROBLEM_CI_TTL,
+    refresh_after=constants.METRICS_PENDING_PROBLEM_CI_TTL / 2)
+
+
+def get_pending_problem_ci_count() -> Optional[int]:
+    db = get_liaison_db_store()
+
+    def count():
+        return len([p for p in db.where(
+            'status', '==', PROBLEM_CI_STATUS_PENDING)
+            if 'bot_eval_keys' in p])
+
+    try:
+        return _pending_problem_ci_cache.get('pending_problem_ci', count)
+    except (AttributeError, NotImplementedError):
+        # Store doesn't support queries, i.e. local
+        return None
+
+
+def handle_metrics_request(_request) -> str:
+    """:return: Metrics in the Prometheus text format"""
+    # Serve the other metrics even if these can't be refreshed
+    try:
+        GITHUB_RATE_LIMIT_REMAINING.set(get_rate_limit_remaining())
+    except Exception:
+        log.warning('Could not get GitHub rate limit for metrics')
+    try:
+        PENDING_PROBLEM_CI.set(get_pending_problem_ci_count())
+    except Exception:
+        log.warning('Could not count pending problem CI for metrics')
+    return render_prometheus()
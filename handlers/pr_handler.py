@@ -1,12 +1,9 @@
-import os
 from io import BytesIO
 from os.path import join
 
 from typing import List, Union, Tuple
 
-from dulwich import porcelain
-from dulwich.repo import Repo
-from logs import log
+from logs import as_json, log, summarize_pr_event
 
 import github.Repository
 import github.Organization
@@ -15,9 +12,9 @@ from box import Box
 
 from bot_eval import process_changed_bot
 from botleague_helpers.config import blconfig, get_test_name_from_callstack
-from botleague_helpers.utils import box2json
 
 from constants import ON_GAE
+from github_gateway import get_github_gateway
 from problem_ci import process_changed_problem
 from responses.pr_responses import ErrorPrResponse, StartedPrResponse, \
     RegenPrResponse, IgnorePrResponse, PrResponse, EvalStartedPrResponse, \
@@ -25,6 +22,7 @@ from responses.pr_responses import ErrorPrResponse, StartedPrResponse, \
 import constants
 from tests.mockable import Mockable
 from tests.test_constants import CHANGED_FILES_FILENAME
+from tracing import traced
 from utils import read_json, trigger_leaderboard_generation, \
     get_liaison_db_store, is_json, dbox
 
@@ -43,7 +41,6 @@ class PrProcessorBase:
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)  # Support multiple inheritance
         self.is_mock = isinstance(self, Mockable)
-        pull_botleague()
 
     def process_changes(self) -> \
             Tuple[Union[PrResponse, List[PrResponse]], str]:
@@ -186,14 +183,6 @@ class PrProcessorBase:
         raise NotImplementedError()
 
 
-def pull_botleague():
-    src = 'https://github.com/botleague/botleague'
-    dst = constants.BOTLEAGUE_REPO_ROOT
-    if not os.path.exists(constants.BOTLEAGUE_REPO_ROOT):
-        porcelain.clone(src, dst)
-    porcelain.pull(dst, remote_location=src, refspecs=b'refs/heads/master',)
-
-
 class PrProcessor(PrProcessorBase):
     def __init__(self, pr_event):
         if get_test_name_from_callstack():
@@ -201,6 +190,7 @@ class PrProcessor(PrProcessorBase):
         super().__init__()
         self.pr_event = pr_event
 
+    @traced()
     def get_changed_files(self) -> List[Box]:
         # See tests/data/bot_eval/changed_files.json
         if self.changed_files is None:
@@ -210,12 +200,12 @@ class PrProcessor(PrProcessorBase):
         return self.changed_files
 
     def get_repo(self, repo_name):
-        return self.github_client.get_repo(repo_name)
+        return get_github_gateway().get_repo(repo_name)
 
+    @traced()
     def create_status(self, resp, commit_sha, github_client, repo_name):
         status, msg = self.get_ci_resp(resp)
-        repo = github_client.get_repo(repo_name)
-        commit = repo.get_commit(sha=commit_sha)
+        commit = get_github_gateway().get_commit(repo_name, sha=commit_sha)
 
         # status can be error, failure, pending, or success
 
@@ -224,16 +214,13 @@ class PrProcessor(PrProcessorBase):
             description=truncate_pr_msg(msg),
             # target_url='https://botleague.io/users/username/botname/this-evaluation',
             context='Botleague')
-        log.success(f'Created status on pull request '
-                    f'{box2json(Box(status.raw_data))}')
+        log.success('Created status on pull request {}',
+                    as_json(status.raw_data))
         return status
 
     @property
     def github_client(self):
-        if PrProcessor._github_client is None:
-            # Lazy load class variable. Note this doesn't affect the base class
-            PrProcessor._github_client = github.Github(blconfig.github_token)
-        return PrProcessor._github_client
+        return get_github_gateway().client
 
 
 class PrProcessorMock(PrProcessorBase, Mockable):
@@ -368,14 +355,10 @@ def handle_pr_request(payload):
         pull_request = pr_event.pull_request
         pr_processor.pr_event = pr_event
         if get_liaison_host_override(pull_request) and ON_GAE:
-            log.warning(f'DEBUG local set on pull request '
-                        f'{pr_event.to_json(indent=2)} '
-                        f'Skipping!')
+            log.warning('DEBUG local set on pull request {} Skipping!',
+                        as_json(summarize_pr_event(pr_event)))
         else:
-            log.info(f'Processing pull request event')
-            log.trace(f'{pr_event.to_json(indent=2)}')
+            log.info('Processing pull request event {}',
+                     as_json(summarize_pr_event(pr_event)))
+            log.trace('{}', as_json(pr_event))
             return pr_processor.process_changes()
-
-
-if __name__ == '__main__':
-    pull_botleague()
@@ -1,13 +1,10 @@
 import math
 import sys
 import time
-from copy import deepcopy
-from statistics import mean, median, stdev
 
-from botleague_helpers.crypto import decrypt_symmetric
 from botleague_helpers.reduce import try_reduce_async
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
-from typing import Tuple, Optional
+from typing import Tuple, Optional, List
 
 import github
 from botleague_helpers.config import get_test_name_from_callstack, blconfig
@@ -15,17 +12,24 @@ from botleague_helpers.utils import box2json, dbox, \
     get_bot_scores_id_from_parts, get_bot_scores_db, get_eval_db_key
 from botleague_helpers.db import DB, get_db
 from box import Box, BoxList
-from github import Github, GithubException
+from github import GithubException
 import github.Gist
 import constants
-from models.eval_data import get_eval_data, save_eval_data
-from logs import log
-
-from problem_ci import get_problem_ci_db_id, PROBLEM_CI_STATUS_FAILED, \
-    PROBLEM_CI_STATUS_PASSED
+from config_cache import get_secret
+from github_effects import GithubEffectPlan
+from github_gateway import get_github_gateway
+from models.bot_scores import add_score, get_score_count, \
+    is_score_recorded
+from models.eval_data import EvalData, PullRequestRef, get_eval_data
+from logs import as_json, log
+
+from problem_ci import get_bot_eval_failures, get_problem_ci_db_id, \
+    PROBLEM_CI_STATUS_FAILED, PROBLEM_CI_STATUS_PASSED
 from responses.error import Error
 from responses.pr_responses import truncate_pr_msg
-from utils import trigger_leaderboard_generation, get_liaison_db_store, dbox
+from tracing import traced
+from utils import trigger_leaderboard_generation, get_liaison_db_store, dbox, \
+    cas_update, get_many, TracedDB
 
 
 @log.catch(reraise=True)
@@ -34,7 +38,7 @@ def handle_results_request(request) -> Tuple[Box, Box, Optional[str]]:
     Handles results POSTS from problem evaluators at the end of evaluation
     """
     data = Box(request.json)
-    log.info(f'Handling results request {data.to_json(indent=2)}')
+    log.info('Handling results request {}', as_json(data))
     db = get_liaison_db_store()
     error, results, eval_data, gist, should_skip = process_results(data, db)
     if not should_skip:
@@ -43,45 +47,87 @@ def handle_results_request(request) -> Tuple[Box, Box, Optional[str]]:
     return results, error, gist
 
 
-def save_results(db: DB, error: Box, eval_data: Box, gist: str, results: Box):
+def save_results(db: DB, error: Box, eval_data: EvalData, gist: str,
+                 results: Box):
     eval_data.status = constants.EVAL_STATUS_COMPLETE
     eval_data.gist = gist
     if error:
         eval_data.error = error
     eval_data.results = results
     eval_data.results_at = SERVER_TIMESTAMP
-    save_eval_data(eval_data, db)
 
-    # Handle problem ci before saving to the aggregate bot scores
-    # as we want to compare the new bot scores to the previous
-    problem_ci, should_merge, ci_error = check_for_problem_ci(db, eval_data)
+    def complete_eval(current_eval_data):
+        if current_eval_data.status == constants.EVAL_STATUS_COMPLETE:
+            # Another results request beat us to it
+            return None
+        return eval_data.to_dict()
 
-    create_pr_results_comment(eval_data, gist, results)
+    if cas_update(db, get_eval_db_key(eval_data.eval_key), complete_eval,
+                  name='eval_data') is None:
+        return Error(http_status_code=400,
+                     message='This evaluation has already been processed')
 
+    # Handle problem ci before saving to the aggregate bot scores
+    # as we want to compare the new bot scores to the previous
+    problem_ci, should_merge, ci_error, bot_evals = check_for_problem_ci(
+        db, eval_data)
+
+    # Plan all GitHub side effects up front so the independent ones, i.e. the
+    # comment and the status, run concurrently with each other and with the
+    # bot score updates below.
+    github_effects = GithubEffectPlan()
+    github_effects.add('comment', lambda: create_pr_results_comment(
+        eval_data, gist, results))
     if problem_ci:
-        save_problem_ci_results(ci_error, db, error, eval_data, gist,
-                                problem_ci, results, should_merge)
+        pr_status_fn = get_problem_ci_pr_status_fn(ci_error, error, eval_data,
+                                                   problem_ci, should_merge)
     else:
         # Just a normal bot eval
-        update_pr_status(error, eval_data, results, gist)
+        pr_status_fn = lambda: update_pr_status(error, eval_data, results,
+                                                gist)
+    if pr_status_fn:
+        github_effects.add('status', pr_status_fn)
+    should_merge_pr = should_merge and not error
+    if should_merge_pr:
+        # Merge after the status is set in case it's a required check
+        github_effects.add('merge',
+                           lambda: merge_pull_request(eval_data.pull_request),
+                           depends_on=['status'] if pr_status_fn else None)
+    github_effects.start()
+
+    if problem_ci:
+        save_problem_ci_results(ci_error, db, eval_data, problem_ci,
+                                should_merge, bot_evals)
+    else:
         save_to_bot_scores(
             eval_data, eval_data.eval_key,
             Box(score=results.score, eval_key=eval_data.eval_key))
 
     # TODO: Save aggregate problem scores?
 
-    if should_merge and not error:
-        error = merge_pull_request(eval_data.pull_request)
+    github_results = github_effects.wait()
+    failed_effects = [e.name for e in github_effects.effects
+                      if e.name not in github_results]
+    if should_merge_pr:
+        if 'merge' in github_results:
+            error = github_results['merge']
+        else:
+            error = Error(http_status_code=500,
+                          message='Could not merge pull request')
+    if failed_effects and not error:
+        # The eval is saved, but the PR is missing its comment or status
+        error = Error(http_status_code=500,
+                      message=f'Could not update pull request, GitHub '
+                              f'{", ".join(failed_effects)} failed')
     if error:
         results.error = error
     return error
 
 
-def create_pr_results_comment(eval_data: Box, gist: str, results: Box):
-    github_client = Github(blconfig.github_token)
-    league_repo = github_client.get_repo(
-        eval_data.pull_request.base_full_name)
-    issue = league_repo.get_issue(eval_data.pull_request.number)
+def create_pr_results_comment(eval_data: EvalData, gist: str, results: Box):
+    gateway = get_github_gateway()
+    issue = gateway.get_issue(eval_data.pull_request.base_full_name,
+                              eval_data.pull_request.number)
     log_links = ''
     log_link_prefix = '\n* '
     try:
@@ -94,11 +140,24 @@ def create_pr_results_comment(eval_data: Box, gist: str, results: Box):
                        f'Container logs for your evaluation:' \
                        f'{log_link_prefix} {log_links}' \
                        f'\n\n{comment_body}'
-    issue.create_comment(comment_body)
+    gateway.call_non_critical(issue.create_comment, comment_body)
+
+
+def get_problem_ci_pr_status_fn(ci_error, error, eval_data, problem_ci,
+                                should_merge) -> Optional[callable]:
+    """:return: Function that sets the PR status, if the CI is finished"""
+    if should_merge:
+        return lambda: update_pr_status_problem_ci(error, problem_ci,
+                                                   eval_data)
+    elif ci_error:
+        return lambda: update_pr_status_problem_ci(ci_error, problem_ci,
+                                                   eval_data)
+    else:
+        return None
 
 
-def save_problem_ci_results(ci_error, db, error, eval_data, gist, problem_ci,
-                            results, should_merge):
+def save_problem_ci_results(ci_error, db, eval_data, problem_ci,
+                            should_merge, bot_evals: List[EvalData]):
     if not should_merge:
         # If problem_ci fails, don't save to aggregate bot scores collection
         if ci_error:
@@ -107,62 +166,56 @@ def save_problem_ci_results(ci_error, db, error, eval_data, gist, problem_ci,
                         'with the new version of the problem.')
             problem_ci.status = PROBLEM_CI_STATUS_FAILED
             problem_ci.error = ci_error
-            update_pr_status_problem_ci(ci_error, problem_ci, eval_data)
         else:
             log.info('Problem CI not yet finished')
 
     else:
         # Aggregate data from bot evals now that they're done
         gists = BoxList()
-        for bot_eval_key in problem_ci.bot_eval_keys:
-            bot_eval = db.get(get_eval_db_key(bot_eval_key))
+        for bot_eval in bot_evals:
             save_to_bot_scores(
                 bot_eval, bot_eval.eval_key,
                 Box(score=bot_eval.results.score,
                     eval_key=bot_eval.eval_key))
             gists.append(bot_eval.gist)
         problem_ci.gists = gists
-        update_pr_status_problem_ci(error, problem_ci, eval_data)
         problem_ci.status = PROBLEM_CI_STATUS_PASSED
-    db.set(problem_ci.id, problem_ci)
+
+    def update(current_problem_ci):
+        for field in ['status', 'error', 'gists']:
+            if field in problem_ci:
+                current_problem_ci[field] = problem_ci[field]
+        return current_problem_ci
+
+    cas_update(db, problem_ci.id, update, name='problem_ci')
 
 def save_to_bot_scores(eval_data, eval_key, new_score: Box):
-    db = get_bot_scores_db()
+    db = TracedDB(get_bot_scores_db())
     score_id = get_scores_id(eval_data)
-    orig = db.get(score_id)
-    bot_scores = db.get(score_id) or dbox(Box(scores=[]))
-    recorded = bot_scores and \
-               any([b.eval_key == eval_key for b in bot_scores.scores])
-    if not recorded:
-        bot_scores.scores.append(new_score)
-        score_values = [s.score for s in bot_scores.scores]
-        if len(bot_scores) < 2:
-            score_stdev = None
-        else:
-            score_stdev = stdev(score_values)
+
+    def update(bot_scores):
+        created = not bot_scores
+        bot_scores = bot_scores or dbox(Box(scores=[]))
+        if not add_score(bot_scores, new_score):
+            return None
         new_bot_scores = Box(
-            scores=bot_scores.scores,
+            bot_scores,
             id=score_id,
             botname=eval_data.botname,
             username=eval_data.username,
             problem_id=eval_data.problem_id,
-            updated_at=SERVER_TIMESTAMP,
-            mean=mean(score_values),
-            max=max(score_values),
-            min=min(score_values),
-            median=median(score_values),
-            stdev=score_stdev)
-        if not orig:
+            updated_at=SERVER_TIMESTAMP)
+        if created:
             new_bot_scores.created_at = SERVER_TIMESTAMP
-        if not db.cas(score_id, orig, new_bot_scores):
-            log.warning('Race condition saving bot scores! Trying again.')
-            save_to_bot_scores(eval_data, eval_key, new_score)
-        else:
-            log.success(f'Saved new bot scores '
-                        f'{box2json(new_bot_scores)}')
+        return new_bot_scores
 
+    saved = cas_update(db, score_id, update, name='bot_scores')
+    if saved is not None:
+        log.success('Saved new bot scores {}', as_json(saved))
 
-def check_for_problem_ci(db: DB, eval_data: Box) -> Tuple[Box, bool, str]:
+
+def check_for_problem_ci(db: DB,
+                         eval_data: EvalData) -> Tuple[Box, bool, str]:
     """
     Check to see if PR is a problem CI and merge iff this is the last bot
     :return: Whether we should merge or not
@@ -173,24 +226,37 @@ def check_for_problem_ci(db: DB, eval_data: Box) -> Tuple[Box, bool, str]:
     problem_ci_db_key = get_problem_ci_db_id(pr.number, pr.head_commit)
     problem_ci = db.get(problem_ci_db_key)
     error = ''
+    bot_evals = None
     if not problem_ci:
         should_merge = True
     else:
+        # Read every bot eval and their past scores once, up front, for the
+        # readiness check, the reduce and the score aggregation
+        bot_evals, past_bot_scores_list = get_problem_ci_snapshot(
+            db, problem_ci)
+
         def reduce():
             result = dbox(problem_ci)
-            # Refetch all bots in case scores came in after initial request
-            for bot_eval_key in problem_ci.bot_eval_keys:
-                bot_eval = db.get(get_eval_db_key(bot_eval_key))
-                past_bot_scores = get_past_bot_scores(bot_eval)
-                bot_eval_no_eval_key = deepcopy(bot_eval)
-                del bot_eval_no_eval_key['eval_key']
-                log.info(f'Checking confidence interval for bot_eval '
-                         f'{box2json(bot_eval)}\n'
-                         f'past scores: {box2json(past_bot_scores)}')
+            bot_eval_failures = get_bot_eval_failures(problem_ci)
+            if bot_eval_failures:
+                # Evals that did start have finished, now fail the CI for the
+                # ones that never started
+                result.error = f'{len(bot_eval_failures)} bot evals failed ' \
+                    f'to start: ' + ', '.join(
+                        f'{bot_id}: {failure.error}' for bot_id, failure in
+                        sorted(bot_eval_failures.items()))
+                log.error(result.error)
+                return result
+            for bot_eval, past_bot_scores in zip(bot_evals,
+                                                 past_bot_scores_list):
+                bot_details = as_json(bot_eval, omit=['eval_key'])
+                log.info('Checking confidence interval for bot_eval {}\n'
+                         'past scores: {}', as_json(bot_eval),
+                         as_json(past_bot_scores))
                 if bot_eval.results.errors:
                     result.error = str(bot_eval.results.errors)
-                    log.error(result.error + ': bot details ' \
-                        f'{box2json(bot_eval_no_eval_key)}')
+                    log.error('{}: bot details {}', result.error,
+                              bot_details)
                     return result
                 in_interval, interval_info = score_within_confidence_interval(
                     bot_eval, past_bot_scores)
@@ -200,8 +266,8 @@ def check_for_problem_ci(db: DB, eval_data: Box) -> Tuple[Box, bool, str]:
                         f'{interval_info.low} to {interval_info.high}, ' \
                         f'mean: {interval_info.mean} ' \
                         f'problem CI failed'
-                    log.error(result.error + ': bot details ' \
-                        f'{box2json(bot_eval_no_eval_key)}')
+                    log.error('{}: bot details {}', result.error,
+                              bot_details)
                     return result
             else:
                 log.success('Score for bot within confidence interval, '
@@ -210,7 +276,7 @@ def check_for_problem_ci(db: DB, eval_data: Box) -> Tuple[Box, bool, str]:
 
         reduce_result = try_reduce_async(
             reduce_id=problem_ci_db_key,
-            ready_fn=get_bots_done_fn(db, problem_ci.bot_eval_keys),
+            ready_fn=get_bots_done_fn(bot_evals),
             reduce_fn=reduce)
 
         if not reduce_result:
@@ -222,7 +288,22 @@ def check_for_problem_ci(db: DB, eval_data: Box) -> Tuple[Box, bool, str]:
         else:
             should_merge = True
 
-    return problem_ci, should_merge, error
+    return problem_ci, should_merge, error, bot_evals
+
+
+def get_problem_ci_snapshot(db: DB, problem_ci: Box) -> \
+        Tuple[List[EvalData], List[Box]]:
+    """
+    Batch read a problem CI's bot evals and then their past bot scores
+    :return: bot_evals, past_bot_scores ordered as problem_ci.bot_eval_keys
+    """
+    bot_evals = [EvalData.from_dict(b) if b else b for b in get_many(
+        db, [get_eval_db_key(k) for k in problem_ci.bot_eval_keys])]
+    past_bot_scores_list = get_many(TracedDB(get_bot_scores_db()),
+                                    [get_scores_id(b) for b in bot_evals])
+    past_bot_scores_list = [s or Box(scores=[], means=None)
+                            for s in past_bot_scores_list]
+    return bot_evals, past_bot_scores_list
 
 
 def score_within_confidence_interval(bot_eval: Box,
@@ -250,21 +331,21 @@ def score_within_confidence_interval(bot_eval: Box,
     info = Box(mean=None, ci_high=None, ci_low=None,
                acceptable_score_deviation=None)
 
-    if bot_eval.eval_key in [p.eval_key for p in past_bot_scores.scores]:
+    if is_score_recorded(past_bot_scores, bot_eval.eval_key):
         log.warning('Score already recorded, this should not happen!')
         return True, info
     score = bot_eval.results.score
     acceptable_score_deviation = bot_eval.problem_def.acceptable_score_deviation
-    if not past_bot_scores.scores:
+    num_scores = get_score_count(past_bot_scores)
+    if not num_scores:
         # If no previous scores, then we are the mean of the CI
         return True, info
-    score_values = [b.score for b in past_bot_scores.scores]
     multiplier = {
         2: 12.71,
         3:  4.30,
         4:  3.18,
         5:  2.78,
-    }.get(len(score_values) + 1, 1.96)
+    }.get(num_scores + 1, 1.96)
 
     diff_max = acceptable_score_deviation * multiplier / 2
     ci_low = past_bot_scores.mean - diff_max
@@ -286,11 +367,10 @@ def score_within_confidence_interval(bot_eval: Box,
 
 
 
-def get_bots_done_fn(db, bot_eval_keys) -> callable:
+def get_bots_done_fn(bot_evals: List[EvalData]) -> callable:
     def bots_done():
-        for bot_eval_key in bot_eval_keys:
-            bot = db.get(get_eval_db_key(bot_eval_key))
-            log.info(f'Checking if bot is done... bot: {box2json(bot)}')
+        for bot in bot_evals:
+            log.info('Checking if bot is done... bot: {}', as_json(bot))
             if bot.status != constants.EVAL_STATUS_COMPLETE:
                 log.info('Bot not done')
                 return False
@@ -300,16 +380,17 @@ def get_bots_done_fn(db, bot_eval_keys) -> callable:
     return bots_done
 
 
-def update_pr_status_problem_ci(error: Error, problem_ci: Box, eval_data: Box):
+@traced('create_status')
+def update_pr_status_problem_ci(error: Error, problem_ci: Box,
+                                eval_data: EvalData):
     if error:
         pr_msg = f'{str(error)[:50]}... check details link for full logs.'
         pr_status = constants.PR_STATUS_ERROR
     else:
         pr_msg = 'Evaluation complete'
         pr_status = constants.PR_STATUS_SUCCESS
-    league_repo = github.Github(blconfig.github_token).get_repo(
-        eval_data.pull_request.base_full_name)
-    league_commit = league_repo.get_commit(
+    league_commit = get_github_gateway().get_commit(
+        eval_data.pull_request.base_full_name,
         sha=eval_data.pull_request.head_commit)
     # status can be error, failure, pending, or success
     status = league_commit.create_status(
@@ -321,6 +402,7 @@ def update_pr_status_problem_ci(error: Error, problem_ci: Box, eval_data: Box):
     return status
 
 
+@traced('create_status')
 def update_pr_status(error, eval_data, results, gist):
     if error:
         results.error = error
@@ -329,9 +411,9 @@ def update_pr_status(error, eval_data, results, gist):
     else:
         pr_msg = 'Evaluation complete'
         pr_status = constants.PR_STATUS_SUCCESS
-    league_repo = github.Github(blconfig.github_token).get_repo(
-        eval_data.pull_request.base_full_name)
-    commit = league_repo.get_commit(sha=eval_data.pull_request.head_commit)
+    commit = get_github_gateway().get_commit(
+        eval_data.pull_request.base_full_name,
+        sha=eval_data.pull_request.head_commit)
     # status can be error, failure, pending, or success
     status = commit.create_status(
         pr_status,
@@ -342,16 +424,14 @@ def update_pr_status(error, eval_data, results, gist):
     return status
 
 
-def merge_pull_request(pull_request: Box) -> Error:
+def merge_pull_request(pull_request: PullRequestRef) -> Error:
     error = Error()
     if blconfig.is_test or get_test_name_from_callstack():
         log.info('Skipping pr merge in test')
     else:
-        log.info(f'Merging pull request '
-                 f'{box2json(pull_request)}')
-        github_client = Github(blconfig.github_token)
-        repo = github_client.get_repo(pull_request.base_full_name)
-        pr = repo.get_pull(pull_request.number)
+        log.info('Merging pull request {}', as_json(pull_request))
+        pr = get_github_gateway().get_pull(pull_request.base_full_name,
+                                           pull_request.number)
         if dbox(pr.raw_data).mergeable_state == 'draft':
             log.info('Pull request is draft, not trying to merge')
         else:
@@ -365,22 +445,21 @@ def merge_pull_request(pull_request: Box) -> Error:
                 error.http_status_code = e.status
 
     if error:
-        log.error(f'Error merging pull request '
-                  f'{box2json(pull_request)} '
-                  f'Error: {box2json(error)}')
+        log.error('Error merging pull request {} Error: {}',
+                  as_json(pull_request), as_json(error))
 
     return error
 
 
+@traced()
 def post_results_to_gist(db, results) -> Optional[github.Gist.Gist]:
     # Posts to botleague-results gist
     if blconfig.is_test or get_test_name_from_callstack():
         log.info('DETECTED TEST MODE: Not uploading results.')
         ret = None
     else:
-        github_client = Github(
-            decrypt_symmetric(
-                db.get(constants.BOTLEAGUE_RESULTS_GITHUB_TOKEN_NAME)))
+        github_client = get_github_gateway(
+            get_secret(constants.BOTLEAGUE_RESULTS_GITHUB_TOKEN_NAME)).client
         # TODO: Need to use access_token header instead of query param by
         #  July!
         ret = github_client.get_user().create_gist(
@@ -392,12 +471,13 @@ def post_results_to_gist(db, results) -> Optional[github.Gist.Gist]:
 
 
 def process_results(result_payload: Box,
-                    db: DB) -> Tuple[Error, Box, Box, Optional[str], bool]:
+                    db: DB) -> Tuple[Error, Box, Optional[EvalData],
+                                     Optional[str], bool]:
     eval_key = result_payload.get('eval_key', '')
     results = result_payload.get('results', Box())
     results.finished = time.time()
     error = Error()
-    eval_data = Box()
+    eval_data = None
     gist = None
     should_skip = False
     # Note that 200, 400, and 500 are the ONLY expected status codes.
@@ -441,7 +521,7 @@ def process_results(result_payload: Box,
     return error, results, eval_data, gist, should_skip
 
 
-def add_eval_data_to_results(eval_data: Box, results: Box):
+def add_eval_data_to_results(eval_data: EvalData, results: Box):
     results.username = eval_data.username
     results.botname = eval_data.botname
     results.problem = eval_data.problem_id
@@ -449,7 +529,7 @@ def add_eval_data_to_results(eval_data: Box, results: Box):
     results.league_commit_sha = eval_data.league_commit_sha
     results.source_commit = eval_data.source_commit
     results.seed = eval_data.seed
-    if 'reason' in eval_data:
+    if eval_data.reason is not None:
         results.reason = eval_data.reason
     results.utc_timestamp = time.time()
 
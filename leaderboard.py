@@ -0,0 +1,156 @@
+import math
+import threading
+import time
+from typing import Dict, Optional, Set, Tuple
+
+import requests
+from box import Box, BoxList
+
+import constants
+from logs import log
+
+LEADERBOARD_SOURCE_AGGREGATED_RESULTS = 'aggregated_results'
+LEADERBOARD_SOURCE_BOT_SCORES = 'bot_scores'
+
+
+class LeaderboardCache:
+    """
+    Cache of botleague.io aggregated_results.json snapshots keyed by problem
+    id.
+
+    Fresh entries are served from memory. Stale ones are served while being
+    revalidated in the background with If-None-Match / If-Modified-Since, and
+    once they're too old to serve we revalidate inline, falling back to the
+    stale copy if botleague.io is unreachable.
+    """
+    base_url: str
+    entries: Dict[str, Box]
+
+    def __init__(self, base_url=constants.LEADERBOARD_DATA_URL,
+                 ttl=constants.LEADERBOARD_CACHE_TTL,
+                 max_stale=constants.LEADERBOARD_CACHE_MAX_STALE,
+                 timeout=constants.LEADERBOARD_REQUEST_TIMEOUT):
+        self.base_url = base_url
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.timeout = timeout
+        self.entries = {}
+        self._lock = threading.Lock()
+        self._revalidating = set()
+
+    def get(self, problem_id: str) -> Box:
+        """:return: aggregated_results for the problem"""
+        entry = self.entries.get(problem_id)
+        if entry is not None:
+            age = time.time() - entry.fetched_at
+            if age < self.ttl:
+                return entry.data
+            elif age < self.max_stale:
+                self._revalidate_async(problem_id)
+                return entry.data
+        try:
+            return self.revalidate(problem_id).data
+        except requests.RequestException:
+            if entry is None:
+                raise
+            log.warning(f'Could not revalidate leaderboard for '
+                        f'{problem_id}, using snapshot from '
+                        f'{time.time() - entry.fetched_at:.0f}s ago')
+            return entry.data
+
+    def revalidate(self, problem_id: str) -> Box:
+        entry = self.entries.get(problem_id)
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+        resp = requests.get(
+            f'{self.base_url}/problems/{problem_id}/aggregated_results.json',
+            headers=headers, timeout=self.timeout)
+        if resp.status_code == 304 and entry is not None:
+            entry = Box(entry, fetched_at=time.time())
+        else:
+            resp.raise_for_status()
+            entry = Box(data=Box(resp.json()),
+                        etag=resp.headers.get('ETag'),
+                        last_modified=resp.headers.get('Last-Modified'),
+                        fetched_at=time.time())
+        with self._lock:
+            self.entries[problem_id] = entry
+        return entry
+
+    def set(self, problem_id: str, data: Box):
+        """Serve data as a fresh snapshot without fetching it"""
+        with self._lock:
+            self.entries[problem_id] = Box(data=Box(data), etag=None,
+                                           last_modified=None,
+                                           fetched_at=time.time())
+
+    def _revalidate_async(self, problem_id: str):
+        with self._lock:
+            if problem_id in self._revalidating:
+                return
+            self._revalidating.add(problem_id)
+
+        def revalidate():
+            try:
+                self.revalidate(problem_id)
+            except requests.RequestException:
+                log.warning(f'Background leaderboard revalidation failed '
+                            f'for {problem_id}')
+            finally:
+                with self._lock:
+                    self._revalidating.discard(problem_id)
+
+        threading.Thread(target=revalidate, daemon=True).start()
+
+
+def get_top_bots_from_bot_scores(problem_id: str, num: int) -> BoxList:
+    """
+    Rank bots by mean score in the bot scores collection, i.e. what
+    aggregated_results is generated from, without going through botleague.io
+    """
+    from botleague_helpers.utils import get_bot_scores_db
+    bot_scores = [s for s in get_bot_scores_db().where(
+                      'problem_id', '==', problem_id)
+                  if s.mean is not None and not math.isnan(s.mean)]
+    bot_scores.sort(key=lambda s: s.mean, reverse=True)
+    ret = BoxList(Box(problem=problem_id, username=s.username,
+                      botname=s.botname, score=s.mean)
+                  for s in bot_scores[:num])
+    return ret
+
+
+def get_top_bots(problem_id: str,
+                 num: int = constants.PROBLEM_CI_NUM_TOP_BOTS,
+                 source: str = constants.LEADERBOARD_SOURCE) -> \
+        Set[Tuple[str, str, str]]:
+    """:return: {(problem_id, username, botname), ...} of the leaders"""
+    if source == LEADERBOARD_SOURCE_BOT_SCORES:
+        leaders = get_top_bots_from_bot_scores(problem_id, num)
+    else:
+        try:
+            leaders = get_leaderboard_cache().get(problem_id).bots[:num]
+        except requests.RequestException:
+            log.warning(f'Could not get leaderboard for {problem_id}, '
+                        f'ranking from bot scores')
+            leaders = get_top_bots_from_bot_scores(problem_id, num)
+    ret = {(b.problem, b.username, b.botname) for b in leaders}
+    return ret
+
+
+_leaderboard_cache: Optional[LeaderboardCache] = None
+
+
+def get_leaderboard_cache() -> LeaderboardCache:
+    global _leaderboard_cache
+    if _leaderboard_cache is None:
+        _leaderboard_cache = LeaderboardCache()
+    return _leaderboard_cache
+
+
+def set_leaderboard_cache(cache: LeaderboardCache):
+    global _leaderboard_cache
+    _leaderboard_cache = cache
@@ -1,4 +1,241 @@
+import atexit
+import copy
+import json
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Optional, Tuple
+
 from loguru import logger as log
-from botleague_helpers.logs import add_slack_error_sink
 
-add_slack_error_sink(log, '#deepdrive-alerts', log_name='Botleague Liaison')
+import constants
+from metrics import counter
+
+# Separate logger that only the Slack sender thread logs to, copied before
+# any handlers are added as loguru can't copy them
+log.remove()
+_slack_log = copy.deepcopy(log)
+log.add(sys.stderr)
+
+
+class LazyJson:
+    """See as_json"""
+    __slots__ = ('obj', 'omit')
+
+    def __init__(self, obj, omit=()):
+        self.obj = obj
+        self.omit = omit
+
+    def __str__(self):
+        obj = summarize(self.obj)
+        if self.omit and isinstance(obj, dict):
+            obj = {k: v for k, v in obj.items() if k not in self.omit}
+        return json.dumps(obj, default=str, separators=(',', ':'))
+
+
+def as_json(obj, omit=()) -> LazyJson:
+    """
+    Log an object as compact JSON, summarized to a bounded size. Nothing is
+    serialized unless a handler formats the message, so
+        log.trace('PR event {}', as_json(pr_event))
+    costs next to nothing when trace is off. Pass it as a format argument,
+    not inside an f-string, which would serialize it right away.
+
+    :param omit: Top level keys to leave out
+    """
+    return LazyJson(obj, omit)
+
+
+def summarize(value: Any) -> Any:
+    """
+    Copy value with long strings truncated, long lists cut short and fields
+    in FIELD_SUMMARIZERS, like embedded PR events, summarized. Models like
+    EvalData are summarized as their to_dict().
+    """
+    if isinstance(value, dict):
+        ret = {}
+        for key, item in value.items():
+            summarizer = FIELD_SUMMARIZERS.get(key)
+            ret[key] = summarizer(item) if summarizer else summarize(item)
+        return ret
+    if isinstance(value, (list, tuple)):
+        ret = [summarize(item)
+               for item in value[:constants.LOG_MAX_LIST_ITEMS]]
+        if len(value) > constants.LOG_MAX_LIST_ITEMS:
+            ret.append(f'...{len(value) - constants.LOG_MAX_LIST_ITEMS} '
+                       f'more')
+        return ret
+    if isinstance(value, str):
+        return truncate(value, constants.LOG_MAX_STRING_CHARS)
+    if hasattr(value, '__slots__') and hasattr(value, 'to_dict'):
+        return summarize(value.to_dict())
+    return value
+
+
+def truncate(text: str, max_chars: int) -> str:
+    if len(text) <= max_chars:
+        return text
+    return f'{text[:max_chars]}...({len(text)} chars)'
+
+
+def summarize_pr_event(pr_event) -> Any:
+    """Just enough of a GitHub pull_request event to find the PR"""
+    if not isinstance(pr_event, dict):
+        return summarize(pr_event)
+    pull_request = pr_event.get('pull_request') or {}
+    head = pull_request.get('head') or {}
+    base = pull_request.get('base') or {}
+    return dict(action=pr_event.get('action'),
+                number=pull_request.get('number'),
+                head_repo=(head.get('repo') or {}).get('full_name'),
+                head_sha=head.get('sha'),
+                base_repo=(base.get('repo') or {}).get('full_name'),
+                user=(pull_request.get('user') or {}).get('login'))
+
+
+def summarize_results_logs(logs) -> Any:
+    if not isinstance(logs, dict):
+        return summarize(logs)
+    return {name: truncate(str(text), constants.LOG_MAX_RESULTS_LOG_CHARS)
+            for name, text in logs.items()}
+
+
+FIELD_SUMMARIZERS = dict(pr_event=summarize_pr_event,
+                         logs=summarize_results_logs)
+
+
+SLACK_ALERTS = counter('liaison_slack_alerts_total',
+                       'Error logs shipped to Slack by outcome', ['outcome'])
+
+ALERT_SENT = 'sent'
+ALERT_COALESCED = 'coalesced'
+ALERT_DROPPED_QUEUE_FULL = 'dropped_queue_full'
+ALERT_DROPPED_RATE_LIMITED = 'dropped_rate_limited'
+ALERT_FAILED = 'failed'
+
+
+class SlackAlertShipper:
+    """
+    Loguru sink that ships errors to Slack from a background thread, so
+    logging an error never waits on Slack.
+
+    The same error logged from the same call site within coalesce_window is
+    sent once, followed by a count of the repeats when the window closes, so
+    a burst of retries against a failing endpoint makes one alert rather than
+    hundreds. Different errors are sent separately, even from the same call
+    site. Sends beyond max_per_minute, and errors logged while the queue is
+    full, are dropped and counted in SLACK_ALERTS.
+    """
+    def __init__(self, send: Callable[[str], None],
+                 queue_size=constants.SLACK_ALERT_QUEUE_SIZE,
+                 flush_interval=constants.SLACK_ALERT_FLUSH_INTERVAL,
+                 coalesce_window=constants.SLACK_ALERT_COALESCE_WINDOW,
+                 max_per_minute=constants.SLACK_ALERTS_PER_MINUTE):
+        self.send = send
+        self.flush_interval = flush_interval
+        self.coalesce_window = coalesce_window
+        self.max_per_minute = max_per_minute
+        self.queue = queue.Queue(maxsize=queue_size)
+        # (name, function, line, message) -> [window start, first text,
+        # repeats]
+        self.windows: Dict[Tuple, list] = {}
+        self._sent_times = deque()
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+
+    def sink(self, message):
+        record = message.record
+        key = (record['name'], record['function'], record['line'],
+               record['message'])
+        try:
+            self.queue.put_nowait((key, str(message).rstrip('\n')))
+        except queue.Full:
+            SLACK_ALERTS.inc(outcome=ALERT_DROPPED_QUEUE_FULL)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='slack-alerts')
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self.flush(final=True)
+
+    def flush(self, now: float = None, final=False):
+        """Send what's queued and close expired coalescing windows"""
+        now = time.time() if now is None else now
+        while True:
+            try:
+                key, text = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            window = self.windows.get(key)
+            if window is not None and now - window[0] < self.coalesce_window:
+                window[2] += 1
+                SLACK_ALERTS.inc(outcome=ALERT_COALESCED)
+                continue
+            if window is not None:
+                self._send_repeats(window)
+            self.windows[key] = [now, text, 0]
+            self._send(text, now)
+        for key, window in list(self.windows.items()):
+            if final or now - window[0] >= self.coalesce_window:
+                self._send_repeats(window, now)
+                del self.windows[key]
+
+    def _send_repeats(self, window: list, now: float = None):
+        start, text, repeats = window
+        if repeats:
+            self._send(f'Repeated {repeats} more times in '
+                       f'{self.coalesce_window}s: {text}', now)
+
+    def _send(self, text: str, now: float = None):
+        now = time.time() if now is None else now
+        while self._sent_times and now - self._sent_times[0] >= 60:
+            self._sent_times.popleft()
+        if len(self._sent_times) >= self.max_per_minute:
+            SLACK_ALERTS.inc(outcome=ALERT_DROPPED_RATE_LIMITED)
+            return
+        self._sent_times.append(now)
+        try:
+            self.send(text)
+        except Exception:
+            # Not an error, which would be shipped right back here
+            log.opt(exception=True).warning('Could not send Slack alert')
+            SLACK_ALERTS.inc(outcome=ALERT_FAILED)
+        else:
+            SLACK_ALERTS.inc(outcome=ALERT_SENT)
+
+    def _run(self):
+        while not self._stopping.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                log.opt(exception=True).warning('Slack alert flush failed')
+
+
+_slack_shipper: Optional[SlackAlertShipper] = None
+_slack_sink_lock = threading.Lock()
+
+
+def add_slack_sink():
+    """Alert errors to Slack. Not done on import to keep cold starts fast."""
+    global _slack_shipper
+    with _slack_sink_lock:
+        if _slack_shipper is not None:
+            return
+        from botleague_helpers.logs import add_slack_error_sink
+        # Posts synchronously, but only ever from the shipper's thread
+        add_slack_error_sink(_slack_log, '#deepdrive-alerts',
+                             log_name='Botleague Liaison')
+        _slack_shipper = SlackAlertShipper(send=_slack_log.error)
+        _slack_shipper.start()
+        # Send what's left and the repeat counts on shutdown
+        atexit.register(_slack_shipper.stop,
+                        timeout=constants.SLACK_ALERT_FLUSH_INTERVAL)
+        log.add(_slack_shipper.sink, level='ERROR',
+                format='{name}:{function}:{line} - {message}')
@@ -1,31 +1,41 @@
 from __future__ import print_function
 
 import os
+import threading
 import time
-from wsgiref.simple_server import make_server
 
 from botleague_helpers.config import blconfig
 from box import Box
-from logs import log
+from logs import as_json, log
 
+import constants
+from config_cache import get_secret
 from constants import ON_GAE
 from handlers.confirm_handler import handle_confirm_request
 
 from pyramid.config import Configurator
+from pyramid.tweens import INGRESS
 
 from pyramid.response import Response
-import github
-from github import Github
 
+from handlers.metrics_handler import handle_metrics_request
 from handlers.problem_ci_status_handler import handle_problem_ci_status_request
 from handlers.results_handler import handle_results_request
-from handlers import github_handler
-
-try:
-  import googleclouddebugger
-  googleclouddebugger.enable()
-except ImportError:
-  pass
+from handlers.github_handler import PayloadView
+from logs import add_slack_sink
+from metrics import count_responses, counter
+
+if constants.ENABLE_CLOUD_DEBUGGER:
+    try:
+      import googleclouddebugger
+      googleclouddebugger.enable()
+    except ImportError:
+      pass
+
+EVAL_CALLBACKS = counter('liaison_eval_callbacks_total',
+                         'Confirm and results requests by HTTP status and '
+                         'outcome, i.e. ok, error or exception',
+                         ['route', 'status', 'outcome'])
 
 # TODO(Challenges): Allow private docker and github repos that grant access to
 #  special botleague user. Related: https://docs.google.com/document/d/1IOMMtfEVaPWFPg8pEqPOPbLO__bs9_SCmA8_GbfGBTU/edit#
@@ -39,16 +49,17 @@ def diagnostics(request):
         return Response('Not token found')
 
 
+@count_responses(EVAL_CALLBACKS, route='results')
 def handle_results(request):
     final_results, error, gist = handle_results_request(request)
     resp_box = Box(results=final_results, error=error, gist=gist)
     resp = Response(json=resp_box.to_dict())
     if error:
         resp.status_code = error.http_status_code
-        log.error(f'Error handling results {error} - results:'
-                           f' {resp_box.to_json(indent=2)}')
+        log.error('Error handling results {} - results: {}', error,
+                  as_json(resp_box))
     else:
-        log.info(f'Results response {resp_box.to_json(indent=2)}')
+        log.info('Results response {}', as_json(resp_box))
     return resp
 
 
@@ -66,6 +77,7 @@ def handle_test_error(request):
     log.error('Testing error handling')
 
 
+@count_responses(EVAL_CALLBACKS, route='confirm')
 def handle_confirm(request):
     start = time.time()
     body, error = handle_confirm_request(request)
@@ -76,6 +88,12 @@ def handle_confirm(request):
     return resp
 
 
+def handle_metrics(request):
+    return Response(handle_metrics_request(request),
+                    content_type='text/plain; version=0.0.4',
+                    charset='utf-8')
+
+
 def handle_root(request):
     return Response(f'Botleague liaison service<br>'
                     f'https://github.com/botleague/botleague-liaison<br>')
@@ -120,6 +138,10 @@ with Configurator() as config:
     config.add_view(view=handle_results, route_name='results', renderer='json',
                     request_method='POST')
 
+    config.add_route(name='metrics', pattern='/metrics')
+    config.add_view(view=handle_metrics, route_name='metrics',
+                    request_method='GET')
+
     config.add_route(name='problem_ci_status', pattern='/problem_ci_status')
     config.add_view(view=handle_problem_ci_status,
                     route_name='problem_ci_status', renderer='json',
@@ -130,18 +152,39 @@ with Configurator() as config:
     #                 route_name='test_error', renderer='json',
     #                 request_method=('GET', 'POST'))
 
-    config.add_route(name='github_payload', pattern='/github_payload')
-    # The view for the Github payload route is added via class annotation
-
-    config.scan(github_handler)
+    config.add_route(name='github_payload',
+                     pattern=constants.GITHUB_WEBHOOK_PATH)
+    # Added here rather than scanned from view_config decorators, which
+    # inspect the call stack, taking hundreds of ms once many modules are
+    # loaded
+    config.add_view(view=PayloadView, attr='payload_event',
+                    route_name='github_payload', renderer='json',
+                    request_method='POST')
+    config.add_tween('webhook_verify.verify_webhook_tween_factory')
+    # Outermost, so request timing includes webhook verification
+    config.add_tween('tracing.tracing_tween_factory', under=INGRESS)
     app = config.make_wsgi_app()
 
-if ON_GAE or __name__ == '__main__':
-    # Load github token into memory so that requests don't need to do this.
+
+def warm_up():
+    """
+    Load the github token and webhook secret into memory so that requests
+    don't need to do this, and start alerting errors to Slack. Once per
+    process, after any fork.
+    """
+    add_slack_sink()
     _tok_ = blconfig.github_token
+    if not blconfig.is_test:
+        get_secret(constants.GITHUB_WEBHOOK_SECRET_NAME)
+
+
+if ON_GAE:
+    # In the background so cold starts can serve requests that need neither,
+    # i.e. confirms, right away. Any that do will load what they need.
+    threading.Thread(target=log.catch(warm_up), daemon=True,
+                     name='warm-up').start()
 
 if __name__ == '__main__':
     # TODO: Standardize on Pyramid or Flask with problem-endpoint
-    server = make_server("0.0.0.0", 8888, app)
-    log.success('Serving http://0.0.0.0:8888')
-    server.serve_forever()
+    from serve import serve
+    serve(app, warm_up)
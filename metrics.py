@@ -0,0 +1,208 @@
+"""
+Process-local metrics. Each App Engine instance / worker keeps its own.
+"""
+import bisect
+import functools
+import threading
+from typing import Dict, Tuple, Union, List
+
+
+class Counter:
+    name: str
+    description: str
+    label_names: Tuple[str, ...]
+    values: Dict[Tuple[str, ...], float]
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+
+# Seconds, from a fast Firestore read up to a slow problem endpoint
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set"""
+    name: str
+    description: str
+    label_names: Tuple[str, ...]
+    buckets: Tuple[float, ...]
+    values: Dict[Tuple[str, ...], dict]
+
+    def __init__(self, name, description, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self.values:
+                self.values[key] = dict(
+                    bucket_counts=[0] * len(self.buckets), sum=0, count=0)
+            entry = self.values[key]
+            # Counts are per bucket here and made cumulative on export
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                entry['bucket_counts'][i] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def get_count(self, **labels) -> int:
+        entry = self.values.get(self._key(labels))
+        return entry['count'] if entry else 0
+
+    def get_cumulative(self, **labels) -> List[int]:
+        entry = self.values.get(self._key(labels))
+        ret = []
+        total = 0
+        for count in entry['bucket_counts'] if entry else \
+                [0] * len(self.buckets):
+            total += count
+            ret.append(total)
+        return ret
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+
+class Gauge:
+    """Last set value per label set, e.g. refreshed when metrics are read"""
+    name: str
+    description: str
+    label_names: Tuple[str, ...]
+    values: Dict[Tuple[str, ...], float]
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels))
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, '')) for n in self.label_names)
+
+
+REGISTRY: Dict[str, Union[Counter, Histogram, Gauge]] = {}
+_registry_lock = threading.Lock()
+
+
+def counter(name, description, label_names=()) -> Counter:
+    """Get or create the counter with this name"""
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Counter(name, description, label_names)
+        return REGISTRY[name]
+
+
+def gauge(name, description, label_names=()) -> Gauge:
+    """Get or create the gauge with this name"""
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Gauge(name, description, label_names)
+        return REGISTRY[name]
+
+
+def histogram(name, description, label_names=(),
+              buckets=DEFAULT_BUCKETS) -> Histogram:
+    """Get or create the histogram with this name"""
+    with _registry_lock:
+        if name not in REGISTRY:
+            REGISTRY[name] = Histogram(name, description, label_names,
+                                       buckets)
+        return REGISTRY[name]
+
+
+OUTCOME_OK = 'ok'
+OUTCOME_ERROR = 'error'
+OUTCOME_EXCEPTION = 'exception'
+
+
+def count_responses(metric: Counter, **labels):
+    """
+    Decorate a view to count its responses in metric by status and outcome,
+    including those that raise, which are counted as a 500 exception
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            status, outcome = 500, OUTCOME_EXCEPTION
+            try:
+                response = view(*args, **kwargs)
+                status = response.status_code
+                outcome = OUTCOME_OK if status < 400 else OUTCOME_ERROR
+                return response
+            finally:
+                metric.inc(status=status, outcome=outcome, **labels)
+        return wrapper
+    return decorator
+
+
+def render_prometheus() -> str:
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for name, metric in sorted(REGISTRY.items()):
+        lines.append(f'# HELP {name} {metric.description}')
+        if isinstance(metric, Histogram):
+            lines.append(f'# TYPE {name} histogram')
+            for key, entry in sorted(metric.values.items()):
+                labels = dict(zip(metric.label_names, key))
+                cumulative = metric.get_cumulative(**labels)
+                for bound, count in zip(metric.buckets, cumulative):
+                    lines.append(f'{name}_bucket'
+                                 f'{_format_labels(labels, le=bound)} '
+                                 f'{count}')
+                lines.append(f'{name}_bucket'
+                             f'{_format_labels(labels, le="+Inf")} '
+                             f'{entry["count"]}')
+                lines.append(f'{name}_sum{_format_labels(labels)} '
+                             f'{entry["sum"]}')
+                lines.append(f'{name}_count{_format_labels(labels)} '
+                             f'{entry["count"]}')
+        else:
+            kind = 'counter' if isinstance(metric, Counter) else 'gauge'
+            lines.append(f'# TYPE {name} {kind}')
+            for key, value in sorted(metric.values.items()):
+                if value is None:
+                    continue
+                labels = dict(zip(metric.label_names, key))
+                lines.append(f'{name}{_format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels: dict, **extra) -> str:
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    pairs = []
+    for k, v in labels.items():
+        v = str(v).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+        pairs.append(f'{k}="{v}"')
+    return '{' + ','.join(pairs) + '}'
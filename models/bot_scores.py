@@ -0,0 +1,199 @@
+import base64
+import hashlib
+import math
+from typing import List
+
+from box import Box, BoxList
+
+import constants
+
+
+class QuantileSketch:
+    """
+    Mergeable, size-bounded quantile sketch in the style of a t-digest.
+
+    Values are kept as (mean, weight) centroids, stored as a list of dicts as
+    Firestore doesn't allow nested arrays. Until there are more than
+    max_centroids values every centroid is a single value, so quantiles are
+    exact, e.g. the median matches statistics.median. Beyond that the closest
+    adjacent centroids with the least weight are merged.
+    """
+    centroids: List[List[float]]
+
+    def __init__(self, centroids: List[dict] = None,
+                 max_centroids=constants.BOT_SCORES_SKETCH_SIZE):
+        self.centroids = sorted([c['mean'], c['weight']]
+                                for c in centroids or [])
+        self.max_centroids = max_centroids
+
+    def add(self, value: float, weight: float = 1):
+        if math.isnan(value):
+            return
+        self._insert([value, weight])
+        self._compress()
+
+    def merge(self, other: 'QuantileSketch'):
+        for centroid in other.centroids:
+            self._insert(list(centroid))
+        self._compress()
+
+    def quantile(self, q: float) -> float:
+        if not self.centroids:
+            return None
+        total = sum(w for _, w in self.centroids)
+        target = q * total
+        # Position each centroid at the middle of the weight it covers
+        cumulative = 0
+        prev_pos, prev_mean = None, None
+        for mean, weight in self.centroids:
+            pos = cumulative + weight / 2
+            if target <= pos:
+                if prev_pos is None:
+                    return mean
+                frac = (target - prev_pos) / (pos - prev_pos)
+                return prev_mean + frac * (mean - prev_mean)
+            prev_pos, prev_mean = pos, mean
+            cumulative += weight
+        return self.centroids[-1][0]
+
+    def to_list(self) -> List[dict]:
+        return [dict(mean=m, weight=w) for m, w in self.centroids]
+
+    def _insert(self, centroid):
+        # Keep sorted, centroids are few so a linear scan is fine
+        for i, existing in enumerate(self.centroids):
+            if centroid[0] < existing[0]:
+                self.centroids.insert(i, centroid)
+                return
+        self.centroids.append(centroid)
+
+    def _compress(self):
+        while len(self.centroids) > self.max_centroids:
+            # Merge the adjacent pair with the least combined weight, breaking
+            # ties by the smallest gap between them
+            i = min(range(len(self.centroids) - 1),
+                    key=lambda j: (self.centroids[j][1] +
+                                   self.centroids[j + 1][1],
+                                   self.centroids[j + 1][0] -
+                                   self.centroids[j][0]))
+            (m1, w1), (m2, w2) = self.centroids[i], self.centroids[i + 1]
+            weight = w1 + w2
+            self.centroids[i:i + 2] = [[(m1 * w1 + m2 * w2) / weight, weight]]
+
+
+class EvalKeyFilter:
+    """
+    Fixed-size Bloom filter of the eval_keys a bot's scores were counted
+    from, so redelivered results are never counted twice however old they
+    are, without storing every eval_key.
+
+    Stored base64 encoded. False positives, i.e. a new score taken as
+    already counted, are about one in a million at 3000 evals per bot with
+    the default size.
+    """
+    bits: bytearray
+
+    def __init__(self, encoded: str = None,
+                 num_bits=constants.BOT_SCORES_KEY_FILTER_BITS,
+                 num_hashes=constants.BOT_SCORES_KEY_FILTER_HASHES):
+        if encoded:
+            self.bits = bytearray(base64.b64decode(encoded))
+        else:
+            self.bits = bytearray(num_bits // 8)
+        self.num_hashes = num_hashes
+
+    def add(self, eval_key: str):
+        for pos in self._positions(eval_key):
+            self.bits[pos // 8] |= 1 << (pos % 8)
+
+    def __contains__(self, eval_key: str) -> bool:
+        return all(self.bits[pos // 8] & (1 << (pos % 8))
+                   for pos in self._positions(eval_key))
+
+    def to_str(self) -> str:
+        return base64.b64encode(bytes(self.bits)).decode()
+
+    def _positions(self, eval_key: str):
+        # Double hashing, see Kirsch and Mitzenmacher
+        digest = hashlib.sha256(eval_key.encode()).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:16], 'little') | 1
+        num_bits = len(self.bits) * 8
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+
+def is_score_recorded(bot_scores: Box, eval_key: str) -> bool:
+    if any(s.eval_key == eval_key for s in bot_scores.scores or []):
+        return True
+    if bot_scores.get('eval_key_filter'):
+        return eval_key in EvalKeyFilter(bot_scores.eval_key_filter)
+    # Documents from before the filter list every eval_key
+    return eval_key in (bot_scores.get('eval_keys') or [])
+
+
+def get_score_count(bot_scores: Box) -> int:
+    if 'count' in bot_scores:
+        return bot_scores.count
+    return len(bot_scores.scores or [])
+
+
+def add_score(bot_scores: Box, new_score: Box) -> bool:
+    """
+    Update the running aggregates of bot_scores in place without revisiting
+    past scores.
+
+    Mean and variance use Welford's algorithm, the median comes from a
+    QuantileSketch, and only the most recent scores are kept so the document
+    stays bounded. Counted eval_keys are kept in an EvalKeyFilter.
+
+    :return: False if the score's eval_key was already recorded
+    """
+    if 'count' not in bot_scores:
+        migrate_bot_scores(bot_scores)
+    if is_score_recorded(bot_scores, new_score.eval_key):
+        return False
+    if bot_scores.get('eval_key_filter'):
+        key_filter = EvalKeyFilter(bot_scores.eval_key_filter)
+    else:
+        key_filter = EvalKeyFilter()
+        # Every eval_key used to be listed, which grew without bound
+        for eval_key in bot_scores.pop('eval_keys', None) or []:
+            key_filter.add(eval_key)
+        for score in bot_scores.scores or []:
+            key_filter.add(score.eval_key)
+    key_filter.add(new_score.eval_key)
+    bot_scores.eval_key_filter = key_filter.to_str()
+
+    score = new_score.score
+    bot_scores.count += 1
+    delta = score - bot_scores.mean
+    bot_scores.mean += delta / bot_scores.count
+    bot_scores.m2 += delta * (score - bot_scores.mean)
+    if bot_scores.count < 2:
+        bot_scores.stdev = None
+    else:
+        bot_scores.stdev = math.sqrt(bot_scores.m2 / (bot_scores.count - 1))
+    if not math.isnan(score):
+        bot_scores.min = score if bot_scores.min is None else \
+            min(bot_scores.min, score)
+        bot_scores.max = score if bot_scores.max is None else \
+            max(bot_scores.max, score)
+    sketch = QuantileSketch(bot_scores.quantile_sketch)
+    sketch.add(score)
+    bot_scores.quantile_sketch = sketch.to_list()
+    bot_scores.median = sketch.quantile(0.5)
+
+    bot_scores.scores = BoxList(
+        list(bot_scores.scores) +
+        [new_score])[-constants.BOT_SCORES_NUM_RECENT:]
+    return True
+
+
+def migrate_bot_scores(bot_scores: Box):
+    """Build running aggregates for documents that only have a scores list"""
+    scores = list(bot_scores.scores or [])
+    bot_scores.update(count=0, mean=0.0, m2=0.0, stdev=None, min=None,
+                      max=None, median=None, quantile_sketch=[],
+                      scores=BoxList())
+    for score in scores:
+        add_score(bot_scores, Box(score))
@@ -1,3 +1,6 @@
+import json
+from typing import Optional
+
 from botleague_helpers.db import DB
 from box import Box
 from botleague_helpers.utils import get_eval_db_key
@@ -6,17 +9,139 @@ from botleague_helpers.utils import get_eval_db_key
 INVALID_DB_KEY_STATE_MESSAGE = 'Eval key in eval data were different. ' \
                                'Database in invalid state.'
 
+# Sent to problem endpoints to start an eval, the rest is for the liaison
+EVAL_REQUEST_FIELDS = ('eval_key', 'eval_id', 'docker_tag', 'seed',
+                       'problem_id', 'problem_def', 'botname', 'username',
+                       'status', 'started', 'league_commit_sha',
+                       'botleague_liaison_host', 'reason', 'is_release',
+                       'source_commit', 'pull_request')
+
+
+class PullRequestRef:
+    """
+    The parts of the league pull request an eval needs to report back to it.
+    The full GitHub event is not stored, it's tens of KB per eval.
+    """
+    __slots__ = ('url', 'number', 'updated_at', 'merge_commit_sha',
+                 'head_commit', 'head_full_name', 'base_commit',
+                 'base_full_name', 'draft', 'extra')
+
+    # Fields we don't model, kept so saving doesn't erase them
+    extra: dict
+
+    def __init__(self, url=None, number=None, updated_at=None,
+                 merge_commit_sha=None, head_commit=None, head_full_name=None,
+                 base_commit=None, base_full_name=None, draft=None, **extra):
+        self.url = url
+        self.number = number
+        self.updated_at = updated_at
+        self.merge_commit_sha = merge_commit_sha
+        self.head_commit = head_commit
+        self.head_full_name = head_full_name
+        self.base_commit = base_commit
+        self.base_full_name = base_full_name
+        self.draft = draft
+        self.extra = extra
+
+    @classmethod
+    def from_github(cls, pull_request: Box) -> 'PullRequestRef':
+        """:param pull_request: The pull_request of a GitHub PR event"""
+        return cls(url=pull_request.url,
+                   number=pull_request.number,
+                   updated_at=pull_request.updated_at,
+                   merge_commit_sha=pull_request.merge_commit_sha,
+                   head_commit=pull_request.head.sha,
+                   head_full_name=pull_request.head.repo.full_name,
+                   base_commit=pull_request.base.sha,
+                   base_full_name=pull_request.base.repo.full_name,
+                   draft=pull_request.draft)
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'PullRequestRef':
+        # Older evals also stored the whole event as pr_event, drop it
+        return cls(**{k: v for k, v in data.items() if k != 'pr_event'})
+
+    def to_dict(self) -> dict:
+        ret = dict(self.extra)
+        for name in self.__slots__[:-1]:
+            ret[name] = getattr(self, name)
+        return ret
+
+
+class EvalData:
+    """
+    An eval as stored in the liaison db, keyed by its secret eval_key.
+    problem_def and results keep the shape their authors gave them, so they
+    stay Boxes.
+    """
+    __slots__ = ('eval_key', 'eval_id', 'docker_tag', 'seed', 'problem_id',
+                 'problem_def', 'botname', 'username', 'status', 'started',
+                 'started_at', 'league_commit_sha', 'botleague_liaison_host',
+                 'reason', 'is_release', 'source_commit', 'pull_request',
+                 'gist', 'error', 'results', 'results_at', 'extra')
+
+    eval_key: str
+    pull_request: Optional[PullRequestRef]
+    problem_def: Optional[Box]
+    results: Optional[Box]
+
+    # Fields we don't model, e.g. added by other writers, kept so saving
+    # doesn't erase them
+    extra: dict
+
+    def __init__(self, **fields):
+        for name in self.__slots__[:-1]:
+            setattr(self, name, fields.pop(name, None))
+        self.extra = fields
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'EvalData':
+        ret = cls(**data)
+        if ret.pull_request is not None:
+            ret.pull_request = PullRequestRef.from_dict(ret.pull_request)
+        for name in ('problem_def', 'results'):
+            value = getattr(ret, name)
+            if isinstance(value, dict) and not isinstance(value, Box):
+                setattr(ret, name, Box(value))
+        return ret
+
+    def to_dict(self) -> Box:
+        """Fields that are set, as stored. A Box, like values read back."""
+        ret = Box(self.extra)
+        for name in self.__slots__[:-1]:
+            value = getattr(self, name)
+            if value is not None:
+                ret[name] = value
+        if self.pull_request is not None:
+            ret.pull_request = self.pull_request.to_dict()
+        return ret
+
+    def to_request_body(self) -> bytes:
+        """JSON to POST to the problem endpoint, encoded in one pass"""
+        body = {}
+        for name in EVAL_REQUEST_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                body[name] = value
+        if self.pull_request is not None:
+            body['pull_request'] = self.pull_request.to_dict()
+        return json.dumps(body, default=str, sort_keys=True,
+                          separators=(',', ':')).encode()
+
 
-def get_eval_data(eval_key, db: DB) -> Box:
+def get_eval_data(eval_key, db: DB) -> Optional[EvalData]:
     db_key = get_eval_db_key(eval_key)
     # eval_key is secret, do not make public anywhere!
-    eval_data = Box(db.get(db_key))
-    if eval_data and eval_data.eval_key != eval_key:
+    stored = db.get(db_key)
+    if not stored:
+        return None
+    eval_data = EvalData.from_dict(stored)
+    if eval_data.eval_key != eval_key:
         raise RuntimeError(INVALID_DB_KEY_STATE_MESSAGE)
     return eval_data
 
 
-def save_eval_data(eval_data: Box, db: DB):
+def save_eval_data(eval_data: EvalData, db: DB):
     db_key = get_eval_db_key(eval_data.eval_key)
     # eval_key is secret, do not make public anywhere!
-    db.set(db_key, eval_data)
+    db.set(db_key, eval_data.to_dict())
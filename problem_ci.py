@@ -1,21 +1,21 @@
-from glob import glob
-from os.path import join
+from copy import deepcopy
 from typing import Union
 
 import github
-import requests
 from botleague_helpers.reduce import create_reduce
-from botleague_helpers.utils import box2json
 from box import Box
 from google.cloud.firestore_v1 import SERVER_TIMESTAMP
-from logs import log
+from logs import as_json, log
 
-from bot_eval import get_bot_eval, PROBLEM_CHANGED
+from bot_eval import get_bot_eval, PROBLEM_CHANGED, trigger_evals
+from bot_index import get_bot_index
+from leaderboard import get_top_bots
 from responses.pr_responses import RegenPrResponse, ErrorPrResponse, \
     ProblemCIResponse, NoBotsResponse, EvalStartedPrResponse, \
-    EvalErrorPrResponse
-from constants import BOTLEAGUE_REPO_ROOT, ONGOING_PROBLEM_CI_KEY_PREFIX
-from utils import read_box, get_liaison_db_store
+    EvalErrorPrResponse, PrResponse
+from constants import ONGOING_PROBLEM_CI_KEY_PREFIX
+from repo_mirror import get_botleague_mirror
+from utils import get_liaison_db_store
 
 
 PROBLEM_CI_STATUS_PENDING = 'pending'
@@ -43,28 +43,14 @@ def process_changed_problem(changed_problem_definitions,
         resp = ErrorPrResponse('Can only change one problem at a time')
     else:
         # This is an existing problem, we need to rerun and validate bot perf
-        prob_def = read_box(
-            join(BOTLEAGUE_REPO_ROOT, changed_problem_definitions[0]))
+        league = get_botleague_mirror()
+        base_commit = pull_request.base.sha
+        prob_def = league.read_box(changed_problem_definitions[0],
+                                   ref=base_commit)
         problem_id = '/'.join(changed_problem_definitions[0].split('/')[-3:-1])
         # For each bot that lists this problem, run an eval and collect the
         # results.
-
-        # Just get top three bots on leaderboard
-        bots_to_eval = Box()
-
-        leaders = Box(requests.get(
-            f'https://botleague.io/data/problems/{problem_id}/'
-            f'aggregated_results.json').json())
-
-        top_3 = {(b.problem, b.username, b.botname) for b in leaders.bots[:3]}
-
-        for f_name in glob(f'{BOTLEAGUE_REPO_ROOT}/bots/*/*/bot.json'):
-            bot = read_box(f_name)
-            botname = f_name.split('/')[-2]
-            bot_user = f_name.split('/')[-3]
-            if problem_id in bot.problems and \
-                    (problem_id, bot_user, botname) in top_3:
-                bots_to_eval[(bot_user, botname)] = bot
+        bots_to_eval = get_problem_ci_bots(problem_id, base_commit)
         if not bots_to_eval:
             resp = NoBotsResponse('No bots with this problem, nothing to eval')
         else:
@@ -81,6 +67,7 @@ def process_changed_problem(changed_problem_definitions,
                     id=pci_id,
                     pull_request=pull_request,
                     bot_eval_keys=[b.eval_key for b in resp.bot_evals],
+                    bot_eval_failures=resp.bot_eval_failures,
                     prob_def=prob_def,
                     botleague_liaison_host=botleague_liaison_host,
                     created_at=SERVER_TIMESTAMP,
@@ -92,6 +79,39 @@ def process_changed_problem(changed_problem_definitions,
     return resp, should_gen
 
 
+def get_bot_id(bot_user: str, botname: str) -> str:
+    """Key of a bot in a problem ci's bot_eval_failures"""
+    return f'{bot_user}/{botname}'
+
+
+def get_bot_eval_failures(problem_ci: Box) -> Box:
+    """
+    :return: 'user_or_org/botname' -> Box(error=...) for bots whose evals
+        failed to start
+    """
+    failures = problem_ci.get('bot_eval_failures') or Box()
+    if isinstance(failures, list):
+        # Problem cis started before failures were keyed by bot
+        failures = Box({get_bot_id(f['username'], f['botname']):
+                        Box(error=f['error']) for f in failures})
+    return Box(failures)
+
+
+def get_problem_ci_bots(problem_id: str, base_commit: str) -> Box:
+    """
+    Just the top bots on the leaderboard that still list the problem at
+    base_commit
+    :return: {(user_or_org, botname): bot_def}
+    """
+    ret = Box()
+    top_bots = get_top_bots(problem_id)
+    for bot_user, botname, bot in get_bot_index().get_bots_for_problem(
+            problem_id, ref=base_commit):
+        if (problem_id, bot_user, botname) in top_bots:
+            ret[(bot_user, botname)] = bot
+    return ret
+
+
 def get_problem_ci_db_id(pull_number, pull_head_commit):
     ret = f'{ONGOING_PROBLEM_CI_KEY_PREFIX}_' \
           f'PR:{pull_number}-' \
@@ -104,13 +124,12 @@ def eval_bots(base_repo, bots_with_problem, changed_filenames, changed_files,
               pull_request, botleague_liaison_host, replace_sim_url,
               container_postfix) \
         -> Union[ProblemCIResponse, EvalErrorPrResponse]:
-    bot_evals = []
-
     # Create the reduce record that we will use to fan in results with
     create_reduce(get_problem_ci_db_id(
                     pull_number=pull_request.number,
                     pull_head_commit=pull_request.head.sha[:6]))
 
+    evals = []
     for (bot_user, botname), bot in bots_with_problem.items():
         bot_eval = get_bot_eval(use_mock=from_mock)(
             botname=botname,
@@ -123,20 +142,39 @@ def eval_bots(base_repo, bots_with_problem, changed_filenames, changed_files,
             github_client=github_client,
             botleague_liaison_host=botleague_liaison_host,
             reason=PROBLEM_CHANGED)
-        trigger_resp = bot_eval.trigger_single_eval(
-            bot_def=bot, problem_def=prob_def, problem_id=problem_id,
+        evals.append((bot_eval, bot_eval.prepare_single_eval(
+            bot_def=bot, problem_def=deepcopy(prob_def), problem_id=problem_id,
             problem_ci_replace_sim_url=replace_sim_url,
-            container_postfix=container_postfix)
+            container_postfix=container_postfix)))
+
+    def on_timeout(_eval_item) -> PrResponse:
+        return EvalErrorPrResponse('Timed out triggering eval, canceled it')
+
+    trigger_responses = trigger_evals(evals, on_timeout=on_timeout)
+    bots = list(bots_with_problem.items())
+
+    # Keep whatever evals did start so they're tracked by the problem ci
+    # record instead of being orphaned by a failure on another bot.
+    bot_evals = []
+    # 'user_or_org/botname' -> Box(error=...)
+    bot_eval_failures = Box()
+    for ((bot_user, botname), _bot), trigger_resp in zip(bots,
+                                                         trigger_responses):
         if isinstance(trigger_resp, EvalStartedPrResponse):
             eval_data = trigger_resp.eval_data
             bot_evals.append(eval_data)
-            log.success(f'Triggered '
-                        f'{box2json(eval_data)}')
-        elif isinstance(trigger_resp, EvalErrorPrResponse):
+            log.success('Triggered {}', as_json(eval_data))
+        else:
             log.error(f'Could not evaluate bot {bot_user}:{botname}. '
                       f'Error: {trigger_resp.msg}')
-            return trigger_resp
+            bot_eval_failures[get_bot_id(bot_user, botname)] = Box(
+                error=trigger_resp.msg)
+    if not bot_evals:
+        return EvalErrorPrResponse(
+            f'Could not start any of {len(bots)} problem CI evals')
     ci_message = f'Triggered {len(bot_evals)} evals'
-    resp = ProblemCIResponse(ci_message, bot_evals)
+    if bot_eval_failures:
+        ci_message += f', {len(bot_eval_failures)} failed to start'
+    resp = ProblemCIResponse(ci_message, bot_evals, bot_eval_failures)
     log.success(ci_message)
     return resp
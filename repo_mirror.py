@@ -0,0 +1,191 @@
+import fcntl
+import os
+import re
+import shutil
+import tempfile
+import threading
+from typing import List, Optional, Tuple
+
+from box import Box
+
+import constants
+from logs import log
+from utils import get_str_or_box
+
+BOTLEAGUE_REPO_URL = os.environ.get('BOTLEAGUE_REPO_URL',
+                                    'https://github.com/botleague/botleague')
+
+SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+
+class RepoMirror:
+    """
+    A warm clone of a git repo that lives for the life of the instance.
+    Files are read straight out of the object store at a given ref, so we never
+    need a working tree, and we only hit the network when asked for a commit
+    we don't have yet.
+    """
+    src: str
+    dst: str
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self._repo = None
+        # dulwich pack reads seek on shared file handles, so serialize access
+        self._lock = threading.RLock()
+
+    @property
+    def repo(self):
+        with self._lock:
+            if self._repo is None:
+                self._repo = self._open_or_clone()
+            return self._repo
+
+    def _open_or_clone(self):
+        from dulwich import porcelain
+        from dulwich.repo import Repo
+        # Server workers share dst, so only one of them clones while the
+        # rest wait on the lock and then open its clone
+        with open(self.dst + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if not os.path.exists(self.dst):
+                log.info(f'Cloning {self.src} into {self.dst}')
+                # Clone aside so an interrupted clone is never opened
+                tmp_dst = tempfile.mkdtemp(
+                    dir=os.path.dirname(self.dst) or '.',
+                    prefix=os.path.basename(self.dst) + '.')
+                try:
+                    porcelain.clone(self.src, tmp_dst, bare=True,
+                                    errstream=NullStream()).close()
+                    os.rename(tmp_dst, self.dst)
+                except Exception:
+                    shutil.rmtree(tmp_dst, ignore_errors=True)
+                    raise
+        return Repo(self.dst)
+
+    def has_commit(self, sha: str) -> bool:
+        with self._lock:
+            return sha.encode() in self.repo.object_store
+
+    def fetch(self):
+        from dulwich import porcelain
+        with self._lock:
+            log.info(f'Fetching {self.src} into {self.dst}')
+            # By remote name, fetching by url doesn't update origin's refs
+            porcelain.fetch(self.repo, 'origin', errstream=NullStream())
+
+    def ensure_commit(self, sha: str) -> bool:
+        """Fetch only if we don't already have the commit"""
+        with self._lock:
+            if not self.has_commit(sha):
+                self.fetch()
+            return self.has_commit(sha)
+
+    def resolve(self, ref: str) -> bytes:
+        """
+        :param ref: Commit sha or branch name, e.g. 'master'. Branches are
+            where they were at the last fetch.
+        :return: Commit sha as bytes
+        """
+        with self._lock:
+            if SHA_RE.match(ref):
+                if not self.ensure_commit(ref):
+                    raise RuntimeError(f'Commit {ref} not found in {self.src}')
+                return ref.encode()
+            refs = self.repo.get_refs()
+            for prefix in (b'refs/remotes/origin/', b'refs/heads/'):
+                name = prefix + ref.encode()
+                if name in refs:
+                    return refs[name]
+            raise RuntimeError(f'Ref {ref} not found in {self.src}')
+
+    def read_file(self, path: str, ref: str, missing_ok=False) -> str:
+        """
+        :param path: Relative path to file in repo
+        :param missing_ok: Don't log an error if the file does not exist
+        :return: File contents or '' if the file does not exist at ref
+        """
+        from dulwich.object_store import tree_lookup_path
+        with self._lock:
+            repo = self.repo
+            tree = repo[self.resolve(ref)].tree
+            try:
+                _mode, sha = tree_lookup_path(repo.get_object, tree,
+                                              path.encode())
+            except KeyError:
+                if not missing_ok:
+                    log.error(f'Unable to find {path} at {ref} in {self.src}')
+                return ''
+            return repo[sha].data.decode('utf-8')
+
+    def read_box(self, path: str, ref: str):
+        """Same return convention as utils.get_file_from_github"""
+        return get_str_or_box(self.read_file(path, ref), path)
+
+    def list_dir(self, path: str, ref: str) -> List[str]:
+        from dulwich.object_store import tree_lookup_path
+        with self._lock:
+            repo = self.repo
+            tree = repo[self.resolve(ref)].tree
+            try:
+                _mode, sha = tree_lookup_path(repo.get_object, tree,
+                                              path.encode())
+            except KeyError:
+                return []
+            return sorted(e.path.decode() for e in repo[sha].items())
+
+    def get_changed_paths(self, old_ref: str, new_ref: str) -> List[str]:
+        """:return: Paths of files added, modified or deleted between refs"""
+        from dulwich.diff_tree import tree_changes
+        with self._lock:
+            repo = self.repo
+            old_tree = repo[self.resolve(old_ref)].tree
+            new_tree = repo[self.resolve(new_ref)].tree
+            ret = set()
+            for change in tree_changes(repo.object_store, old_tree, new_tree):
+                for entry in (change.old, change.new):
+                    # Older dulwich uses empty entries rather than None
+                    if entry is not None and entry.path is not None:
+                        ret.add(entry.path.decode())
+        return sorted(ret)
+
+    def get_bot_defs(self, ref: str) -> List[Tuple[str, str, Box]]:
+        """:return: (user_or_org, botname, bot_def) for every bot at ref"""
+        ret = []
+        with self._lock:
+            for user in self.list_dir(constants.BOTS_DIR, ref):
+                user_dir = f'{constants.BOTS_DIR}/{user}'
+                for botname in self.list_dir(user_dir, ref):
+                    path = f'{user_dir}/{botname}/' \
+                           f'{constants.BOT_DEFINITION_FILENAME}'
+                    try:
+                        bot_def = self.read_box(path, ref)
+                    except (ValueError, TypeError):
+                        # One bad bot shouldn't hide the rest of the league
+                        log.exception(f'Skipping malformed {path} at {ref}')
+                        continue
+                    if bot_def:
+                        ret.append((user, botname, bot_def))
+        return ret
+
+
+class NullStream:
+    def write(self, *_args, **_kwargs):
+        pass
+
+    def flush(self):
+        pass
+
+
+_botleague_mirror: Optional[RepoMirror] = None
+_botleague_mirror_lock = threading.Lock()
+
+
+def get_botleague_mirror() -> RepoMirror:
+    global _botleague_mirror
+    with _botleague_mirror_lock:
+        if _botleague_mirror is None:
+            _botleague_mirror = RepoMirror(BOTLEAGUE_REPO_URL,
+                                           constants.BOTLEAGUE_REPO_ROOT)
+        return _botleague_mirror
@@ -3,6 +3,8 @@ from typing import Optional, List
 
 from box import Box
 
+from models.eval_data import EvalData
+
 
 class PrResponse:
     msg: str
@@ -28,7 +30,7 @@ class IgnorePrResponse(PrResponse):
 
 
 class EvalStartedPrResponse(StartedPrResponse):
-    eval_data: Optional[Box] = None
+    eval_data: Optional[EvalData] = None
 
     def __init__(self, msg, eval_data):
         super().__init__(msg)
@@ -37,10 +39,13 @@ class EvalStartedPrResponse(StartedPrResponse):
 
 class ProblemCIResponse(StartedPrResponse):
     bot_evals: Optional[List] = None
+    # 'user_or_org/botname' -> Box(error=...)
+    bot_eval_failures: Optional[Box] = None
 
-    def __init__(self, msg, bot_evals):
+    def __init__(self, msg, bot_evals, bot_eval_failures: Box = None):
         super().__init__(msg)
         self.bot_evals = bot_evals
+        self.bot_eval_failures = bot_eval_failures or Box()
 
 
 class NoBotsResponse(PrResponse):
@@ -0,0 +1,87 @@
+"""
+Serve the liaison off App Engine with gunicorn: several worker processes,
+each with a pool of threads, so one slow /results request doesn't hold up
+confirms and webhooks behind it.
+
+Workers share the pull request queue and the botleague mirror on disk, but
+metrics and in-memory caches are per worker, see the README.
+
+Usage:
+    python serve.py
+    PORT=8080 SERVER_WORKERS=4 SERVER_THREADS=16 python serve.py
+"""
+from typing import Callable
+
+from gunicorn.app.base import BaseApplication
+
+import constants
+from logs import log
+
+
+class LiaisonServer(BaseApplication):
+    """
+    :param warm_up: Called in each worker after forking, as clients for
+        Firestore, KMS and GitHub don't survive a fork
+    """
+    def __init__(self, app, warm_up: Callable[[], None], options: dict):
+        self.application = app
+        self.warm_up = warm_up
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def on_starting(_server):
+    # Once, before forking, so that a worker starting up never requeues jobs
+    # another worker is running
+    from work_queue import WorkQueue
+    WorkQueue(constants.PR_QUEUE_PATH, requeue_running=True).close()
+
+
+def post_fork(server, worker):
+    from work_queue import get_pr_queue
+    get_pr_queue(requeue_running=False)
+    server.app.warm_up()
+    log.info(f'Worker {worker.pid} ready')
+
+
+def worker_exit(_server, _worker):
+    # In-flight requests are done by now
+    from work_queue import stop_pr_workers
+    stop_pr_workers()
+
+
+def get_options() -> dict:
+    return dict(
+        bind=f'0.0.0.0:{constants.SERVER_PORT}',
+        workers=constants.SERVER_WORKERS,
+        worker_class='gthread',
+        threads=constants.SERVER_THREADS,
+        keepalive=constants.SERVER_KEEPALIVE,
+        timeout=constants.SERVER_TIMEOUT,
+        graceful_timeout=constants.SERVER_GRACEFUL_TIMEOUT,
+        # Import the app once in the master and fork it
+        preload_app=True,
+        on_starting=on_starting,
+        post_fork=post_fork,
+        worker_exit=worker_exit)
+
+
+def serve(app=None, warm_up: Callable[[], None] = None, **options):
+    if app is None:
+        from main import app, warm_up
+    log.success(f'Serving http://0.0.0.0:{constants.SERVER_PORT} with '
+                f'{constants.SERVER_WORKERS} workers of '
+                f'{constants.SERVER_THREADS} threads')
+    LiaisonServer(app, warm_up or (lambda: None),
+                  dict(get_options(), **options)).run()
+
+
+if __name__ == '__main__':
+    serve()
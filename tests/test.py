@@ -2,21 +2,53 @@
 # Set SHOULD_RECORD=true to record changed-files.json
 import statistics
 
+import hashlib
+import hmac
+import json
 import math
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
 from os.path import join
 from random import random
 
+import requests
 from box import Box
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
+from pyramid import httpexceptions
+from pyramid.request import Request
 
 import constants
 from botleague_helpers.utils import get_eval_db_key
 
-from bot_eval import BOT_CHANGED, PROBLEM_CHANGED
+from benchmarks.fakes import FakeGithub, build_league_repo
+from benchmarks.league import make_league, use_league
+from benchmarks.startup import IMPORT_BUDGET_SECONDS, LAZY_MODULES, \
+    get_record, profile_imports
+from bot_eval import BOT_CHANGED, PROBLEM_CHANGED, BotEvalMock, \
+    get_problem_session
+from bot_index import BotIndex, set_bot_index
+from config_cache import ConfigCache
+from event_routes import route_event, EventRoute, WEBHOOK_EVENTS, \
+    ROUTE_IGNORED
 from handlers.confirm_handler import process_confirm
 from handlers.results_handler import add_eval_data_to_results, process_results, \
     score_within_confidence_interval, get_past_bot_scores, get_scores_id
+from github_effects import GithubEffectPlan, SkippedEffect
+from github_gateway import GithubGateway
 from handlers.pr_handler import PrProcessorMock, handle_pr_request
-from models.eval_data import INVALID_DB_KEY_STATE_MESSAGE, get_eval_data
+from leaderboard import LeaderboardCache, set_leaderboard_cache
+from logs import SlackAlertShipper, SLACK_ALERTS, as_json, log
+from metrics import count_responses, counter, histogram, \
+    render_prometheus
+from models.bot_scores import add_score
+from models.eval_data import INVALID_DB_KEY_STATE_MESSAGE, EvalData, \
+    get_eval_data, save_eval_data
+from problem_ci import eval_bots, get_bot_eval_failures, \
+    get_problem_ci_bots
+from repo_mirror import RepoMirror
 from responses.pr_responses import ErrorPrResponse, EvalStartedPrResponse
 
 from botleague_helpers.config import activate_test_mode, blconfig
@@ -24,6 +56,13 @@ from botleague_helpers.utils import get_bot_scores_db, get_liaison_db_store, \
     dbox, generate_rand_alphanumeric
 
 from tests.mockable import Mockable
+from tracing import span, SPAN_DURATION
+from utils import CAS_RETRIES, CasContentionError, cas_update, \
+    get_many, set_many, fan_out
+from webhook_verify import read_webhook
+from work_queue import WorkQueue, drain, get_pr_dedup_key, \
+    JOB_STATUS_FAILED, JOB_STATUS_PENDING, JOB_STATUS_RUNNING, \
+    JOB_STATUS_SUPERSEDED
 
 activate_test_mode()  # So don't import this module from non-test code!
 
@@ -81,8 +120,13 @@ def test_results_handler():
     assert results.problem == 'deepdrive/domain_randomization'
 
 
-def get_test_eval_data():
-    ret = Mockable.read_test_box('eval_data.json')
+def get_test_eval_data(test_name: str = None):
+    """:param test_name: Whose data to use, defaults to the calling test's"""
+    if test_name is None:
+        ret = Mockable.read_test_box('eval_data.json')
+    else:
+        ret = Box.from_json(filename=Mockable.get_test_filename_from_test_name(
+            test_name, 'eval_data.json'))
     ret.botleague_liaison_host = constants.HOST
     return ret
 
@@ -128,6 +172,45 @@ def test_results_handler_already_complete():
     assert 'finished' in results
 
 
+def test_eval_data_round_trip():
+    stored = get_test_eval_data()
+    # Evals stored before EvalData embedded the whole PR event
+    stored.pull_request.pr_event = Box(body='x' * 10 ** 4)
+    # Written by something else, or a newer version
+    stored.reviewed_by = 'someone'
+    stored.pull_request.labels = ['problem']
+    eval_data = EvalData.from_dict(stored)
+    assert EvalData(**stored).extra == eval_data.extra
+    assert not hasattr(eval_data, '__dict__')
+    assert eval_data.pull_request.number == stored.pull_request.number
+    db = get_liaison_db_store()
+    save_eval_data(eval_data, db)
+    saved = db.get(get_eval_db_key(eval_data.eval_key))
+    assert 'pr_event' not in saved.pull_request
+    assert saved.reviewed_by == 'someone'
+    assert saved.pull_request.labels == ['problem']
+    assert 'results' not in saved
+    assert get_eval_data(eval_data.eval_key, db).to_dict() == \
+        eval_data.to_dict()
+
+
+def test_eval_request_body():
+    eval_data = EvalData.from_dict(
+        get_test_eval_data('eval_data_round_trip'))
+    eval_data.started_at = SERVER_TIMESTAMP
+    eval_data.results = Box(score=1)
+    body = eval_data.to_request_body()
+    assert b': ' not in body
+    sent = json.loads(body)
+    assert sent['eval_key'] == eval_data.eval_key
+    assert sent['pull_request']['number'] == eval_data.pull_request.number
+    assert 'started_at' not in sent and 'results' not in sent
+    assert get_problem_session('https://a.com/eval/x') is \
+        get_problem_session('https://a.com/eval/y')
+    assert get_problem_session('https://a.com/eval') is not \
+        get_problem_session('https://b.com/eval')
+
+
 def test_confirm_handler():
     payload = Mockable.read_test_box('request.json')
     db = get_liaison_db_store()
@@ -227,6 +310,685 @@ def test_problem_ci_sim_build():
     assert all(b.reason == PROBLEM_CHANGED for b in resp.bot_evals)
 
 
+def test_problem_ci_keeps_started_evals():
+    pull_request = Mockable.get_pr_event_from_test_name(
+        'problem_ci_sim_build').pull_request
+    db = get_liaison_db_store()
+    eval_keys = {}
+
+    def request_eval(_endpoint, eval_data):
+        eval_keys[eval_data.botname] = eval_data.eval_key
+        if eval_data.botname == 'down':
+            raise requests.exceptions.ConnectionError('Connection refused')
+        elif eval_data.botname == 'confirmed_slow':
+            process_confirm(Box(eval_key=eval_data.eval_key), db)
+        if eval_data.botname.endswith('slow'):
+            time.sleep(0.5)
+        return EvalStartedPrResponse('Mock eval', eval_data)
+
+    bots = {('user', botname): Box(docker_tag=f'user/{botname}')
+            for botname in ['ok', 'down', 'slow', 'confirmed_slow']}
+    orig_request_eval = BotEvalMock.request_eval
+    orig_deadline = constants.EVAL_FAN_OUT_DEADLINE
+    BotEvalMock.request_eval = staticmethod(request_eval)
+    constants.EVAL_FAN_OUT_DEADLINE = 0.2
+    try:
+        resp = eval_bots(
+            base_repo=None, bots_with_problem=bots, changed_filenames=[],
+            changed_files=[], from_mock=True, github_client=None,
+            head_repo=None, prob_def=Box(endpoint='https://a.com/eval/p'),
+            problem_id='org/p', pull_request=pull_request,
+            botleague_liaison_host=None, replace_sim_url=None,
+            container_postfix=None)
+    finally:
+        BotEvalMock.request_eval = staticmethod(orig_request_eval)
+        constants.EVAL_FAN_OUT_DEADLINE = orig_deadline
+    # Both of these are running, so they go in the problem CI's bot_eval_keys
+    assert [e.botname for e in resp.bot_evals] == ['ok', 'confirmed_slow']
+    assert sorted(resp.bot_eval_failures) == ['user/down', 'user/slow']
+    assert resp.bot_eval_failures['user/slow'].error == \
+        'Timed out triggering eval, canceled it'
+    assert get_bot_eval_failures(
+        Box(bot_eval_failures=resp.bot_eval_failures)) == \
+        resp.bot_eval_failures
+    # As stored before failures were keyed by bot
+    assert get_bot_eval_failures(Box(bot_eval_failures=[
+        dict(username='user', botname='down', error='Down')])) == \
+        {'user/down': dict(error='Down')}
+    assert get_bot_eval_failures(Box()) == {}
+    # The timed out eval can't start late
+    error, confirm_resp = process_confirm(
+        Box(eval_key=eval_keys['slow']), db)
+    assert error and not confirm_resp.confirmed
+    assert get_eval_data(eval_keys['down'], db).status == \
+        constants.EVAL_STATUS_CANCELED
+
+
+def test_pr_queue_dedup():
+    def pr_payload(action, head_sha):
+        return dict(action=action, pull_request=dict(
+            number=7, head=dict(sha=head_sha),
+            base=dict(repo=dict(full_name='botleague/botleague'))))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queue = WorkQueue(join(tmp_dir, 'queue.sqlite'))
+        first = pr_payload('synchronize', 'a' * 40)
+        assert queue.enqueue(*get_pr_dedup_key_args(first))
+        # Redelivery of the same event collapses
+        assert not queue.enqueue(*get_pr_dedup_key_args(first))
+        # A newer push supersedes the pending one
+        second = pr_payload('synchronize', 'b' * 40)
+        assert queue.enqueue(*get_pr_dedup_key_args(second))
+        assert queue.count(JOB_STATUS_SUPERSEDED) == 1
+
+        handled = []
+        assert drain(queue, handled.append) == 1
+        assert handled[0].pull_request.head.sha == 'b' * 40
+
+
+def test_pr_queue_shared_by_workers():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = join(tmp_dir, 'queue.sqlite')
+        first = WorkQueue(path)
+        assert first.enqueue('job', dict(number=1))
+        assert first.claim() is not None
+        # Another worker opening the queue leaves the running job alone
+        second = WorkQueue(path, requeue_running=False)
+        assert second.claim() is None
+        assert second.count(JOB_STATUS_RUNNING) == 1
+        first.close()
+        second.close()
+        # Until a restart, which retries it
+        restarted = WorkQueue(path)
+        assert restarted.count(JOB_STATUS_PENDING) == 1
+        restarted.close()
+
+
+def test_pr_queue_requeues_stale_jobs():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = join(tmp_dir, 'queue.sqlite')
+        dead = WorkQueue(path, max_attempts=2)
+        assert dead.enqueue('job', dict(number=1))
+        job_id, _payload = dead.claim()
+        # Its worker dies, the others carry on
+        live = WorkQueue(path, max_attempts=2, requeue_running=False,
+                         stale_after=0.1)
+        assert live.claim() is None
+        time.sleep(0.2)
+        retried_id, payload = live.claim()
+        assert retried_id == job_id and payload.number == 1
+        # Out of attempts
+        time.sleep(0.2)
+        assert live.claim() is None
+        assert live.count(JOB_STATUS_FAILED) == 1
+        dead.close()
+        live.close()
+
+
+def get_pr_dedup_key_args(payload):
+    dedup_key, group_key = get_pr_dedup_key(payload)
+    return dedup_key, payload, group_key
+
+
+def test_leaderboard_cache():
+    leaders = dict(bots=[dict(problem='org/prob', username='u', botname='b')])
+    requests_seen = []
+
+    class AggregatedResultsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests_seen.append(self.headers.get('If-None-Match'))
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.end_headers()
+            else:
+                body = json.dumps(leaders).encode()
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        def log_message(self, *_args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), AggregatedResultsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    cache = LeaderboardCache(
+        base_url=f'http://127.0.0.1:{server.server_port}', ttl=0,
+        max_stale=0, timeout=1)
+    try:
+        assert cache.get('org/prob').bots[0].botname == 'b'
+        # Revalidated with the ETag, served from cache on 304
+        assert cache.get('org/prob').bots[0].botname == 'b'
+        assert requests_seen == [None, '"v1"']
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    # Stale snapshot served when the site is down
+    assert cache.get('org/prob').bots[0].botname == 'b'
+
+
+def test_bot_score_aggregates():
+    score_values = [random() * 100 for _ in range(300)]
+    bot_scores = dbox(scores=[Box(score=s, eval_key=str(i))
+                              for i, s in enumerate(score_values[:10])])
+    for i, score in enumerate(score_values):
+        # First ten are migrated from the legacy scores list
+        added = add_score(bot_scores, Box(score=score, eval_key=str(i)))
+        assert added == (i >= 10)
+    assert bot_scores.count == len(score_values)
+    assert math.isclose(bot_scores.mean, statistics.mean(score_values))
+    assert math.isclose(bot_scores.stdev, statistics.stdev(score_values))
+    assert bot_scores.min == min(score_values)
+    assert bot_scores.max == max(score_values)
+    assert abs(bot_scores.median - statistics.median(score_values)) < 5
+    assert len(bot_scores.scores) == constants.BOT_SCORES_NUM_RECENT
+    assert 'eval_keys' not in bot_scores
+
+    # Redelivered results are ignored, recent or not
+    for eval_key in ['299', '0', '150']:
+        assert not add_score(bot_scores, Box(score=0, eval_key=eval_key))
+    assert bot_scores.count == len(score_values)
+    assert math.isclose(bot_scores.mean, statistics.mean(score_values))
+
+    # Documents listing every eval_key move them to the filter
+    legacy = dbox(scores=[Box(score=1, eval_key='a')])
+    add_score(legacy, Box(score=2, eval_key='b'))
+    legacy.eval_keys = ['old', 'a', 'b']
+    del legacy['eval_key_filter']
+    assert not add_score(legacy, Box(score=3, eval_key='old'))
+    assert add_score(legacy, Box(score=3, eval_key='c'))
+    assert 'eval_keys' not in legacy
+    assert not add_score(legacy, Box(score=3, eval_key='old'))
+    assert legacy.count == 3
+
+
+def test_synthetic_league():
+    league = make_league(num_bots=40, num_problems=5, history_length=20)
+    generated = next(iter(league.bot_scores.values()))
+    expected = dbox(scores=[])
+    for score in generated['scores']:
+        add_score(expected, Box(score))
+    assert expected.count == generated['count']
+    assert math.isclose(expected.mean, generated['mean'])
+    assert math.isclose(expected.median, generated['median'])
+    assert expected.eval_key_filter == generated['eval_key_filter']
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        try:
+            sha = use_league(league, tmp_dir)
+            for problem_id in league.problem_ids:
+                leaders = league.aggregated_results[problem_id]['bots'][
+                    :constants.PROBLEM_CI_NUM_TOP_BOTS]
+                assert set(get_problem_ci_bots(problem_id, sha)) == \
+                    {(b['username'], b['botname']) for b in leaders}
+        finally:
+            set_bot_index(None)
+            set_leaderboard_cache(None)
+
+
+def test_repo_mirror():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src = join(tmp_dir, 'botleague')
+        first = build_league_repo(src, {'problems/p/problem.json': '{}'})
+        mirror = RepoMirror(src, join(tmp_dir, 'mirror'))
+        assert mirror.resolve('master') == first.encode()
+        assert mirror.read_file('problems/p/problem.json', first) == '{}'
+
+        # Pushed to src after the clone
+        second = build_league_repo(src, {
+            'problems/p/problem.json': '{"id": "p"}'})
+        assert not mirror.has_commit(second)
+        assert mirror.resolve('master') == first.encode()
+        assert mirror.ensure_commit(second)
+        assert mirror.resolve('master') == second.encode()
+        assert mirror.read_box('problems/p/problem.json', 'master').id == 'p'
+        assert mirror.read_file('problems/p/problem.json', first) == '{}'
+        assert mirror.get_changed_paths(first, second) == [
+            'problems/p/problem.json']
+
+        assert mirror.read_file('problems/q/problem.json', second,
+                                missing_ok=True) == ''
+        assert mirror.list_dir('bots', second) == []
+
+        # Reopens the existing clone
+        reopened = RepoMirror(src, join(tmp_dir, 'mirror'))
+        assert reopened.resolve('master') == second.encode()
+
+
+def test_bot_index_update():
+    def bot_json(*problems):
+        return json.dumps(dict(problems=list(problems)))
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        src = join(tmp_dir, 'botleague')
+        path = join(tmp_dir, 'bot_index.json')
+        sha1 = build_league_repo(src, {
+            'bots/alice/a/bot.json': bot_json('p1'),
+            'bots/bob/b/bot.json': bot_json('p1', 'p2'),
+            'bots/carol/c/bot.json': bot_json('p2')})
+        index = BotIndex(RepoMirror(src, join(tmp_dir, 'mirror')), path)
+        index.update(sha1)
+        assert index.problems == {'p1': ['alice/a', 'bob/b'],
+                                  'p2': ['bob/b', 'carol/c']}
+
+        # Added, modified and deleted bots in the next commit
+        sha2 = build_league_repo(src, {
+            'bots/dave/d/bot.json': bot_json('p1'),
+            'bots/bob/b/bot.json': bot_json('p3'),
+            'bots/carol/c/bot.json': None})
+        index.update(sha2)
+        expected = {'p1': ['alice/a', 'dave/d'], 'p3': ['bob/b']}
+        assert index.commit == sha2
+        assert index.problems == expected
+
+        # Persisted
+        assert BotIndex(index.mirror, path).problems == expected
+
+        # Indexed commit the mirror doesn't have, e.g. after a force push
+        index.commit = '0' * 40
+        index.bots['carol/c'] = json.loads(bot_json('p2'))
+        index.update(sha2)
+        assert index.problems == expected
+
+        # Malformed bot.json files are dropped, the rest still index
+        sha3 = build_league_repo(src, {
+            'bots/alice/a/bot.json': '{"problems": ["p1"',
+            'bots/erin/e/bot.json': '["p1"]',
+            'bots/frank/f/bot.json': bot_json('p3')})
+        index.update(sha3)
+        expected = {'p1': ['dave/d'], 'p3': ['bob/b', 'frank/f']}
+        assert index.problems == expected
+        index.commit = None
+        index.update(sha3)
+        assert index.problems == expected
+
+
+def test_github_gateway_caching():
+    fake_github = FakeGithub()
+    gateway = GithubGateway('token', client=fake_github)
+    repo = gateway.get_repo('botleague/botleague')
+    commit = gateway.get_commit('botleague/botleague', 'abc')
+    issue = gateway.get_issue('botleague/botleague', 1)
+    assert fake_github.calls == 3
+    assert gateway.get_repo('botleague/botleague') is repo
+    assert gateway.get_commit('botleague/botleague', 'abc') is commit
+    assert gateway.get_issue('botleague/botleague', 1) is issue
+    assert fake_github.calls == 3
+    gateway.get_commit('botleague/botleague', 'def')
+    gateway.get_repo('botleague/problem')
+    assert fake_github.calls == 5
+
+
+def test_github_gateway_deferred_calls():
+    fake_github = FakeGithub()
+    gateway = GithubGateway('token', client=fake_github)
+    issue = gateway.get_issue('botleague/botleague', 1)
+    comments = []
+
+    def comment(body):
+        comments.append(issue.create_comment(body).body)
+
+    def fail():
+        raise RuntimeError('Deferred call failed')
+
+    gateway.call_non_critical(comment, 'now')
+    assert comments == ['now']
+
+    fake_github.rate_limit_remaining = constants.GITHUB_RATE_LIMIT_RESERVE - 1
+    assert gateway.call_non_critical(comment, 'later') is None
+    gateway.call_non_critical(fail)
+    gateway.call_non_critical(comment, body='after failure')
+    assert comments == ['now']
+    timer = gateway._flush_timer
+    assert timer is not None
+    timer.cancel()
+
+    # As when the rate limit resets
+    fake_github.rate_limit_remaining = 5000
+    gateway._flush_deferred()
+    assert comments == ['now', 'later', 'after failure']
+    assert gateway._flush_timer is None
+    gateway._flush_deferred()
+    assert len(comments) == 3
+
+
+def test_github_effect_plan_order():
+    status_set = threading.Event()
+    order = []
+
+    def status():
+        # Give merge a chance to run first if it didn't wait
+        time.sleep(0.05)
+        order.append('status')
+        status_set.set()
+        return 'status'
+
+    def merge():
+        assert status_set.is_set()
+        order.append('merge')
+        return 'merge'
+
+    plan = GithubEffectPlan()
+    plan.add('comment', lambda: order.append('comment') or 'comment')
+    plan.add('status', status)
+    plan.add('merge', merge, depends_on=['status'])
+    assert plan.wait() == dict(comment='comment', status='status',
+                               merge='merge')
+    assert order.index('status') < order.index('merge')
+
+    try:
+        GithubEffectPlan().add('merge', merge, depends_on=['status'])
+    except ValueError:
+        pass
+    else:
+        raise RuntimeError('Expected unknown dependency to be rejected')
+
+
+def test_github_effect_plan_failures():
+    merged = []
+
+    def status():
+        raise RuntimeError('Could not set status')
+
+    plan = GithubEffectPlan()
+    plan.add('comment', lambda: 'comment')
+    plan.add('status', status)
+    plan.add('merge', lambda: merged.append(True), depends_on=['status'])
+    plan.start()
+    assert plan.wait() == dict(comment='comment')
+    assert not merged
+    try:
+        plan._futures['merge'].result()
+    except SkippedEffect as e:
+        assert str(e) == 'status failed'
+    else:
+        raise RuntimeError('Expected merge to be skipped')
+
+
+def test_cas_update_retries():
+    class RacyDB:
+        """Loses the first lost compare-and-swaps, reads plain dicts"""
+        def __init__(self, lost):
+            self.value = dict(count=0)
+            self.lost = lost
+            self.attempts = 0
+
+        def get(self, _key):
+            return self.value
+
+        def cas(self, _key, _expected, new_value):
+            self.attempts += 1
+            if self.attempts <= self.lost:
+                return False
+            self.value = new_value
+            return True
+
+    def increment(current):
+        current.count += 1
+        return current
+
+    db = RacyDB(lost=2)
+    retries = CAS_RETRIES.get(name='test_cas')
+    assert cas_update(db, 'key', increment, name='test_cas',
+                      base_delay=0).count == 1
+    assert db.attempts == 3
+    assert CAS_RETRIES.get(name='test_cas') == retries + 2
+
+    # Gives up without sleeping after the last attempt
+    db = RacyDB(lost=1)
+    start = time.time()
+    try:
+        cas_update(db, 'key', increment, name='test_cas', max_attempts=1,
+                   base_delay=10)
+    except CasContentionError:
+        pass
+    else:
+        assert False, 'Expected CasContentionError'
+    assert time.time() - start < 1
+    assert db.value == dict(count=0)
+
+
+def test_db_batch():
+    db = get_liaison_db_store()
+    stored = set_many(db, {'test_batch_a': Box(at=SERVER_TIMESTAMP),
+                           'test_batch_b': 2})
+    assert isinstance(stored['test_batch_a'].at, datetime)
+    assert db.get('test_batch_a').at == stored['test_batch_a'].at
+    assert get_many(db, ['test_batch_b', 'test_batch_missing']) == [2, None]
+
+
+def test_config_cache():
+    loads = []
+
+    def load():
+        loads.append(1)
+        return len(loads)
+
+    cache = ConfigCache(ttl=60, refresh_after=30)
+    assert cache.get('key', load) == 1
+    assert cache.get('key', load) == 1
+    assert len(loads) == 1
+
+    # Past refresh_after, serve the cached value while refreshing
+    cache.entries['key'].loaded_at -= 45
+    assert cache.get('key', load) == 1
+    for _ in range(100):
+        if cache.get('key', load) == 2:
+            break
+        time.sleep(0.01)
+    assert cache.get('key', load) == 2
+
+    cache.invalidate('key')
+    assert cache.get('key', load) == 3
+
+    # Shorter ttl for switches, reloaded inline once expired
+    assert cache.get('key', load, ttl=5) == 3
+    cache.entries['key'].loaded_at -= 10
+    assert cache.get('key', load, ttl=5) == 4
+
+
+def test_webhook_signature():
+    body = json.dumps({'action': 'opened', 'number': 1}).encode()
+
+    def webhook_request(headers):
+        return Request.blank(constants.GITHUB_WEBHOOK_PATH, POST=body,
+                             headers=headers)
+
+    sig = hmac.new(b'secret', body, hashlib.sha256).hexdigest()
+    payload = read_webhook(
+        webhook_request({'X-Hub-Signature-256': f'sha256={sig}'}), 'secret')
+    assert payload == {'action': 'opened', 'number': 1}
+
+    # SHA-1 fallback
+    sig = hmac.new(b'secret', body, hashlib.sha1).hexdigest()
+    assert read_webhook(webhook_request({'X-Hub-Signature': f'sha1={sig}'}),
+                        'secret') == payload
+
+    for headers, max_size, expected in [
+            ({'X-Hub-Signature': f'sha1={sig}'}, 10,
+             httpexceptions.HTTPRequestEntityTooLarge),
+            ({'X-Hub-Signature-256': f'sha256={sig}'}, None,
+             httpexceptions.HTTPForbidden),
+            ({'X-Hub-Signature-256': f'sha256={sig[:-1]}\u00e9'}, None,
+             httpexceptions.HTTPForbidden),
+            ({}, None, httpexceptions.HTTPForbidden)]:
+        kwargs = {'max_size': max_size} if max_size else {}
+        try:
+            read_webhook(webhook_request(headers), 'secret', **kwargs)
+        except expected:
+            pass
+        else:
+            raise RuntimeError(f'Expected {expected.__name__}')
+
+
+def test_event_routes():
+    pull_request = dict(base=dict(repo=dict(full_name='botleague/botleague')))
+    for action in ['labeled', 'edited', 'closed']:
+        ignored = WEBHOOK_EVENTS.get(event='pull_request', action=action,
+                                     route=ROUTE_IGNORED)
+        body, status = route_event('pull_request', dict(
+            action=action, pull_request=pull_request))
+        assert body == {'ignored': True}
+        assert WEBHOOK_EVENTS.get(event='pull_request', action=action,
+                                  route=ROUTE_IGNORED) == ignored + 1
+    assert route_event('ping', {}) == ({'ping': True}, 200)
+
+    readme_push = dict(repository=dict(full_name='botleague/botleague'),
+                       commits=[dict(modified=['problems/a/b/README.md'])])
+    bot_push = dict(repository=dict(full_name='botleague/botleague'),
+                    commits=[dict(added=['bots/a/b/bot.json'])])
+    routes = [EventRoute('problems', event='push', handler=lambda p: 'ok',
+                         base_repos=['botleague/botleague'],
+                         path_prefixes=['problems/'])]
+    assert route_event('push', readme_push, routes) == ('ok', 200)
+    assert route_event('push', bot_push, routes)[0] == {'ignored': True}
+    fork_push = Box(readme_push, repository=dict(full_name='fork/botleague'))
+    assert route_event('push', fork_push, routes)[0] == {'ignored': True}
+
+
+def test_tracing_spans():
+    def child(_i):
+        with span('child') as child_span:
+            return child_span
+
+    with span('outer') as outer:
+        children = fan_out(child, range(3), max_workers=3)
+    # Spans in worker threads nest under the caller's
+    assert all(c.parent_id == outer.span_id for c in children)
+    assert all(c.trace_id == outer.trace_id for c in children)
+    assert len(outer.trace) == 4 and outer.trace[-1] is outer
+    assert SPAN_DURATION.get_count(name='child') >= 3
+
+
+def test_fan_out_timeouts():
+    release = threading.Event()
+    ran = []
+
+    def work(item):
+        ran.append(item)
+        if item == 'hang':
+            release.wait(5)
+        elif item == 'fail':
+            raise ValueError(item)
+        return item
+
+    try:
+        # Queued items get their own timeout once they start
+        ret = fan_out(work, ['hang', 'fail', 'a', 'b', 'c'], max_workers=2,
+                      timeout=0.3, on_timeout=lambda i: f'timeout {i}',
+                      on_error=lambda i, e: f'error {e}')
+        assert ret == ['timeout hang', 'error fail', 'a', 'b', 'c']
+
+        # With every worker stuck, queued items are cancelled, not started
+        ran.clear()
+        ret = fan_out(work, ['hang', 'hang', 'a'], max_workers=2,
+                      timeout=0.2, on_timeout=lambda i: f'timeout {i}')
+        assert ret == ['timeout hang', 'timeout hang', 'timeout a']
+    finally:
+        release.set()
+    time.sleep(0.1)
+    assert 'a' not in ran
+
+
+def test_prometheus_metrics():
+    requests_total = counter('test_requests_total', 'Test requests',
+                             ['route'])
+    requests_total.inc(route='results')
+    latency = histogram('test_latency_seconds', 'Test latency',
+                        buckets=(0.1, 1))
+    latency.observe(0.5)
+    text = render_prometheus()
+    assert '# TYPE test_requests_total counter' in text
+    assert 'test_requests_total{route="results"} 1' in text
+    assert 'test_latency_seconds_bucket{le="0.1"} 0' in text
+    assert 'test_latency_seconds_bucket{le="1"} 1' in text
+    assert 'test_latency_seconds_bucket{le="+Inf"} 1' in text
+    assert 'test_latency_seconds_count 1' in text
+
+
+def test_count_responses():
+    callbacks = counter('test_callbacks_total', 'Test callbacks',
+                        ['route', 'status', 'outcome'])
+
+    @count_responses(callbacks, route='results')
+    def view(status):
+        if status is None:
+            raise RuntimeError('Handler failed')
+        return Box(status_code=status)
+
+    view(200)
+    view(400)
+    try:
+        view(None)
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError('Expected exception')
+    assert callbacks.get(route='results', status=200, outcome='ok') == 1
+    assert callbacks.get(route='results', status=400, outcome='error') == 1
+    assert callbacks.get(route='results', status=500,
+                         outcome='exception') == 1
+
+
+def test_startup_budget():
+    records = profile_imports('main')
+    assert [m for m in LAZY_MODULES if get_record(records, m)] == []
+    assert get_record(records, 'main').cumulative_seconds < \
+        IMPORT_BUDGET_SECONDS
+    assert get_record(records, 'handlers.results_handler').chain[0] == 'main'
+
+
+def test_slack_alert_coalescing():
+    sent = []
+    shipper = SlackAlertShipper(send=sent.append, queue_size=4,
+                                coalesce_window=60, max_per_minute=2)
+    sink_id = log.add(shipper.sink, level='ERROR', format='{message}')
+    dropped = SLACK_ALERTS.get(outcome='dropped_queue_full')
+    try:
+        for endpoint in ['a', 'a', 'a', 'b', 'a']:
+            log.error(f'Problem endpoint {endpoint} down')
+    finally:
+        log.remove(sink_id)
+    # Logging didn't send anything, and the fifth error didn't fit
+    assert sent == []
+    assert SLACK_ALERTS.get(outcome='dropped_queue_full') == dropped + 1
+    shipper.flush(now=0)
+    # Different messages from the same call site aren't coalesced
+    assert sent == ['Problem endpoint a down', 'Problem endpoint b down']
+    shipper.flush(now=61)
+    assert sent[2] == 'Repeated 2 more times in 60s: Problem endpoint a down'
+    limited = SLACK_ALERTS.get(outcome='dropped_rate_limited')
+    shipper.queue.put_nowait(('other', 'Third send'))
+    shipper.queue.put_nowait(('another', 'Fourth send'))
+    shipper.flush(now=62)
+    # Over max_per_minute
+    assert sent[3:] == ['Third send']
+    assert SLACK_ALERTS.get(outcome='dropped_rate_limited') == limited + 1
+
+
+def test_log_summaries():
+    pr_event = Box(action='opened', pull_request=dict(
+        number=7, head=dict(sha='abc', repo=dict(full_name='u/botleague')),
+        body='x' * 10 ** 5))
+    bot_eval = Box(eval_key='secret', pull_request=dict(pr_event=pr_event),
+                   results=dict(score=1, logs=dict(episode='y' * 10 ** 5)),
+                   eval_keys=list(range(100)))
+    logged = json.loads(str(as_json(bot_eval, omit=['eval_key'])))
+    assert 'eval_key' not in logged
+    assert logged['pull_request']['pr_event'] == dict(
+        action='opened', number=7, head_repo='u/botleague', head_sha='abc',
+        base_repo=None, user=None)
+    assert len(logged['results']['logs']['episode']) < 300
+    assert len(logged['eval_keys']) == constants.LOG_MAX_LIST_ITEMS + 1
+
+    class Unused:
+        def __str__(self):
+            raise AssertionError('Formatted a disabled log')
+    log.trace('{}', Unused())
+
+
 def get_past_bot_scores_test(past_scores: list, bot_eval: Box):
     if not past_scores:
         get_bot_scores_db().set(get_scores_id(bot_eval), {})
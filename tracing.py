@@ -0,0 +1,162 @@
+"""
+Lightweight request tracing. Spans nest via a context variable, their
+durations go to histograms in metrics.py, and if TRACE_DUMP_PATH is set
+finished traces are appended there as OpenTelemetry (OTLP) JSON lines.
+
+Usage:
+    with span('request_eval', endpoint=endpoint):
+        ...
+
+    @traced('create_status')
+    def create_status(...):
+"""
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+import constants
+from logs import log
+from metrics import histogram
+
+SPAN_DURATION = histogram('liaison_span_duration_seconds',
+                          'Duration of traced stages', ['name'])
+REQUEST_DURATION = histogram('liaison_request_duration_seconds',
+                             'HTTP request duration', ['route', 'status'])
+
+STATUS_OK = 'ok'
+STATUS_ERROR = 'error'
+
+
+class Span:
+    name: str
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    start_time: float
+    end_time: Optional[float]
+    attributes: dict
+    status: str
+
+    def __init__(self, name: str, parent: 'Span' = None, **attributes):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        if parent is None:
+            self.trace_id = os.urandom(16).hex()
+            self.parent_id = None
+            self.trace = []  # Finished spans, shared with children
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.trace = parent.trace
+        self.attributes = attributes
+        self.start_time = time.time()
+        self.end_time = None
+        self.status = STATUS_OK
+
+    @property
+    def duration(self) -> float:
+        return (self.end_time or time.time()) - self.start_time
+
+    def to_otlp(self) -> dict:
+        return dict(
+            traceId=self.trace_id,
+            spanId=self.span_id,
+            parentSpanId=self.parent_id or '',
+            name=self.name,
+            startTimeUnixNano=int(self.start_time * 1e9),
+            endTimeUnixNano=int(self.end_time * 1e9),
+            attributes=[dict(key=k, value=dict(stringValue=str(v)))
+                        for k, v in self.attributes.items()],
+            status=dict(code=2 if self.status == STATUS_ERROR else 1))
+
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar(
+    'current_span', default=None)
+_dump_lock = threading.Lock()
+_trace_listeners: List[Callable[[List[Span]], None]] = []
+
+
+def add_trace_listener(listener: Callable[[List[Span]], None]):
+    """Call listener with the spans of each finished trace, i.e. benchmarks"""
+    _trace_listeners.append(listener)
+
+
+def get_current_span() -> Optional[Span]:
+    return _current_span.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Time a stage as a child of the current span, or as a new trace"""
+    parent = _current_span.get()
+    current = Span(name, parent, **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException:
+        current.status = STATUS_ERROR
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end_time = time.time()
+        SPAN_DURATION.observe(current.duration, name=name)
+        current.trace.append(current)
+        if parent is None:
+            for listener in _trace_listeners:
+                listener(current.trace)
+            dump_trace(current.trace)
+
+
+def traced(name: str = None) -> Callable:
+    """Decorator that wraps each call in a span"""
+    def decorator(fn):
+        span_name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def dump_trace(spans: List[Span], path=constants.TRACE_DUMP_PATH):
+    if not path:
+        return
+    line = json.dumps(dict(resourceSpans=[dict(
+        resource=dict(attributes=[dict(
+            key='service.name',
+            value=dict(stringValue='botleague-liaison'))]),
+        scopeSpans=[dict(scope=dict(name=__name__),
+                         spans=[s.to_otlp() for s in spans])])]))
+    try:
+        with _dump_lock, open(path, 'a') as f:
+            f.write(line + '\n')
+    except OSError:
+        log.warning(f'Could not write trace to {path}')
+
+
+def tracing_tween_factory(handler, _registry):
+    """Root span and request duration histogram for every request"""
+    def tracing_tween(request):
+        status = 500
+        with span('http_request', method=request.method,
+                  path=request.path) as request_span:
+            try:
+                response = handler(request)
+                status = response.status_code
+                return response
+            finally:
+                route = request.matched_route.name \
+                    if getattr(request, 'matched_route', None) else \
+                    'unmatched'
+                request_span.attributes.update(route=route, status=status)
+                REQUEST_DURATION.observe(request_span.duration, route=route,
+                                         status=status)
+
+    return tracing_tween
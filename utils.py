@@ -1,14 +1,25 @@
+import contextvars
 import json
 import os
 import os.path as p
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from copy import copy, deepcopy
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Any
 
 from botleague_helpers.config import blconfig
-from botleague_helpers.db import DB, get_db
+from botleague_helpers.db import DB, DBFirestore, get_db
 from box import Box
+from google.cloud.firestore_v1 import SERVER_TIMESTAMP
 
 import constants as c
 
 from logs import log
+from metrics import counter
+from tracing import span, traced
 
 from github import UnknownObjectException
 
@@ -19,7 +30,8 @@ def get_file_from_github(repo, filename, ref=None):
         args = [filename]
         if ref is not None:
             args.append(ref)
-        contents = repo.get_contents(*args)
+        with span('github_get', filename=filename):
+            contents = repo.get_contents(*args)
         content_str = contents.decoded_content.decode('utf-8')
     except UnknownObjectException:
         log.error('Unable to find %s in %s', filename, repo.html_url)
@@ -100,10 +112,27 @@ def trigger_leaderboard_generation():
 
 def get_liaison_db_store():
     # TODO: Deprecate this in favor of botleague_helpers version
-    ret = get_db(collection_name='botleague_liaison')
+    ret = TracedDB(get_db(collection_name='botleague_liaison'))
     return ret
 
 
+class TracedDB:
+    """Wraps a botleague_helpers DB so each read and write gets a span"""
+    traced_methods = {'get', 'set', 'cas', 'compare_and_swap', 'where'}
+
+    def __init__(self, db: DB):
+        self.wrapped = db
+
+    def __getattr__(self, name):
+        if name == 'wrapped':
+            # Not set yet, i.e. during copy or unpickling
+            raise AttributeError(name)
+        attr = getattr(self.wrapped, name)
+        if name in self.traced_methods:
+            return traced(f'db.{name}')(attr)
+        return attr
+
+
 def dbox(obj=None, **kwargs):
     # TODO: Deprecate this in favor of botleague_helpers version
     if kwargs:
@@ -113,6 +142,205 @@ def dbox(obj=None, **kwargs):
     return Box(obj, default_box=True)
 
 
+CAS_RETRIES = counter('liaison_cas_retries_total',
+                      'Compare-and-swap attempts that lost a race', ['name'])
+
+
+class CasContentionError(RuntimeError):
+    pass
+
+
+def cas_update(db: DB, key: str, update_fn: Callable[[Any], Any],
+               name: str = None,
+               max_attempts: int = c.CAS_MAX_ATTEMPTS,
+               base_delay: float = c.CAS_BASE_DELAY) -> Any:
+    """
+    Optimistic read-modify-write of key, reading once per attempt and retrying
+    lost races with exponential backoff and full jitter.
+
+    :param update_fn: Given a copy of the current value (falsy if unset),
+        returns the new value, or None to leave the value as is. Documents
+        are passed as Boxes, whether or not db boxes what it reads.
+    :param name: What's being updated, for logs and the retry metric
+    :return: The value written, or None if update_fn returned None
+    """
+    name = name or key
+    for attempt in range(max_attempts):
+        orig = db.get(key)
+        current = deepcopy(orig)
+        if isinstance(current, dict) and not isinstance(current, Box):
+            current = Box(current)
+        new_value = update_fn(current)
+        if new_value is None:
+            return None
+        if db.cas(key, orig, new_value):
+            return new_value
+        CAS_RETRIES.inc(name=name)
+        if attempt == max_attempts - 1:
+            break
+        delay = random.uniform(0, base_delay * 2 ** attempt)
+        log.warning(f'Race condition updating {name}, attempt {attempt + 1} '
+                    f'of {max_attempts}. Retrying in {delay:.3f}s')
+        time.sleep(delay)
+    raise CasContentionError(f'Could not update {name} after {max_attempts} '
+                             f'attempts')
+
+
+def is_firestore(db: DB) -> bool:
+    return isinstance(getattr(db, 'wrapped', db), DBFirestore)
+
+
+def get_many(db: DB, keys: List[str]) -> List:
+    """
+    Read several keys in one round trip where the store supports it, i.e.
+    Firestore's get_all.
+    :return: Values in the same order as keys, falsy for missing keys
+    """
+    keys = list(keys)
+    if not is_firestore(db):
+        return [db.get(key) for key in keys]
+    refs = [db.collection.document(key) for key in keys]
+    by_key = {}
+    with span('db.get_many', num_keys=len(keys)):
+        snapshots = list(db.db.get_all(refs))
+    for snapshot in snapshots:
+        value = db._simplify_value(snapshot.id, snapshot.to_dict() or {})
+        by_key[snapshot.id] = db._to_box(value)
+    return [by_key.get(key, db._to_box({})) for key in keys]
+
+
+_local_batch_lock = threading.Lock()
+
+
+def set_many(db: DB, items: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Atomically write several keys in one round trip, i.e. a Firestore batched
+    write.
+    :return: The values as stored, with any SERVER_TIMESTAMP resolved, so
+        there's no need to read them back
+    """
+    if len(items) > c.FIRESTORE_MAX_BATCH_SIZE:
+        raise ValueError(f'Can only write {c.FIRESTORE_MAX_BATCH_SIZE} keys '
+                         f'at once, got {len(items)}')
+    if not items:
+        return {}
+    if is_firestore(db):
+        batch = db.db.batch()
+        for key, value in items.items():
+            value = db._from_box(value)
+            batch.set(db.collection.document(key),
+                      db._expand_value(key, value))
+        with span('db.set_many', num_keys=len(items)):
+            write_results = batch.commit()
+        # All writes in a batch share the commit time, which is what the
+        # server timestamps resolve to
+        timestamp = write_results[0].update_time
+        ret = {k: resolve_server_timestamps(v, timestamp)
+               for k, v in items.items()}
+    else:
+        with _local_batch_lock:
+            timestamp = datetime.now(timezone.utc)
+            ret = {k: resolve_server_timestamps(v, timestamp)
+                   for k, v in items.items()}
+            for key, value in ret.items():
+                db.set(key, value)
+    return ret
+
+
+def set_resolving_timestamps(db: DB, key: str, value: Any) -> Any:
+    """Set key, returning the value as stored with SERVER_TIMESTAMP resolved"""
+    return set_many(db, {key: value})[key]
+
+
+def resolve_server_timestamps(value: Any, timestamp: datetime) -> Any:
+    """:return: A copy of value with SERVER_TIMESTAMP replaced by timestamp"""
+    if value is SERVER_TIMESTAMP:
+        return timestamp
+    elif isinstance(value, dict):
+        ret = copy(value)
+        for k, v in value.items():
+            ret[k] = resolve_server_timestamps(v, timestamp)
+        return ret
+    elif isinstance(value, list):
+        return type(value)(resolve_server_timestamps(v, timestamp)
+                           for v in value)
+    return value
+
+
+def fan_out(fn: Callable, items: Iterable, max_workers: int,
+            timeout: float = None, on_timeout: Callable = None,
+            on_error: Callable = None) -> List:
+    """
+    Call fn on each item concurrently.
+    :param timeout: Seconds each item may run for, counted from when it
+        starts rather than when it was queued behind other items
+    :param on_timeout: Called with the item to produce its result on timeout.
+        Items that started are left to finish in the background. Items that
+        never got a worker, as every worker is stuck on a timed out item, are
+        cancelled so they can't start after being reported as timed out.
+    :param on_error: Called with the item and the exception fn raised to
+        produce its result, rather than failing every item
+    :return: Results in the same order as items
+    """
+    def call(item):
+        try:
+            return fn(item)
+        except Exception as e:
+            if on_error is None:
+                raise
+            return on_error(item, e)
+
+    items = list(items)
+    if len(items) <= 1 or max_workers <= 1:
+        return [call(item) for item in items]
+    num_workers = min(max_workers, len(items))
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+    started_at = [None] * len(items)
+
+    def run(i):
+        started_at[i] = time.time()
+        return call(items[i])
+
+    # Copy the context per item so spans nest under the caller's
+    futures = [executor.submit(contextvars.copy_context().run, run, i)
+               for i in range(len(items))]
+    timed_out = []
+    ret = []
+    try:
+        for i, (item, future) in enumerate(zip(items, futures)):
+            while True:
+                if timeout is None:
+                    ret.append(future.result())
+                    break
+                start = started_at[i]
+                if start is None:
+                    stuck = sum(1 for f in timed_out if not f.done())
+                    if stuck >= num_workers and future.cancel():
+                        ret.append(on_timeout(item))
+                        break
+                    # Not started, check back shortly
+                    remaining = c.FAN_OUT_POLL_INTERVAL
+                else:
+                    remaining = max(0, start + timeout - time.time())
+                try:
+                    ret.append(future.result(timeout=remaining))
+                    break
+                except TimeoutError:
+                    if start is None:
+                        continue
+                    if on_timeout is None:
+                        raise
+                    timed_out.append(future)
+                    ret.append(on_timeout(item))
+                    break
+    finally:
+        # Don't block on stragglers, and don't start what's still queued
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+    return ret
+
+
 def is_json(string: str):
     try:
         json.loads(string)
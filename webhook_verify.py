@@ -0,0 +1,94 @@
+import hashlib
+import hmac
+import json
+from typing import Optional
+
+from botleague_helpers.config import blconfig
+from pyramid import httpexceptions
+from pyramid.request import Request
+
+import constants
+from config_cache import get_secret
+
+SIGNATURE_HEADERS = [('X-Hub-Signature-256', 'sha256', hashlib.sha256),
+                     ('X-Hub-Signature', 'sha1', hashlib.sha1)]
+
+
+def read_webhook(request: Request, secret: Optional[str],
+                 max_size=constants.GITHUB_WEBHOOK_MAX_PAYLOAD_SIZE):
+    """
+    Read the webhook body once, computing its HMAC as it streams in, then
+    parse the JSON payload from that same buffer.
+
+    :param secret: Webhook secret, or None to skip signature verification
+    :return: The parsed payload
+    """
+    if request.content_length and request.content_length > max_size:
+        raise httpexceptions.HTTPRequestEntityTooLarge(
+            f'Webhook payload over {max_size} bytes')
+    mac = None
+    signature = None
+    if secret is not None:
+        for header, prefix, digestmod in SIGNATURE_HEADERS:
+            if header in request.headers:
+                signature = request.headers[header]
+                mac = hmac.new(bytes(secret, 'utf-8'), digestmod=digestmod)
+                break
+        else:
+            raise httpexceptions.HTTPForbidden(
+                'No X-Hub-Signature-256 or X-Hub-Signature found')
+
+    chunks = []
+    size = 0
+    stream = request.body_file
+    while True:
+        chunk = stream.read(constants.GITHUB_WEBHOOK_READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > max_size:
+            raise httpexceptions.HTTPRequestEntityTooLarge(
+                f'Webhook payload over {max_size} bytes')
+        if mac is not None:
+            mac.update(chunk)
+        chunks.append(chunk)
+    body = b''.join(chunks)
+
+    if mac is not None:
+        expected = f'{prefix}={mac.hexdigest()}'
+        # As bytes, compare_digest raises on non-ASCII strs
+        if not hmac.compare_digest(expected.encode(), signature.encode()):
+            raise httpexceptions.HTTPForbidden(
+                f'Webhook HMAC in {header} does not match. Check secret'
+                ' key in webhook matches BL_GITHUB_WEBOOK_SECRET in Firestore')
+
+    # Leave the body readable for anything downstream
+    request.body = body
+    try:
+        ret = json.loads(body)
+    except ValueError:
+        raise httpexceptions.HTTPBadRequest('Webhook payload is not JSON')
+    return ret
+
+
+def verify_webhook_tween_factory(handler, _registry):
+    """
+    Verifies and parses GitHub webhooks before routing, so the view gets
+    request.webhook_payload without reading or parsing the body again.
+    """
+    def verify_webhook_tween(request: Request):
+        if request.path != constants.GITHUB_WEBHOOK_PATH or \
+                request.method != 'POST':
+            return handler(request)
+        if blconfig.is_test:
+            secret = None
+        else:
+            secret = get_secret(constants.GITHUB_WEBHOOK_SECRET_NAME)
+        try:
+            request.webhook_payload = read_webhook(request, secret)
+        except httpexceptions.HTTPException as e:
+            # Tweens above the exception view need to return the response
+            return e
+        return handler(request)
+
+    return verify_webhook_tween
@@ -0,0 +1,300 @@
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional, Tuple
+
+from box import Box
+
+import constants
+from logs import log
+from tracing import span
+
+JOB_STATUS_PENDING = 'pending'
+JOB_STATUS_RUNNING = 'running'
+JOB_STATUS_DONE = 'done'
+JOB_STATUS_FAILED = 'failed'
+JOB_STATUS_SUPERSEDED = 'superseded'
+
+PR_ACTIONS = ['opened', 'synchronize', 'reopened']
+
+STALE_JOB_ERROR = 'Timed out, worker running it likely died'
+
+
+class WorkQueue:
+    """
+    Durable FIFO of JSON jobs backed by SQLite.
+
+    Jobs with the same dedup_key collapse while one is still pending or
+    running. Jobs in the same group are superseded by newer jobs, i.e. only the
+    latest push to a pull request gets processed.
+
+    Several processes can share a queue, e.g. server workers, in which case
+    only one of them should requeue_running. Jobs left running by a worker
+    that died while the rest carry on are retried once they've not been
+    updated for stale_after seconds.
+    """
+    path: str
+    max_attempts: int
+    stale_after: float
+
+    def __init__(self, path, max_attempts=constants.PR_QUEUE_MAX_ATTEMPTS,
+                 requeue_running=True,
+                 stale_after=constants.PR_QUEUE_STALE_AFTER):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.stale_after = stale_after
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.executescript(f'''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                dedup_key TEXT NOT NULL,
+                group_key TEXT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL);
+            CREATE UNIQUE INDEX IF NOT EXISTS jobs_active_dedup
+                ON jobs (dedup_key)
+                WHERE status IN ('{JOB_STATUS_PENDING}',
+                                 '{JOB_STATUS_RUNNING}');
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id);
+        ''')
+        if requeue_running:
+            # Anything left running was interrupted by an instance shutdown
+            self._conn.execute('UPDATE jobs SET status = ? WHERE status = ?',
+                               (JOB_STATUS_PENDING, JOB_STATUS_RUNNING))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def enqueue(self, dedup_key: str, payload: dict,
+                group_key: str = None) -> bool:
+        """:return: False if an identical job is already queued"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                cursor = self._conn.execute(
+                    'INSERT OR IGNORE INTO jobs (dedup_key, group_key, '
+                    'payload, status, created_at, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (dedup_key, group_key, json.dumps(payload),
+                     JOB_STATUS_PENDING, now, now))
+                enqueued = cursor.rowcount == 1
+                if enqueued and group_key is not None:
+                    self._conn.execute(
+                        'UPDATE jobs SET status = ?, updated_at = ? '
+                        'WHERE group_key = ? AND status = ? AND id < ?',
+                        (JOB_STATUS_SUPERSEDED, now, group_key,
+                         JOB_STATUS_PENDING, cursor.lastrowid))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return enqueued
+
+    def claim(self) -> Optional[Tuple[int, Box]]:
+        """:return: (job_id, payload) of the oldest pending job, if any"""
+        with self._lock:
+            # Write lock up front so other processes can't claim it too
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._requeue_stale()
+                row = self._conn.execute(
+                    'SELECT id, payload FROM jobs WHERE status = ? '
+                    'ORDER BY id LIMIT 1', (JOB_STATUS_PENDING,)).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        'UPDATE jobs SET status = ?, attempts = attempts + 1, '
+                        'updated_at = ? WHERE id = ?',
+                        (JOB_STATUS_RUNNING, time.time(), row[0]))
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        if row is None:
+            return None
+        job_id, payload = row
+        return job_id, Box(json.loads(payload))
+
+    def complete(self, job_id: int):
+        self._set_status(job_id, JOB_STATUS_DONE)
+
+    def fail(self, job_id: int, error: str):
+        with self._lock:
+            attempts, = self._conn.execute(
+                'SELECT attempts FROM jobs WHERE id = ?', (job_id,)).fetchone()
+        if attempts < self.max_attempts:
+            status = JOB_STATUS_PENDING
+        else:
+            status = JOB_STATUS_FAILED
+        self._set_status(job_id, status, error)
+
+    def count(self, status=JOB_STATUS_PENDING) -> int:
+        with self._lock:
+            ret, = self._conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE status = ?',
+                (status,)).fetchone()
+        return ret
+
+    def _requeue_stale(self):
+        now = time.time()
+        cursor = self._conn.execute(
+            'UPDATE jobs SET status = CASE WHEN attempts < ? THEN ? ELSE ? '
+            'END, error = ?, updated_at = ? '
+            'WHERE status = ? AND updated_at < ?',
+            (self.max_attempts, JOB_STATUS_PENDING, JOB_STATUS_FAILED,
+             STALE_JOB_ERROR, now, JOB_STATUS_RUNNING, now - self.stale_after))
+        if cursor.rowcount:
+            log.warning(f'Requeued {cursor.rowcount} jobs running for over '
+                        f'{self.stale_after}s')
+
+    def _set_status(self, job_id, status, error=None):
+        with self._lock:
+            self._conn.execute(
+                'UPDATE jobs SET status = ?, error = ?, updated_at = ? '
+                'WHERE id = ?', (status, error, time.time(), job_id))
+
+
+class WorkerPool:
+    """Threads that drain a WorkQueue with handle_fn(payload)"""
+
+    def __init__(self, queue: WorkQueue, handle_fn, num_workers: int):
+        self.queue = queue
+        self.handle_fn = handle_fn
+        self.num_workers = num_workers
+        self.threads = []
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def start(self):
+        for i in range(self.num_workers):
+            thread = threading.Thread(target=self._run, daemon=True,
+                                      name=f'work-queue-{i}')
+            thread.start()
+            self.threads.append(thread)
+
+    def notify(self):
+        self._wake.set()
+
+    def stop(self, timeout=None):
+        """
+        Let running jobs finish, waiting up to timeout seconds in all. Jobs
+        still running after that are requeued when the queue is next opened.
+        """
+        self._stopping.set()
+        self._wake.set()
+        deadline = None if timeout is None else time.time() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else
+                        max(0, deadline - time.time()))
+
+    def _run(self):
+        while not self._stopping.is_set():
+            if not process_next(self.queue, self.handle_fn):
+                self._wake.wait(timeout=1)
+                self._wake.clear()
+
+
+def process_next(queue: WorkQueue, handle_fn) -> bool:
+    """:return: Whether a job was processed"""
+    claimed = queue.claim()
+    if claimed is None:
+        return False
+    job_id, payload = claimed
+    try:
+        # Root span for the job as it runs outside of any request
+        with span('queued_job', job_id=job_id):
+            handle_fn(payload)
+    except Exception as e:
+        log.exception(f'Error processing queued job {job_id}')
+        queue.fail(job_id, str(e))
+    else:
+        queue.complete(job_id)
+    return True
+
+
+def drain(queue: WorkQueue, handle_fn) -> int:
+    """Synchronously process everything pending, i.e. for tests"""
+    num = 0
+    while process_next(queue, handle_fn):
+        num += 1
+    return num
+
+
+def get_pr_dedup_key(payload: dict) -> Tuple[str, str]:
+    """:return: (dedup_key, group_key) for a pull_request webhook payload"""
+    pull_request = payload['pull_request']
+    group_key = f'{pull_request["base"]["repo"]["full_name"]}#' \
+                f'{pull_request["number"]}'
+    dedup_key = f'{group_key}@{pull_request["head"]["sha"]}:' \
+                f'{payload["action"]}'
+    return dedup_key, group_key
+
+
+_pr_queue: Optional[WorkQueue] = None
+_pr_workers: Optional[WorkerPool] = None
+_pr_queue_lock = threading.Lock()
+
+
+def get_pr_queue(requeue_running=True) -> WorkQueue:
+    """
+    :param requeue_running: Only used when opening the queue, pass False
+        when other processes may be running its jobs
+    """
+    global _pr_queue
+    with _pr_queue_lock:
+        if _pr_queue is None:
+            _pr_queue = WorkQueue(constants.PR_QUEUE_PATH,
+                                  requeue_running=requeue_running)
+        return _pr_queue
+
+
+def get_pr_workers() -> WorkerPool:
+    global _pr_workers
+    queue = get_pr_queue()
+    with _pr_queue_lock:
+        if _pr_workers is None:
+            from handlers.pr_handler import handle_pr_request
+            _pr_workers = WorkerPool(queue, handle_pr_request,
+                                     num_workers=constants.PR_QUEUE_WORKERS)
+            _pr_workers.start()
+        return _pr_workers
+
+
+def stop_pr_workers(timeout: float = constants.PR_QUEUE_DRAIN_TIMEOUT):
+    """Finish the pull requests being processed, i.e. on shutdown"""
+    with _pr_queue_lock:
+        workers = _pr_workers
+    if workers is None:
+        return
+    log.info(f'Waiting up to {timeout}s for queued pull requests to finish')
+    workers.stop(timeout)
+    unfinished = [t.name for t in workers.threads if t.is_alive()]
+    if unfinished:
+        log.warning(f'{unfinished} still running, their jobs will be '
+                    f'retried on restart')
+
+
+def enqueue_pr_event(payload: dict) -> bool:
+    """
+    Queue a pull_request webhook for the worker pool.
+    :return: False if the event was a duplicate or not an actionable action
+    """
+    if payload['action'] not in PR_ACTIONS:
+        return False
+    dedup_key, group_key = get_pr_dedup_key(payload)
+    enqueued = get_pr_queue().enqueue(dedup_key, payload, group_key)
+    if enqueued:
+        log.info(f'Queued pull request event {dedup_key}')
+    else:
+        log.info(f'Dropping duplicate pull request event {dedup_key}')
+    get_pr_workers().notify()
+    return enqueued